@@ -49,6 +49,36 @@ def logLike_2nucs_exp_smuD(s_mu_D,p_k,t_k):
     
     return L
 
+def chi2_traj_batch(s_mu,pp,tt):
+    '''chi2_traj for many sites: s_mu (n_sites, 2), pp (n_sites, n_times)
+    '''
+    p_theory = (s_mu[:,1]/s_mu[:,0])[:,np.newaxis]*(1-np.exp(-s_mu[:,0][:,np.newaxis]*tt))
+    
+    return np.sum((p_theory - pp)**2,axis=1)
+
+def chi2_traj_p0_batch(s_mu_p0,pp,tt):
+    '''chi2_traj_p0 for many sites: s_mu_p0 (n_sites, 3), pp (n_sites, n_times)
+    '''
+    s = s_mu_p0[:,0][:,np.newaxis]
+    p_theory = (s_mu_p0[:,1][:,np.newaxis]/s)*(1-np.exp(-s*tt)) +\
+    s_mu_p0[:,2][:,np.newaxis]*np.exp(-s*tt)
+    
+    return np.sum((p_theory - pp)**2,axis=1)
+
+def logLike_2nucs_exp_smuD_batch(s_mu_D,p_k,t_k):
+    '''logLike_2nucs_exp_smuD for many sites: s_mu_D (n_sites, 3), p_k (n_sites, n_times)'''
+    s = s_mu_D[:,0][:,np.newaxis]
+    mu = s_mu_D[:,1][:,np.newaxis]
+    D0 = s_mu_D[:,2][:,np.newaxis]
+    
+    dt_k = np.diff(t_k)
+    d_k = (1-np.exp(-2*s*dt_k))/(2*s)
+        
+    L = (.5*np.log(D0*d_k)).sum(axis=1) + ((p_k[:,1:] -(1-np.exp(-s*dt_k))*mu/s -\
+    p_k[:,:-1]*np.exp(-s*dt_k))**2/(2*D0*d_k)).sum(axis=1)
+    
+    return L
+
 def amoeba_vp(func,x0,args = (),Nit = 10**4,a = None,tol_x = 10**(-4),tol_f = 10**(-4),return_f = False):
     '''Home-made realization fo Nelder-mead minimum search
         
@@ -146,6 +176,114 @@ def amoeba_vp(func,x0,args = (),Nit = 10**4,a = None,tol_x = 10**(-4),tol_f = 10
     else:
         return xx[0,:]
         
+def amoeba_vp_batch(func,x0,args = (),shared_args = (),Nit = 10**4,a = None,tol_x = 10**(-4),tol_f = 10**(-4),return_f = False):
+    '''Nelder-Mead minimum search for many independent problems at once
+    
+    Each problem (e.g. a site) goes through the same steps as in amoeba_vp, 
+    but the function is evaluated for all problems that have not converged 
+    yet in one vectorized call.
+        
+    Input arguments:
+    func - function to minimize, called as func(x, *args_subset, *shared_args) 
+    with x of shape (m, n) for m problems, returns m function values
+    x0 - initial minimum guesses, shape (n_problems, n)
+    args - per-problem arguments for the function (first dimension n_problems)
+    shared_args - arguments common to all problems
+    Nit, a, tol_x, tol_f - see amoeba_vp
+    return_f - return the function values and the numbers of iterations
+    
+    Output arguments:
+    positions of the minima, shape (n_problems, n)
+    '''
+    
+    '''Nelder-Mead parameters'''
+    alpha = 1.
+    gamma = 2.
+    rho = -.5
+    sigma = .5
+    
+    N, n = x0.shape
+    if a is None:
+        a = np.ones(n)
+    def f(x, ind):
+        return func(x, *([arg[ind] for arg in args] + list(shared_args)))
+    
+    xx = np.repeat(x0[:,np.newaxis,:],n+1,axis=1).astype(float)
+    xx[:,1:,:] += np.diag(a)
+    ff = np.array([f(xx[:,k,:],np.arange(N)) for k in xrange(n+1)]).T
+    
+    active = np.ones(N,dtype = bool)
+    n_iter = np.zeros(N,dtype = int)
+    xcenter = np.copy(xx)
+    for j in xrange(Nit):
+        ia = np.where(active)[0]
+        if len(ia) == 0:
+            break
+        x = xx[ia]
+        fa = ff[ia]
+        n_iter[ia] = j
+        xcenter[ia] = np.mean(x,axis=1)[:,np.newaxis,:]
+        fmean = np.mean(fa,axis=1)[:,np.newaxis]
+        conv = (np.abs(x-xcenter[ia]) < tol_x*np.abs(xcenter[ia])).all(axis=2).all(axis=1)*\
+        (np.abs(fa-fmean) < tol_f*np.abs(fmean)).all(axis=1)
+        active[ia[conv]] = False
+        ia = ia[~conv]
+        x = x[~conv]
+        fa = fa[~conv]
+        m = len(ia)
+        if m == 0:
+            break
+        
+        '''order'''
+        jjsort = np.argsort(fa,axis=1)
+        rows = np.arange(m)[:,np.newaxis]
+        fa = fa[rows,jjsort]
+        x = x[rows,jjsort,:]
+        
+        '''centroid point'''
+        xo = np.mean(x[:,:n,:],axis=1)
+        
+        '''reflection'''
+        xr = xo + alpha*(xo - x[:,n,:])
+        fr = f(xr,ia)
+        x_new = np.copy(xr)
+        f_new = np.copy(fr)
+        
+        '''expansion'''
+        jje = np.where(fr < fa[:,0])[0]
+        if len(jje):
+            xe = xo[jje] + gamma*(xo[jje] - x[jje,n,:])
+            fe = f(xe,ia[jje])
+            better = fe < fr[jje]
+            x_new[jje[better]] = xe[better]
+            f_new[jje[better]] = fe[better]
+        
+        '''contraction, or shrink if that fails'''
+        shrink = np.zeros(m,dtype = bool)
+        jjc = np.where(((fr >= fa[:,0])*(fr < fa[:,-2]) + (fr < fa[:,0])) == False)[0]
+        if len(jjc):
+            xc = xo[jjc] + rho*(xo[jjc]-x[jjc,n,:])
+            fc = f(xc,ia[jjc])
+            ok = fc < fa[jjc,-1]
+            x_new[jjc[ok]] = xc[ok]
+            f_new[jjc[ok]] = fc[ok]
+            shrink[jjc[~ok]] = True
+        
+        x[~shrink,-1,:] = x_new[~shrink]
+        fa[~shrink,-1] = f_new[~shrink]
+        # as in amoeba_vp, the function values are not updated after a shrink
+        x[shrink] = x[shrink,:1,:] + sigma*(x[shrink] - x[shrink,:1,:])
+        xx[ia] = x
+        ff[ia] = fa
+    
+    if active.any():
+        print 'WARNING from amoeba_vp_batch:\n    the maximum number of iterations has been reached for',\
+        active.sum(),'problems, max(dx/x) = ', np.max(np.abs((xx[active]-xcenter[active])/xcenter[active]))
+    if return_f:
+        return xx[:,0,:],ff[:,0], n_iter
+    else:
+        return xx[:,0,:]
+        
 if __name__=="__main__":
     '''Studying fluctuations of nucleotides with high fitness'''
     plt.ioff()
@@ -186,26 +324,22 @@ if __name__=="__main__":
     t_k[1:] = np.copy(tt)
     p_cutoff = 10**(-5)*tt[-1] 
     jj_sample = jj2[np.where(np.max(freqs[:,jjnuc0[jj2],jj2],axis=0) < p_cutoff)]
-    s_mu = np.zeros((len(jj_sample),2))
-    s_mu_p = np.zeros((len(jj_sample),3))
-    s_mu_D = np.zeros((len(jj_sample),3))
-    for idx, p in enumerate(freqs[:,jjnuc0[jj_sample],jj_sample].T):
-#    p_ave = freqs[:,jjnuc0[jj_sample],jj_sample].mean(axis=1)
-        s_mu0 = h*np.array([-1,1])
-        s_mu_chi = amoeba_vp(chi2_traj,s_mu0,args=(p,tt),a = .001*np.array([1,1]),return_f = True)#,tol_x = h,tol_f = h)
-        s_mu[idx,:] = s_mu_chi[0]
-        
-        s_mu_p0 = h*np.array([-1,1,0])
-        s_mu_p_chi = amoeba_vp(chi2_traj_p0,s_mu_p0,args=(p,tt),\
-        a = .001*np.array([1,1,1]),return_f = True)#,tol_x = h,tol_f = h)
-        s_mu_p[idx,:] = s_mu_p_chi[0]
-        
-        p_k = np.zeros(tt.shape[0]+1)
-        p_k[1:] = np.copy(p)     
-        s_mu_D0 = h*np.array([1,1,1])
-        s_mu_D_L = amoeba_vp(logLike_2nucs_exp_smuD,s_mu_D0,args=(p_k,t_k),\
-        a = .001*np.array([1,1,1]),return_f = True)#,tol_x = h,tol_f = h)
-        s_mu_D[idx,:] = s_mu_D_L[0]
+    # fit all sites at once, each site runs the same simplex steps as amoeba_vp
+    pp = freqs[:,jjnuc0[jj_sample],jj_sample].T
+    n_sample = len(jj_sample)
+    s_mu0 = np.tile(h*np.array([-1,1]),(n_sample,1))
+    s_mu = amoeba_vp_batch(chi2_traj_batch,s_mu0,args=(pp,),shared_args=(tt,),\
+    a = .001*np.array([1,1]))
+    
+    s_mu_p0 = np.tile(h*np.array([-1,1,0]),(n_sample,1))
+    s_mu_p = amoeba_vp_batch(chi2_traj_p0_batch,s_mu_p0,args=(pp,),shared_args=(tt,),\
+    a = .001*np.array([1,1,1]))
+    
+    p_k = np.zeros((n_sample,tt.shape[0]+1))
+    p_k[:,1:] = pp
+    s_mu_D0 = np.tile(h*np.array([1,1,1]),(n_sample,1))
+    s_mu_D = amoeba_vp_batch(logLike_2nucs_exp_smuD_batch,s_mu_D0,args=(p_k,),shared_args=(t_k,),\
+    a = .001*np.array([1,1,1]))
 
     '''Fitness histogram'''
     s_cutoff = .1
@@ -0,0 +1,122 @@
+# vim: fdm=indent
+'''
+content:    Amino acid mutation rates from each of the 64 codons, computed from
+            the 12 nucleotide mutation rates as dense tables and cached to file
+            for each version of the mutation rate estimates.
+'''
+# Modules
+from __future__ import division, print_function
+
+import os
+import hashlib
+from collections import defaultdict
+import numpy as np
+
+from hivevo.sequence import alphaal
+from util import get_mutation_rates_filename, load_mutation_rates
+from codons import nucs, codons, codon_aa
+
+
+# Globals
+aa_rate_table_folder = '../data/aa_rate_table/'
+# nucleotides of the 64 codons, (64, 3)
+codon_nucs = np.array([[nucs.index(nuc) for nuc in codon] for codon in codons])
+
+
+
+# Functions
+def get_nucleotide_rate_matrix(nuc_muts):
+    '''4x4 matrix of nucleotide mutation rates from a mapping 'A->C' -> rate, zero diagonal'''
+    rates = np.zeros((4, 4))
+    for i, a in enumerate(nucs):
+        for j, d in enumerate(nucs):
+            if a != d:
+                rates[i, j] = nuc_muts[a+'->'+d]
+    return rates
+
+
+def compute_aa_rate_tables(nuc_muts):
+    '''Compute the amino acid mutation rate tables
+
+    Parameters:
+       nuc_muts: mapping of nucleotide mutations ('A->C', ...) to rates
+
+    Returns:
+       dict with
+          single (64 x len(alphaal)): rate from codon to amino acid by single
+             nucleotide mutations
+          double (64 x len(alphaal)): same, including double and triple hits
+          total_nonsyn (64): total rate of nonsynonymous single mutations
+       Stop codons have zero rates from and to them, as do synonymous changes.
+    '''
+    rates = get_nucleotide_rate_matrix(nuc_muts)
+
+    # codon to codon rates, the product of the rates at the differing positions
+    anc = codon_nucs[:, np.newaxis, :]
+    der = codon_nucs[np.newaxis, :, :]
+    diff = anc != der
+    codon_rates = np.where(diff, rates[anc, der], 1).prod(axis=2)
+    nmuts = diff.sum(axis=2)
+
+    is_stop = codon_aa == '*'
+    aa_index = np.array([alphaal.index(aa) for aa in codon_aa])
+    targets = np.zeros((64, len(alphaal)))
+    targets[np.arange(64), aa_index] = 1
+    targets[is_stop] = 0
+    nonsyn = (aa_index[:, np.newaxis] != np.arange(len(alphaal)))&(~is_stop[:, np.newaxis])
+
+    single = codon_rates*(nmuts == 1)
+    tables = {'single': single.dot(targets)*nonsyn,
+              'double': (codon_rates*(nmuts > 0)).dot(targets)*nonsyn,
+              'total_nonsyn': (single*(aa_index[:, np.newaxis] != aa_index)).dot(~is_stop)*(~is_stop)}
+    return tables
+
+
+def get_aa_rate_table_filename(threshold=0.3, gp120=True):
+    '''Get the cache filename, keyed on the md5 hash of the mutation rate file'''
+    with open(get_mutation_rates_filename(threshold=threshold, gp120=gp120), 'rb') as f:
+        md5 = hashlib.md5(f.read()).hexdigest()
+    return aa_rate_table_folder+'aa_rate_table_'+md5+'.npz'
+
+
+def load_aa_rate_tables(threshold=0.3, gp120=True, regenerate=False):
+    '''Load the amino acid mutation rate tables, see compute_aa_rate_tables
+
+    The tables are recomputed whenever the mutation rate file changes.
+    '''
+    fn = get_aa_rate_table_filename(threshold=threshold, gp120=gp120)
+    if (not regenerate) and os.path.isfile(fn):
+        with np.load(fn) as f:
+            return {key: f[key] for key in f.files}
+
+    tables = compute_aa_rate_tables(load_mutation_rates(threshold=threshold, gp120=gp120)['mu'])
+    try:
+        if not os.path.isdir(aa_rate_table_folder):
+            os.makedirs(aa_rate_table_folder)
+        fn_tmp = fn+'.'+str(os.getpid())+'.tmp'
+        with open(fn_tmp, 'wb') as f:
+            np.savez(f, **tables)
+        os.rename(fn_tmp, fn)
+    except (IOError, OSError):
+        print('Could not save amino acid rate tables to file:', os.path.abspath(fn))
+    return tables
+
+
+def get_aa_rate_dicts(tables, doublehit=False):
+    '''Rates as dicts (codon, aa) -> rate and codon -> total nonsyn rate
+
+    Parameters:
+       tables (dict): see load_aa_rate_tables
+       doublehit (bool): include double and triple hits in the first dict
+    '''
+    table = tables['double' if doublehit else 'single']
+    aa_mutation_rates = defaultdict(float)
+    total_mutation_rates = defaultdict(float)
+    for ci, (codon, aa1) in enumerate(zip(codons, codon_aa)):
+        if aa1 == '*':
+            continue
+        for ai, aa2 in enumerate(alphaal):
+            if aa1 != aa2:
+                aa_mutation_rates[(codon, aa2)] = table[ci, ai]
+        total_mutation_rates[codon] = tables['total_nonsyn'][ci]
+    return aa_mutation_rates, total_mutation_rates
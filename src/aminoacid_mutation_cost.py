@@ -5,6 +5,7 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 import seaborn as sns
 from scipy.stats import ks_2samp
+from util import load_fitness_cost_table
 sns.set_style('darkgrid')
 
 blossum62={
@@ -24,18 +25,9 @@ if __name__=="__main__":
     alpha_aa='ARNDCQEGHILKMFPSTWYV'
     fraction_lethal = {}
     for gene in genes:
-        fc = pd.read_csv('../data/fitness_pooled_aa/aa_'+gene+'_fitness_costs_st_'+subtype+'.tsv', sep='\t', header=1)
+        fc = load_fitness_cost_table('../data/fitness_pooled_aa/aa_'+gene+'_fitness_costs_st_'+subtype+'.tsv')
         cons = np.array(fc.loc[:,'consensus'])
-        fitness = fc.loc[:,'median']
-        fitness_array = []
-        for f in fitness:
-            if f=='>0.1':
-                fitness_array.append(0.1)
-            elif f=='<0.001':
-                fitness_array.append(0.001)
-            else:
-                fitness_array.append(float(f))
-        fitness_array = np.array(fitness_array)
+        fitness_array = np.array(fc.loc[:,'median'])
         plt.figure()
         plt.title(gene)
         fraction_lethal[gene] = {}
@@ -0,0 +1,95 @@
+# vim: fdm=indent
+'''
+content:    Codon lookup tables to classify mutations as syn/nonsyn on whole
+            sequences at once.
+'''
+# Modules
+import numpy as np
+from Bio.Seq import translate
+
+
+# Globals
+nucs = 'ACGT'
+codons = np.array([a+b+c for a in nucs for b in nucs for c in nucs])
+codon_aa = np.array([translate(cod) for cod in codons])
+
+
+
+# Functions
+def nucleotide_indices(seq):
+    '''Index of each nucleotide in ACGT, -1 for anything else (gaps, N, ...)'''
+    seq = np.asarray(seq)
+    ind = -np.ones(seq.shape, int)
+    for inuc, nuc in enumerate(nucs):
+        ind[seq == nuc] = inuc
+    return ind
+
+
+def codon_indices(cods):
+    '''Index of codons in the 64-codon table, -1 if not ACGT
+
+    Parameters:
+       cods (array): (..., 3) array of single nucleotides
+    '''
+    return codon_indices_from_nucleotide_indices(nucleotide_indices(cods))
+
+
+def codon_indices_from_nucleotide_indices(ind):
+    '''Same as codon_indices, from (..., 3) nucleotide indices'''
+    cind = 16 * ind[..., 0] + 4 * ind[..., 1] + ind[..., 2]
+    cind[(ind < 0).any(axis=-1)] = -1
+    return cind
+
+
+def get_codons_at_sites(seq, codon_pos):
+    '''Codon each site is in, given its position within the codon
+
+    Parameters:
+       seq (array): nucleotide sequence as an array of single letters
+       codon_pos (array): position of each site in its codon (0-2)
+
+    Returns:
+       (L, 3) array of single nucleotides
+    '''
+    seq = np.asarray(seq)
+    codon_pos = np.asarray(codon_pos)
+    starts = np.arange(len(codon_pos)) - codon_pos
+    ind = np.clip(starts[:, None] + np.arange(3), 0, len(seq) - 1)
+    return seq[ind]
+
+
+def get_synonymous_table(cods, codon_pos):
+    '''Whether each of the four nucleotides at each site is synonymous
+
+    Parameters:
+       cods (array): (L, 3) ancestral codons, see get_codons_at_sites
+       codon_pos (array): position of each site in its codon (0-2)
+
+    Returns:
+       (4, L) bool array, ACGT along the first axis. Codons with gaps are
+       never synonymous.
+    '''
+    cods = np.asarray(cods)
+    codon_pos = np.asarray(codon_pos)
+    L = len(codon_pos)
+    ind = nucleotide_indices(cods)
+    amb = (ind < 0).any(axis=1)
+
+    aa_anc = codon_aa[codon_indices_from_nucleotide_indices(ind)]
+    syn = np.zeros((4, L), bool)
+    for inuc in xrange(4):
+        ind_new = ind.copy()
+        ind_new[np.arange(L), codon_pos] = inuc
+        syn[inuc] = codon_aa[codon_indices_from_nucleotide_indices(ind_new)] == aa_anc
+
+    # Ambiguous nucleotides are rare: fall back onto Biopython for those
+    for pos in np.nonzero(amb)[0]:
+        cod = ''.join(cods[pos])
+        pc = codon_pos[pos]
+        syn[:, pos] = False
+        if '-' in cod:
+            continue
+        for inuc, nuc in enumerate(nucs):
+            syn[inuc, pos] = translate(cod) == translate(cod[:pc] + nuc + cod[pc+1:])
+
+    return syn
@@ -21,7 +21,12 @@ from seqanpy import align_overlap
 
 from hivevo.patients import Patient
 from hivevo.HIVreference import HIVreference
-from fitness_pooled_aa import calc_amino_acid_mutation_rates, fitness_cost_mutation, offsets
+from fitness_pooled_aa import fitness_costs_mutations, offsets
+from fitness_pooled_aa import get_initial_codon_matrix
+from codons import codons as all_codons
+from aa_rate_table import load_aa_rate_tables
+from pooled_store import load_pooled_data
+from util import load_fitness_cost_table
 
 # Functions
 def get_plasmid_Rihn():
@@ -67,8 +72,9 @@ def load_costs_Rihn():
 def load_costs_ours(subtype='B'):
     '''Load the fitness costs from us'''
     fn = '../data/fitness_pooled_aa/aa_pol_fitness_costs_st_'+subtype+'.tsv'
-    df = (pd.read_csv(fn, sep='\t', header=1)
-          .rename(columns={'# position': 'pos'}))
+    # censored costs: 0 below the lowest, 1 above the highest exported value
+    df = (load_fitness_cost_table(fn, censored=(0, 1))
+          .rename(columns={'position': 'pos'}))
     ref = ''.join(df['NL4-3'])
 
     # Cut out only the integrase
@@ -81,15 +87,17 @@ def load_costs_ours(subtype='B'):
     return ref, df
 
 
-def load_other_experiments(data, aa_mutation_rates):
+def load_other_experiments(data, aa_rate_tables):
     fc = pd.read_csv('../data/fitness_costs_experiments.csv')
-    coefficients = {}
+    queries = []
     for ii, mut in fc.iterrows():
-        region = mut['region']
         offset = offsets[mut['feature']]
-        aa, pos = mut['mutation'][-1], int(mut['mutation'][1:-1])+offset
-        coefficients[(mut['feature'], mut['mutation'])] = (mut['normalized'],
-            fitness_cost_mutation(region, data, aa_mutation_rates, pos, aa, nbootstraps=100))
+        queries.append((mut['region'], int(mut['mutation'][1:-1])+offset, mut['mutation'][-1]))
+    costs = fitness_costs_mutations(queries, data, aa_rate_tables['single'], nbootstraps=100)
+
+    coefficients = {}
+    for (ii, mut), cost in zip(fc.iterrows(), costs):
+        coefficients[(mut['feature'], mut['mutation'])] = (mut['normalized'], list(cost))
 
     return coefficients
 
@@ -101,29 +109,21 @@ def find_Rihn_multiple_alleles(costs):
     return costs.loc[costs['pos'].isin(d.keys())]
 
 
-def get_our_costs_at_Rihn(costs_Rihn, costs_ours, data, aa_mutation_rates):
+def get_our_costs_at_Rihn(costs_Rihn, costs_ours, data, aa_rate_tables):
     '''Get our costs at their positions'''
     c = costs_ours.set_index('pos').loc[costs_Rihn['pos']]['median']
     costs_Rihn_by_pos = costs_Rihn.set_index('pos')
-    c_float = []
-    c_IQD_target_specfic = []
-    for (p, mut), ci in zip(costs_Rihn_by_pos.iterrows(), c):
-        if ci == '<0.001':
-            ci = 0
-        elif ci == '>0.1':
-            ci = 1
-        else:
-            ci = float(ci)
-        c_float.append(ci)
+    initial_codons = get_initial_codon_matrix(data, 'pol', ['p2'])[0]
+    queries = []
+    for p, mut in costs_Rihn_by_pos.iterrows():
         cons, ipos, target_aa = mut['mut'][0], int(mut['mut'][1:-1]), mut['mut'][-1]
         ipos +=714
-        print(cons, mut['NL4-3'], translate(data['init_codon']['pol']['p2'][ipos]))
-        c_IQD_target_specfic.append(fitness_cost_mutation('pol', data,
-                                    aa_mutation_rates, ipos,
-                                    target_aa, nbootstraps=100))
+        icod = initial_codons[ipos]
+        print(cons, mut['NL4-3'], translate(all_codons[icod]) if icod >= 0 else '-')
+        queries.append(('pol', ipos, target_aa))
 
-    c[:] = c_float
-    c_IQD_target_specfic = np.array(c_IQD_target_specfic)
+    c_IQD_target_specfic = fitness_costs_mutations(queries, data, aa_rate_tables['single'],
+                                                   nbootstraps=100)
 
     comp = (pd.concat([c, costs_Rihn.set_index('pos')['cost']], axis=1)
             .rename(columns={'median': 'ours', 'cost': 'Rihn'}))
@@ -169,22 +169,21 @@ if __name__ == '__main__':
     subtype='any'
 
     # load files necessary to calculate target amino acid specific mutation rates
-    fn = '../data/fitness_pooled_aa/avg_aa_allele_frequency_st_'+subtype+'.pickle.gz'
-    with gzip.open(fn) as ifile:
-        data = cPickle.load(ifile)
-    aa_mutation_rates, total_nonsyn_mutation_rates = calc_amino_acid_mutation_rates()
+    fn = '../data/fitness_pooled_aa/avg_aa_allele_frequency_st_'+subtype
+    data = load_pooled_data(fn, regions=['pol'])
+    aa_rate_tables = load_aa_rate_tables()
 
     seq = get_integrase_Rihn()
     costs_Rihn = load_costs_Rihn()
     ref, costs_ours = load_costs_ours(subtype=subtype)
 
-    comp, target_specfic = get_our_costs_at_Rihn(costs_Rihn, costs_ours, data, aa_mutation_rates)
+    comp, target_specfic = get_our_costs_at_Rihn(costs_Rihn, costs_ours, data, aa_rate_tables)
 
     fig = plot_comparison(comp)
     for ext in ['svg', 'pdf', 'png']:
         fig.savefig('../figures/comparison_integrase_Rihn2015.'+ext)
 
-    other_ex = load_other_experiments(data, aa_mutation_rates)
+    other_ex = load_other_experiments(data, aa_rate_tables)
 
     ts=target_specfic
     ts[ts>1]=1.0
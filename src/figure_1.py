@@ -21,7 +21,15 @@ from hivevo.patients import Patient
 from hivevo.HIVreference import HIVreference
 from hivevo.sequence import alpha, alphal
 
-from util import add_binned_column, boot_strap_patients
+from util import add_binned_column, patient_bootstrap_counts
+from site_table import load_site_table
+
+
+
+# Globals
+mutation_classes = [a+'->'+b for a in alpha[:4] for b in alpha[:4] if a != b]
+t_bins = np.array([0, 500, 1000, 1750, 3000], int)
+t_binc = 0.5 * (t_bins[:-1] + t_bins[1:])
 
 
 
@@ -81,41 +89,102 @@ def get_mu_Abram2010(normalize=True, strand='both', with_std=False):
                 'std': std}
 
 
-def get_mutation_matrix(data):
+def fit_rates(sums, counts, times):
     '''
-    Calculate the mutation rate matrix from accumulation of
-    intra patient diversity via linear regression. Uncertainty
-    of the estimates is assessed via boot strapping over patients.
+    Slope through the origin of the mean allele frequency in time bins.
+    sums and counts have shape (..., mutations, time bins); time bins without
+    data for any mutation are left out, as in a groupby over the data
     '''
-    def get_mu(data):
-        d = (data
-             .loc[:, ['af', 'time_binc', 'mut']]
-             .groupby(['mut', 'time_binc'])
-             .mean()
-             .unstack('time_binc')
-             .loc[:, 'af'])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        aft = sums / counts
+    present = counts.sum(axis=-2, keepdims=True) > 0
+    aft = np.where(present, aft, 0)
+    tt = np.where(present, times, 0)
+    return (aft * tt).sum(axis=-1) / (tt**2).sum(axis=-1)
+
+
+def get_sufficient_statistics(data, masks=None):
+    '''
+    Sums and counts of the allele frequencies per patient, mutation class, and
+    time bin, all from one bincount. These determine the rates of any subset of
+    the patients, see fit_rates and get_bootstrap_rates.
+
+    Parameters:
+       data (pd.DataFrame): data with columns af, mut, pcode, and time_bin
+       masks (bool array): rows of each subset, (n_subsets, len(data)),
+          adds a leading subset axis to the results
+
+    Returns:
+       sums, counts: arrays of shape ([subsets,] patients, mutations, time bins)
+    '''
+    single = masks is None
+    masks = np.ones((1, len(data)), bool) if single else np.atleast_2d(masks)
+    pats, pat = np.unique(np.asarray(data['pcode']), return_inverse=True)
+    mut = pd.Categorical(data['mut'], categories=mutation_classes).codes
+    tbin = np.asarray(data['time_bin'], int)
+    af = np.asarray(data['af'], float)
+    C, P, M, T = len(masks), len(pats), len(mutation_classes), len(t_binc)
+
+    ci, ri = np.nonzero(masks)
+    key = ((ci * P + pat[ri]) * M + mut[ri]) * T + tbin[ri]
+    sums = np.bincount(key, weights=af[ri], minlength=C*P*M*T).reshape(C, P, M, T)
+    counts = np.bincount(key, minlength=C*P*M*T).reshape(C, P, M, T)
+    if single:
+        return sums[0], counts[0]
+    return sums, counts
+
+
+def get_bootstrap_rates(sums, counts, n_bootstrap=100, weights=None):
+    '''
+    Rates of bootstrap replicates over patients from the sufficient statistics,
+    see get_sufficient_statistics. Each replicate is a weighted sum over the
+    patient axis, as if the rows of resampled patients were repeated.
+
+    Returns:
+       array of shape (n_bootstrap, [subsets,] mutations)
+    '''
+    if weights is None:
+        weights = patient_bootstrap_counts(sums.shape[-3], n_bootstrap)
+    axis = sums.ndim - 3
+    return fit_rates(np.tensordot(weights, sums, axes=(1, axis)),
+                     np.tensordot(weights, counts, axes=(1, axis)), t_binc)
+
 
-        rates = {}
-        for mut, aft in d.iterrows():
-            times = np.array(aft.index)
-            aft = np.array(aft)
-            rate = np.inner(aft, times) / np.inner(times, times)
-            rates[mut] = rate
+def get_mutation_matrices(data, masks, n_bootstrap=100):
+    '''
+    Calculate the mutation rate matrix for several subsets of the data at once,
+    see get_mutation_matrix. All subsets and bootstrap replicates over patients
+    are fitted together from the same sufficient statistics.
 
-        mu = pd.Series(rates)
-        mu.name = 'mutation rate from longitudinal data'
+    Parameters:
+       data (pd.DataFrame): data with columns af, mut, pcode, and time_bin
+       masks (bool array): rows of each subset, (n_subsets, len(data))
+       n_bootstrap (int): number of bootstrap replicates over patients
 
-        return mu
+    Returns:
+       list of (mu, dmulog10) for each subset
+    '''
+    sums, counts = get_sufficient_statistics(data, masks)
+    mu = fit_rates(sums.sum(axis=1), counts.sum(axis=1), t_binc)
+    muBS = get_bootstrap_rates(sums, counts, n_bootstrap=n_bootstrap)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dmulog10 = np.log10(muBS).std(axis=0)
 
-    mu = get_mu(data)
+    rates = []
+    for ic in xrange(len(mu)):
+        mu_c = pd.Series(mu[ic], index=mutation_classes)
+        mu_c.name = 'mutation rate from longitudinal data'
+        rates.append((mu_c, pd.Series(dmulog10[ic], index=mutation_classes)))
+    return rates
 
-    # Bootstrap
-    dmulog10 = mu.copy()
-    muBS = boot_strap_patients(data, get_mu, n_bootstrap=100)
-    for key, _ in dmulog10.iteritems():
-        dmulog10[key] = np.std([np.log10(tmp[key]) for tmp in muBS])
 
-    return mu, dmulog10
+def get_mutation_matrix(data):
+    '''
+    Calculate the mutation rate matrix from accumulation of
+    intra patient diversity via linear regression. Uncertainty
+    of the estimates is assessed via boot strapping over patients.
+    '''
+    return get_mutation_matrices(data, np.ones(len(data), bool))[0]
 
 
 def plot_mutation_increase(data, mu=None, axs=None):
@@ -374,88 +443,40 @@ def export_mutation_rate_matrix(mu, dmulog10, muA=None, dmuAlog10=None, suffix='
 
 
 def collect_data(patients, cov_min=100, refname='HXB2', subtype='any',
-                 entropy_threshold=0.1, excluded_proteins=[]):
-    '''Collect data for the mutation rate estimate'''
+                 regenerate=False):
+    '''
+    Collect data for the mutation rate estimate, with the site entropy and
+    protein as columns for selecting the sites of each estimate, see select_data
+    '''
     print('Collect data from patients')
 
-    ref = HIVreference(refname=refname, load_alignment=True, subtype=subtype)
-
-    data = []
-    for pi, pcode in enumerate(patients):
-        print(pcode)
-
-        p = Patient.load(pcode)
-        comap = (pd.DataFrame(p.map_to_external_reference('genomewide')[:, :2],
-                              columns=[refname, 'patient'])
-                   .set_index('patient', drop=True)
-                   .loc[:, refname])
-
-        aft = p.get_allele_frequency_trajectories('genomewide', cov_min=cov_min)
-        times = p.dsi
-
-        for pos, aft_pos in enumerate(aft.swapaxes(0, 2)):
-            fead = p.pos_to_feature[pos]
-
-            # Keep only sites within ONE protein
-            if len(fead['protein_codon']) != 1:
-                continue
-            # skip if protein is to be excluded
-            if fead['protein_codon'][0][0] in excluded_proteins:
-                continue
-
-            # Exclude codons with gaps
-            pc = fead['protein_codon'][0][-1]
-            cod_anc = ''.join(p.initial_sequence[pos - pc: pos - pc + 3])
-            if '-' in cod_anc:
-                continue
-
-            for ia, aft_nuc in enumerate(aft_pos[:4]):
-                # Keep only derived alleles
-                if alpha[ia] == p.initial_sequence[pos]:
-                    continue
-
-                # Keep only no RNA structures
-                if fead['RNA']:
-                    continue
-
-                # Keep only sites which are also in the reference
-                if pos not in comap.index:
-                    continue
-
-                # Keep only high-entropy sites
-                S_pos = ref.entropy[comap.loc[pos]]
-                if S_pos < entropy_threshold:
-                    continue
-
-                # Keep only synonymous alleles
-                cod_new = cod_anc[:pc] + alpha[ia] + cod_anc[pc+1:]
-                if translate(cod_anc) != translate(cod_new):
-                    continue
-
-                mut = p.initial_sequence[pos]+'->'+alpha[ia]
-
-                for it, (t, af_nuc) in enumerate(izip(times, aft_nuc)):
-                    # Keep only nonmasked times
-                    if aft_nuc.mask[it]:
-                        continue
-
-                    datum = {'time': t,
-                             'af': af_nuc,
-                             'pos': pos,
-                             'refpos': comap.loc[pos],
-                             'protein': fead['protein_codon'][0][0],
-                             'pcode': pcode,
-                             'mut': mut,
-                             'subtype': subtype,
-                             'refname': refname,
-                            }
-                    data.append(datum)
-
-    data = pd.DataFrame(data)
+    data = load_site_table(patients, cov_min=cov_min, refname=refname,
+                           subtype=subtype, regenerate=regenerate)
+
+    # The site table has only unmasked alleles at sites within ONE protein
+    # and with ungapped codons. Keep only derived, synonymous alleles outside
+    # of RNA structures which are also in the reference
+    ind = (data['derived'] &
+           (~data['RNA']) &
+           (data['pos_ref'] >= 0) &
+           data['syn'])
+
+    data = data.loc[ind, ['time', 'af', 'pos', 'pos_ref', 'protein', 'pcode',
+                          'mut', 'S']]
+    data.reset_index(drop=True, inplace=True)
+    data.rename(columns={'pos_ref': 'refpos'}, inplace=True)
+    data['subtype'] = subtype
+    data['refname'] = refname
 
     return data
 
 
+def select_data(data, entropy_threshold=0.1, excluded_proteins=[]):
+    '''Mask of the rows at high-entropy sites outside of the excluded proteins'''
+    return np.asarray((data['S'] >= entropy_threshold) &
+                      (~data['protein'].isin(excluded_proteins)))
+
+
 
 # Script
 if __name__ == '__main__':
@@ -470,44 +491,48 @@ if __name__ == '__main__':
 
     # make many mutation rate estimates excluding gp120 or not and with different
     # threshold for cross-sectional diversity
-    for excluded_proteins in [[], ['gp120']]:
-        for thres in [0.01, 0.03, 0.1, 0.3, 0.5]:
-            suffix = '_'+'_'.join([str(thres)]+excluded_proteins)
-
-            # Intermediate data are saved to file for faster access later on
-            fn = data_out_path + 'mutation_rate_data'+suffix+'.pickle'
-            if not os.path.isfile(fn) or args.regenerate:
-                data = collect_data(patients, entropy_threshold=thres, excluded_proteins=excluded_proteins)
-                try:
-                    data.to_pickle(fn)
-                    print('Data saved to file:', os.path.abspath(fn))
-                except IOError:
-                    print('Could not save data to file:', os.path.abspath(fn))
-            else:
-                data = pd.read_pickle(fn)
+    configs = [(thres, excluded_proteins)
+               for excluded_proteins in [[], ['gp120']]
+               for thres in [0.01, 0.03, 0.1, 0.3, 0.5]]
+
+    # Intermediate data are saved to file for faster access later on, the
+    # sites of all estimates are selected from the same data
+    fn = data_out_path + 'mutation_rate_data.pickle'
+    if not os.path.isfile(fn) or args.regenerate:
+        data = collect_data(patients, regenerate=args.regenerate)
+        try:
+            data.to_pickle(fn)
+            print('Data saved to file:', os.path.abspath(fn))
+        except IOError:
+            print('Could not save data to file:', os.path.abspath(fn))
+    else:
+        data = pd.read_pickle(fn)
+
+    # Make time bins
+    add_binned_column(data, t_bins, 'time')
+    data['time_binc'] = t_binc[data['time_bin']]
 
-            # Make time bins
-            t_bins = np.array([0, 500, 1000, 1750, 3000], int)
-            t_binc = 0.5 * (t_bins[:-1] + t_bins[1:])
-            add_binned_column(data, t_bins, 'time')
-            data['time_binc'] = t_binc[data['time_bin']]
+    # Get mutation rates with bootstrap error bars for all estimates at once
+    masks = np.array([select_data(data, entropy_threshold=thres, excluded_proteins=excluded_proteins)
+                      for thres, excluded_proteins in configs])
+    rates = get_mutation_matrices(data, masks)
 
-            # save positions used for mutation rate estimation.
-            all_pos = np.array(np.unique(data['refpos']), dtype=int)
-            print(thres, excluded_proteins, '# positions', len(all_pos))
-            np.savetxt(data_out_path+ 'mutation_rate_positions'+suffix+'.txt', all_pos, fmt='%d')
+    # Compare to Abram et al 2010
+    tmp = get_mu_Abram2010(with_std=True)
+    muA = tmp['mu']
+    dmuAlog10 = tmp['std'] / tmp['mu'] / np.log(10)
 
-            # Get mutation rate with bootstrap error bars
-            mu,dmulog10 = get_mutation_matrix(data)
+    for (thres, excluded_proteins), ind, (mu, dmulog10) in izip(configs, masks, rates):
+        suffix = '_'+'_'.join([str(thres)]+excluded_proteins)
 
-            # Compare to Abram et al 2010
-            tmp = get_mu_Abram2010(with_std=True)
-            muA = tmp['mu']
-            dmuAlog10 = tmp['std'] / tmp['mu'] / np.log(10)
+        # save positions used for mutation rate estimation.
+        all_pos = np.array(np.unique(data.loc[ind, 'refpos']), dtype=int)
+        print(thres, excluded_proteins, '# positions', len(all_pos))
+        np.savetxt(data_out_path+ 'mutation_rate_positions'+suffix+'.txt', all_pos, fmt='%d')
 
-            # Save results to file (used in Figure 2)
-            export_mutation_rate_matrix(mu, dmulog10, muA, dmuAlog10, suffix=suffix)
+        # Save results to file (used in Figure 2)
+        export_mutation_rate_matrix(mu, dmulog10, muA, dmuAlog10, suffix=suffix)
 
-            # Plot Figure 1
-            if 'gp120' in excluded_proteins and thres==0.3:
-                plot_figure_1(data=data, mu=mu, dmulog10=dmulog10, muA=muA, dmuAlog10=dmuAlog10, suffix=suffix)
+        # Plot Figure 1
+        if 'gp120' in excluded_proteins and thres==0.3:
+            plot_figure_1(data=data.loc[ind], mu=mu, dmulog10=dmulog10, muA=muA, dmuAlog10=dmuAlog10, suffix=suffix)
@@ -20,7 +20,9 @@ from hivevo.patients import Patient
 from hivevo.HIVreference import HIVreference
 from hivevo.sequence import alpha, alphal
 
-from util import add_binned_column, boot_strap_patients
+from util import add_binned_column, patient_bootstrap_counts
+from site_table import load_site_table, load_sweep_events, get_swept_sites
+from saturation_fit import aggregate_by_patient, average_over_patients, fit_slope, fit_saturation
 
 
 
@@ -170,47 +172,54 @@ def prepare_data_for_fit(data, plot=False):
     del d['counter']
     return d
 
-def fit_fitness_cost_simplest(data, plot=True, bootstrap=True):
-    '''Fit one slope and 6 saturations to ALL data at once'''
-    def average_data(data):
-        data = data.copy()
-        data['counter'] = 1.0
-        d = (data
-             .loc[:, ['S_binc', 'time_binc', 'af', 'counter']]
-             .groupby(['S_binc', 'time_binc'], as_index=True)
-             .sum())
-        d['af'] /= d['counter']
-        data_to_fit = d['af'].unstack()
-        data_to_fit.name = 'af'
-        return data_to_fit
+def prepare_cube_for_fit(data):
+    '''Lay the data out as dense (mutation, entropy bin, time bin) arrays
+
+    The frequencies and their squared errors (see prepare_data_for_fit) are
+    summed per patient, so the averages of all patients and of bootstrap
+    replicates follow from the same arrays, see average_cube.
+    '''
+    af_std2 = np.maximum(data['af'] * (1 - data['af']) / data['n_templates'], 1e-6)
+    columns = ['mut', 'S_binc', 'time_binc']
+    levels, sums, counts = aggregate_by_patient(data, columns)
+    sums_std2 = aggregate_by_patient(data.assign(af_std2=af_std2), columns, value='af_std2')[1]
+    return {'mut': levels[0], 'S_binc': levels[1], 'time_binc': levels[2],
+            'af': sums, 'af_std2': sums_std2, 'counter': counts}
 
-    def fit_data(data_to_fit, mu=None):
-        from scipy.optimize import curve_fit
 
+def average_cube(cube, weights=None):
+    '''Average frequencies and their errors on the mean from the cube
+
+    Parameters:
+       cube (dict): see prepare_cube_for_fit
+       weights (array): patient counts of bootstrap replicates, (n_bootstrap,
+          patients), which adds a leading replicate axis
+
+    Returns:
+       af, af_std: arrays (..., mutations, entropy bins, time bins), NaN where
+       there are no data
+    '''
+    af = average_over_patients(cube['af'], cube['counter'], weights)
+    std2 = average_over_patients(cube['af_std2'], cube['counter'], weights)
+    if weights is None:
+        counter = cube['counter'].sum(axis=0)
+    else:
+        counter = np.tensordot(weights, cube['counter'], axes=(1, 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        af_std = np.sqrt(std2 / (counter - 1))
+    return af, af_std
+
+
+def fit_fitness_cost_simplest(data, plot=True, bootstrap=True):
+    '''Fit one slope and 6 saturations to ALL data at once'''
+    def fit_data(af, mu=None):
         # First fit slope from high-entropy class
         if mu is None:
-            datum = data_to_fit.iloc[-1]
-            nInd = 3
-            x = np.array(datum.index)[:3]
-            y = np.array(datum)[:3]
-            mu = np.dot(x, y) / np.dot(x, x)
+            mu = fit_slope(time_binc[:3], af[..., -1, :3])
 
         # Then, fit the saturations
-        s = []
-        fun = lambda x, s: mu / s * (1.0 - np.exp(-s * x))
-        for iS, (S, datum) in enumerate(data_to_fit.iterrows()):
-            x = np.array(datum.index)
-            y = np.array(datum)
-            s0 = 1e-2 / 10**(iS / 2.0)
-            fit = curve_fit(fun, x, y, p0=[s0])
-            sTmp = fit[0][0]
-            dsTmp = fit[1][0][0]
-            s.append({'S': S,
-                      's': sTmp,
-                      'ds': dsTmp,
-                     })
-        s = pd.DataFrame(s).set_index('S', drop=True, inplace=False)
-        return mu, s
+        s0 = 1e-2 / 10**(np.arange(len(S_binc)) / 2.0)
+        return mu, fit_saturation(time_binc, af, mu, s0)
 
     def plot_fit(data_to_fit, mu, s):
         from matplotlib import cm
@@ -302,22 +311,20 @@ def fit_fitness_cost_simplest(data, plot=True, bootstrap=True):
         plt.show()
 
 
-    data_to_fit = average_data(data)
-    mu, s = fit_data(data_to_fit)
-
-    def bootstrap():
-        def prepare_and_fit(data):
-            data_to_fit = average_data(data)
-            return fit_data(data_to_fit, mu=mu)[1]['s']
-
-        ds = s['s'].copy()
-        sBS = boot_strap_patients(data, prepare_and_fit, n_bootstrap=100)
-        for key, _ in ds.iteritems():
-            ds[key] = np.std([tmp[key] for tmp in sBS])
-        s['ds'] = ds
+    (S_binc, time_binc), sums, counts = aggregate_by_patient(data, ['S_binc', 'time_binc'])
+    af = average_over_patients(sums, counts)
+    data_to_fit = pd.DataFrame(af,
+                               index=pd.Index(S_binc, name='S_binc'),
+                               columns=pd.Index(time_binc, name='time_binc'))
+    data_to_fit.name = 'af'
+    mu, (sFit, dsFit) = fit_data(af)
+    s = pd.DataFrame({'s': sFit, 'ds': dsFit}, index=pd.Index(S_binc, name='S'))
 
+    # Bootstrap over patients, reusing the per-patient sums
     if bootstrap:
-        bootstrap()
+        weights = patient_bootstrap_counts(sums.shape[0], 100)
+        sBS = fit_data(average_over_patients(sums, counts, weights), mu=mu)[1][0]
+        s['ds'] = sBS.std(axis=0)
 
     if plot:
         plot_fit(data_to_fit, mu, s)
@@ -325,9 +332,10 @@ def fit_fitness_cost_simplest(data, plot=True, bootstrap=True):
     return mu, s
 
 
-def fit_fitness_cost_interpmu(data_to_fit, mu,
+def fit_fitness_cost_interpmu(cube, mu,
                               muNS,
-                              nu_sweep_norm):
+                              nu_sweep_norm,
+                              weights=None):
     '''Fit the fitness costs with an interpolated initial slope
     
     The rationale for this is that the simple fit
@@ -344,48 +352,45 @@ def fit_fitness_cost_interpmu(data_to_fit, mu,
     'muNS' according to entropy class (low-S -> mu, high-S -> muNS). The exact
     nature of the interpolation is not known, but it does not make a huge difference
     because alpha is relatively close to 1.
-    '''
-    from scipy.optimize import curve_fit
-
-    data_to_fit = data_to_fit.copy()
-    data_to_fit['mut'] = data_to_fit.index.get_level_values('mut')
-    data_to_fit['time_binc'] = data_to_fit.index.get_level_values('time_binc')
-    d = data_to_fit.groupby(level='S_binc')
-
-    # x[0] is time, x[1] the mutation rate
-    s = []
-    for iS, (S, datum) in enumerate(d):
-        mut = datum['mut']
-        nu_sweep_tmp = nu_sweep_norm.iloc[:, iS][mut]
-
-        # Decrease initial slope by linear interpolation of the bias due to
-        # exclusion of sweeps, anchored at the high-entropy class
-        mu_tmp = interpolate_slope(mu[mut], muNS[mut], nu_sweep_tmp)
 
-        x = np.vstack([np.array(datum['time_binc']),
-                       np.array(mu_tmp),
-                       ])
-        y = np.array(datum['af'])
-        dy = np.array(datum['af_std'])
-
-        s0 = 1e-2 / 10**(iS / 2.0)
-        fun = lambda x, s: x[1] / s * (1 - np.exp(-s * x[0]))
-        fit = curve_fit(fun, x, y, p0=[s0], sigma=dy, absolute_sigma=False)
-        s.append({'S': S,
-                  's': fit[0][0],
-                  'ds': np.sqrt(fit[1][0, 0]),
-                 })
-
-    s = pd.DataFrame(s).set_index('S', inplace=False, drop=True)
-    s.index.name = 'entropy'
+    All mutations of an entropy class share one fitness cost, and all classes
+    are fitted at once from the cube (see prepare_cube_for_fit). With bootstrap
+    weights, all replicates are fitted at once and an array of costs
+    (n_bootstrap, entropy bins) is returned.
+    '''
+    af, af_std = average_cube(cube, weights)
+    muts = cube['mut']
+    nS = len(cube['S_binc'])
+
+    # Decrease initial slope by linear interpolation of the bias due to
+    # exclusion of sweeps, anchored at the high-entropy class
+    nu_sweep_tmp = np.array(nu_sweep_norm.iloc[:, :nS].loc[muts])
+    mu_tmp = interpolate_slope(np.array(mu[muts])[:, None], np.array(muNS[muts])[:, None],
+                               nu_sweep_tmp)
+
+    # one curve per entropy class with the points of all mutations and times
+    def per_class(x):
+        x = np.broadcast_to(x, af.shape)
+        x = np.moveaxis(x, -3, -2)
+        return x.reshape(x.shape[:-2] + (-1,))
+
+    s0 = 1e-2 / 10**(np.arange(nS) / 2.0)
+    sFit, var = fit_saturation(per_class(cube['time_binc']), per_class(af),
+                               per_class(mu_tmp[:, :, None]), s0, sigma=per_class(af_std))
+    if weights is not None:
+        return sFit
+
+    s = pd.DataFrame({'s': sFit, 'ds': np.sqrt(var)},
+                     index=pd.Index(cube['S_binc'], name='entropy'))
     s.name = 'fitness cost'
 
     return s
 
 
-def fit_fitness_cost_interpmu_permu(data_to_fit, mu,
+def fit_fitness_cost_interpmu_permu(cube, mu,
                               muNS,
-                              nu_sweep_norm):
+                              nu_sweep_norm,
+                              weights=None):
     '''Fit the fitness costs with an interpolated initial slope
     
     The rationale for this is that the simple fit
@@ -403,39 +408,31 @@ def fit_fitness_cost_interpmu_permu(data_to_fit, mu,
     nature of the interpolation is not known, but it does not make a huge difference
     because alpha is relatively close to 1.
 
-    In this version, we fit a fitness coefficient per entropy per mutation.
+    In this version, we fit a fitness coefficient per entropy per mutation,
+    all 12 x entropy bins curves of the cube (see prepare_cube_for_fit) at
+    once. With bootstrap weights, all replicates are fitted at once and an
+    array of costs (n_bootstrap, mutations, entropy bins) is returned.
     '''
-    from scipy.optimize import curve_fit
-
-    data_to_fit = data_to_fit.copy()
-    data_to_fit['time_binc'] = data_to_fit.index.get_level_values('time_binc')
-    d = data_to_fit.groupby(level=['mut', 'S_binc'])
-
+    af, af_std = average_cube(cube, weights)
+    muts = cube['mut']
     Sall = nu_sweep_norm.columns.tolist()
-
-    s = []
-    for (mut, S), datum in d:
-        iS = Sall.index(S)
-        nu_sweep_tmp = nu_sweep_norm.loc[mut, S]
-
-        # Decrease initial slope by linear interpolation of the bias due to
-        # exclusion of sweeps, anchored at the high-entropy class
-        mu_tmp = interpolate_slope(mu[mut], muNS[mut], nu_sweep_tmp)
-
-        x =np.array(datum['time_binc'])
-        y = np.array(datum['af'])
-        dy = np.array(datum['af_std'])
-
-        s0 = 1e-2 / 10**(iS / 2.0)
-        fun = lambda x, s: mu_tmp / s * (1 - np.exp(-s * x))
-        fit = curve_fit(fun, x, y, p0=[s0], sigma=dy, absolute_sigma=False)
-        s.append({'S': S,
-                  's': fit[0][0],
-                  'ds': np.sqrt(fit[1][0, 0]),
-                  'mut': mut,
-                 })
-
-    s = pd.DataFrame(s).set_index(['S', 'mut'], inplace=False, drop=True)
+    iS = np.array([Sall.index(S) for S in cube['S_binc']])
+
+    # Decrease initial slope by linear interpolation of the bias due to
+    # exclusion of sweeps, anchored at the high-entropy class
+    nu_sweep_tmp = np.array(nu_sweep_norm.loc[muts, cube['S_binc']])
+    mu_tmp = interpolate_slope(np.array(mu[muts])[:, None], np.array(muNS[muts])[:, None],
+                               nu_sweep_tmp)
+
+    s0 = np.broadcast_to(1e-2 / 10**(iS / 2.0), mu_tmp.shape)
+    sFit, var = fit_saturation(cube['time_binc'], af, mu_tmp[..., None], s0, sigma=af_std)
+    if weights is not None:
+        return sFit
+
+    index = pd.MultiIndex.from_product([muts, cube['S_binc']], names=['mut', 'S'])
+    s = (pd.DataFrame({'s': sFit.ravel(), 'ds': np.sqrt(var).ravel()}, index=index)
+         .swaplevel(0, 1)
+         .sort_index())
     s.index.name = 'entropy and mutation'
     s.name = 'fitness cost'
     s = s.to_panel().transpose(0, 2, 1)
@@ -453,6 +450,11 @@ def plot_fits_4x4(data, s, mu):
     fig, axs = plt.subplots(4, 4,
                             figsize=(4 * fig_width, 4 * fig_width))
 
+    # Average trajectories of all panels at once
+    cube = prepare_cube_for_fit(data)
+    af = average_cube(cube)[0]
+    muts = cube['mut'].tolist()
+
     for ia1, a1 in enumerate(alphal[:4]):
         for ia2, a2 in enumerate(alphal[:4]):
             mut = a1+'->'+a2
@@ -464,17 +466,13 @@ def plot_fits_4x4(data, s, mu):
                 continue
 
             # Trajectories
-            d = (data
-                 .groupby('mut')
-                 .get_group(mut)
-                 .loc[:, ['time_binc', 'S_binc', 'af']]
-                 .groupby(['S_binc', 'time_binc'], as_index=False)
-                 .mean()
-                 .groupby('S_binc'))
-            colors = [cm.jet(1.0 * iS / d.ngroups) for iS in xrange(d.ngroups)]
-            for iS, (S, datum) in enumerate(d):
-                x = np.array(datum['time_binc'])
-                y = np.array(datum['af'])
+            af_mut = af[muts.index(mut)]
+            nS = len(cube['S_binc'])
+            colors = [cm.jet(1.0 * iS / nS) for iS in xrange(nS)]
+            for iS, S in enumerate(cube['S_binc']):
+                ind = ~np.isnan(af_mut[iS])
+                x = cube['time_binc'][ind]
+                y = af_mut[iS][ind]
                 ax.scatter(x, y,
                            s=70,
                            color=colors[iS],
@@ -489,14 +487,14 @@ def plot_fits_4x4(data, s, mu):
             # Fits
             if isinstance(s, pd.Series):
                 fun = lambda t, s: mu[mut] / s * (1 - np.exp(-s * t))
-                for iS in xrange(d.ngroups):
+                for iS in xrange(nS):
                     xfit = np.linspace(0, x.max())
                     yfit = fun(xfit, s.iloc[iS])
                     ax.plot(xfit, yfit, lw=2, color=colors[iS], alpha=0.5)
 
             else:
                 fun = lambda t, s1, s2: mu[mut] / s1 * (1 - np.exp(-s2 * t))
-                for iS in xrange(d.ngroups):
+                for iS in xrange(nS):
                     xfit = np.linspace(0, x.max())
                     yfit = fun(xfit, s.iloc[iS]['s1'], s.iloc[iS]['s2'])
                     ax.plot(xfit, yfit, lw=2, color=colors[iS], alpha=0.5)
@@ -722,100 +720,31 @@ def plot_fitness_cost_allmuts(sMu):
     plt.show()
 
 
-def collect_data(patients, cov_min=100, no_sweeps=False, refname='HXB2'):
+def collect_data(patients, cov_min=100, no_sweeps=False, refname='HXB2',
+                 regenerate=False):
     '''Collect data for the fitness cost estimate'''
-    ref = HIVreference(refname=refname, subtype='any', load_alignment=True)
     mus = load_mutation_rates()
     mu = mus.mu
     muA = mus.muA
 
-    data = []
-    for pi, pcode in enumerate(patients):
-        print pcode
-
-        p = Patient.load(pcode)
-        comap = (pd.DataFrame(p.map_to_external_reference('genomewide', refname=refname)[:, :2],
-                              columns=[refname, 'patient'])
-                   .set_index('patient', drop=True)
-                   .loc[:, refname])
-
-        aft = p.get_allele_frequency_trajectories('genomewide', cov_min=cov_min)
-        for pos, aft_pos in enumerate(aft.swapaxes(0, 2)):
-            fead = p.pos_to_feature[pos]
-
-            # Keep only sites within ONE protein
-            # Note: we could drop this, but then we cannot quite classify syn/nonsyn
-            if len(fead['protein_codon']) != 1:
-                continue
-
-            # Exclude codons with gaps
-            pc = fead['protein_codon'][0][-1]
-            cod_anc = ''.join(p.initial_sequence[pos - pc: pos - pc + 3])
-            if '-' in cod_anc:
-                continue
+    data = load_site_table(patients, cov_min=cov_min, refname=refname,
+                           subtype='any', regenerate=regenerate)
 
-            # Keep only nonmasked times
-            if aft_pos[:4].mask.any(axis=0).all():
-                continue
-            else:
-                ind = ~aft_pos[:4].mask.any(axis=0)
-                times = p.dsi[ind]
-                aft_pos = aft_pos[:, ind]
-                n_templates = p.n_templates_dilutions[ind]
+    # Keep only nonmasked times at sites where the ancestral allele and
+    # group M agree, and derived alleles
+    ind = data['covered'] & data['anc_cross'] & data['derived']
 
-            # Get site entropy
-            if pos not in comap.index:
-                continue
-            pos_ref = comap.loc[pos]
-            S_pos = ref.entropy[pos_ref]
-
-            # Keep only sites where the ancestral allele and group M agree
-            if ref.consensus_indices[pos_ref] != aft_pos[:, 0].argmax():
-                continue
+    # Filter out sweeps if so specified
+    if no_sweeps:
+        events = load_sweep_events(patients, threshold=0.5, cov_min=cov_min,
+                                   refname=refname, subtype='any', table=data)
+        ind &= ~get_swept_sites(data, events=events)
 
-            # Filter out sweeps if so specified
-            if no_sweeps:
-                found = False
-                nuc_anc = p.initial_sequence[pos]
-                for ia, aft_nuc in enumerate(aft_pos[:4]):
-                    if (alpha[ia] != nuc_anc) and (aft_nuc > 0.5).any():
-                        found = True
-                if found:
-                    continue
-
-            for ia, aft_nuc in enumerate(aft_pos[:4]):
-                # Keep only derived alleles
-                if alpha[ia] == p.initial_sequence[pos]:
-                    continue
-
-                # Annotate with syn/nonsyn alleles
-                cod_new = cod_anc[:pc] + alpha[ia] + cod_anc[pc+1:]
-                if translate(cod_anc) != translate(cod_new):
-                    syn = False
-                else:
-                    syn = True
-
-                mut = p.initial_sequence[pos]+'->'+alpha[ia]
-                mu_pos = mu[mut]
-                muA_pos = muA[mut]
-
-                for it, (t, af_nuc, n_temp) in enumerate(izip(times, aft_nuc, n_templates)):
-                    datum = {'time': t,
-                             'af': af_nuc,
-                             'pos': pos,
-                             'pos_ref': pos_ref,
-                             'protein': fead['protein_codon'][0][0],
-                             'pcode': pcode,
-                             'mut': mut,
-                             'mu': mu_pos,
-                             'muAbram': muA_pos,
-                             'S': S_pos,
-                             'syn': syn,
-                             'n_templates': n_temp,
-                            }
-                    data.append(datum)
-
-    data = pd.DataFrame(data)
+    data = data.loc[ind, ['time', 'af', 'pos', 'pos_ref', 'protein', 'pcode',
+                          'mut', 'S', 'syn', 'n_templates']]
+    data.reset_index(drop=True, inplace=True)
+    data['mu'] = data['mut'].map(mu)
+    data['muAbram'] = data['mut'].map(muA)
 
     return data
 
@@ -837,7 +766,8 @@ if __name__ == '__main__':
     if not os.path.isfile(fn) or args.regenerate:
         patients = ['p1', 'p2', 'p3','p5', 'p6', 'p8', 'p9', 'p11']
         cov_min = 100
-        data = collect_data(patients, cov_min=cov_min, no_sweeps=args.no_sweeps)
+        data = collect_data(patients, cov_min=cov_min, no_sweeps=args.no_sweeps,
+                            regenerate=args.regenerate)
         data.to_pickle(fn)
     else:
         data = pd.read_pickle(fn)
@@ -884,12 +814,13 @@ if __name__ == '__main__':
 
     # Fitness estimate
     data_to_fit = prepare_data_for_fit(data, plot=True)
-    s = fit_fitness_cost_interpmu(data_to_fit,
+    cube = prepare_cube_for_fit(data)
+    s = fit_fitness_cost_interpmu(cube,
                                   mu=mu,
                                   muNS=muNS,
                                   nu_sweep_norm=nu_sweep_norm)
 
-    sMu = fit_fitness_cost_interpmu_permu(data_to_fit,
+    sMu = fit_fitness_cost_interpmu_permu(cube,
                                           mu=mu,
                                           muNS=muNS,
                                           nu_sweep_norm=nu_sweep_norm)
@@ -897,20 +828,15 @@ if __name__ == '__main__':
     sys.exit()
 
     if True:
-        def fit_fitness_cost_for_bootstrap(data):
-            data_to_fit = prepare_data_for_fit(data, plot=False)
-            s =  fit_fitness_cost_interpmu(data_to_fit,
-                                           mu=mu,
-                                           muNS=muNS,
-                                           nu_sweep_norm=nu_sweep_norm)
-            return s['s']
-
-        ds = s['s'].copy()
-        sBS = boot_strap_patients(data, fit_fitness_cost_for_bootstrap, n_bootstrap=100)
-        for key, _ in ds.iteritems():
-            ds[key] = np.std([tmp[key] for tmp in sBS])
+        # all bootstrap replicates from the same cube
+        weights = patient_bootstrap_counts(cube['af'].shape[0], 100)
+        sBS = fit_fitness_cost_interpmu(cube,
+                                        mu=mu,
+                                        muNS=muNS,
+                                        nu_sweep_norm=nu_sweep_norm,
+                                        weights=weights)
         s.rename(columns={'ds': 'ds_fit'}, inplace=True)
-        s['ds_bootstrap'] = ds
+        s['ds_bootstrap'] = sBS.std(axis=0)
         s.sort_index(axis=1, ascending=False, inplace=True)
 
     fn_s = 'data/fitness_cost_result.pickle'
@@ -9,6 +9,7 @@ from __future__ import division
 import os
 import sys
 import argparse
+from itertools import izip, imap
 import numpy as np
 from scipy import linalg as LA
 from scipy import optimize
@@ -23,6 +24,7 @@ h = 10**(-8)
 cols_Fabio = ['b','c','g','y','r','m']
 cols = ['b','g','r','c','m','y','k','b','g','r']
 outdir_name = '../data/fitness_KL/'
+KL_bootstrap_shared = {}
 
 def fit_upper_multipat(xk_q_all, tk_all, LL=None):
     '''Fitting the quantile data with a linear law
@@ -48,7 +50,143 @@ def fit_upper_multipat(xk_q_all, tk_all, LL=None):
     return res.x
 
 
-def KLfit_multipat_mu(Ckq_q_all, xk_q_all, tk_all, mu):
+def prepare_KL_data(Ckq_q_all, xk_q_all, tk_all):
+    '''Stack the by-patient data into arrays padded to the longest time series
+
+    Input parameters:
+    Ckq_q_all - list of by-quantile covariance matrices for all patients
+    xk_q_all - list of by-quantile mean frequencies for all patients
+    tk_all - list of the time points for all patients
+
+    Returns:
+    dictionary of arrays of shape (n_patients, q, T_max) or (n_patients, 1, T_max):
+    time points and intervals, mean frequencies, diagonal and first off-diagonal
+    of the covariances, mask of the valid time points
+    '''
+    npat = len(tk_all)
+    q = xk_q_all[0].shape[0]
+    T = np.array([tk.shape[0] for tk in tk_all], int)
+    Tmax = T.max()
+
+    KLdata = {'T': T,
+              'tk': np.ones((npat, 1, Tmax)),
+              'dtk': np.ones((npat, 1, Tmax)),
+              'dtk_next': np.ones((npat, 1, Tmax)),
+              'valid': np.zeros((npat, 1, Tmax), bool),
+              'valid_next': np.zeros((npat, 1, Tmax), bool),
+              'xk': np.zeros((npat, q, Tmax)),
+              'Ck_diag': np.zeros((npat, q, Tmax)),
+              'Ck_off': np.zeros((npat, q, Tmax)),
+             }
+    for jpat, (Ckq_q, xk_q, tk) in enumerate(izip(Ckq_q_all, xk_q_all, tk_all)):
+        nt = tk.shape[0]
+        dtk = np.zeros(nt); dtk[0] = tk[0]; dtk[1:] = np.diff(tk)
+        KLdata['tk'][jpat, 0, :nt] = tk
+        KLdata['dtk'][jpat, 0, :nt] = dtk
+        KLdata['dtk_next'][jpat, 0, :nt-1] = dtk[1:]
+        KLdata['valid'][jpat, 0, :nt] = True
+        KLdata['valid_next'][jpat, 0, :nt-1] = True
+        KLdata['xk'][jpat, :, :nt] = xk_q
+        KLdata['Ck_diag'][jpat, :, :nt] = np.diagonal(Ckq_q, axis1=1, axis2=2)
+        # tr(C A) picks up both C[k,k+1] and C[k+1,k] for the off-diagonal of A
+        KLdata['Ck_off'][jpat, :, :nt-1] = (np.diagonal(Ckq_q, 1, axis1=1, axis2=2) +
+                                            np.diagonal(Ckq_q, -1, axis1=1, axis2=2))
+    KLdata['dtk_min'] = np.array([dtk[0, :nt].min() for dtk, nt in
+                                  izip(KLdata['dtk'], T)])[:, None, None]
+    return KLdata
+
+
+def KL_multipat_tridiag(sD, KLdata, mu, gradient=False):
+    '''KL divergence summed over patients and quantiles, with its gradient
+
+    The precision matrices A_kq are tridiagonal, hence their log determinant,
+    the quadratic form and the trace with the covariance are computed in O(T)
+    for all patients and quantiles at once.
+
+    Input parameters:
+    sD - square roots of the fitness parameters for each quantile and of the
+         noise parameter (last)
+    KLdata - padded data, see prepare_KL_data
+    mu - mutation rate
+    gradient - return also the gradient with respect to sD
+
+    Returns:
+    KL divergence (and gradient)
+    '''
+    q = KLdata['xk'].shape[1]
+    Tmax = KLdata['xk'].shape[2]
+    s = (sD[:q]**2)[None, :, None]
+    D0 = sD[-1]**2
+    tk = KLdata['tk']
+    dtk = KLdata['dtk']
+    dtn = KLdata['dtk_next']
+    valid = KLdata['valid']
+    valid_next = KLdata['valid_next']
+    # exponential expressions unless s is (almost) zero, linearized otherwise
+    exact = s > h/KLdata['dtk_min']
+
+    with np.errstate(all='ignore'):
+        u = np.exp(-2*s*dtk)
+        un = np.exp(-2*s*dtn)
+        vn = np.exp(-s*dtn)
+        w = np.exp(-s*tk)
+        a0 = (np.where(exact, 2*s/(1-u), 1/dtk) +
+              np.where(valid_next, np.where(exact, 2*s*un/(1-un), (1.- s*dtn)**2/dtn), 0))
+        a0 = np.where(valid, a0, 1)
+        a1 = np.where(valid_next, np.where(exact, -2*s*vn/(1-un), -(1.- s*dtn)/dtn), 0)
+        b_k = np.where(exact, mu*(1-w)/s, mu*tk)
+    r = np.where(valid, KLdata['xk'] - b_k, 0)
+    r_next = np.zeros_like(r); r_next[:, :, :-1] = r[:, :, 1:]
+
+    # log determinant via the LDL recursion of tridiagonal matrices
+    f = np.zeros_like(a0)
+    f[:, :, 0] = a0[:, :, 0]
+    for k in xrange(1, Tmax):
+        f[:, :, k] = a0[:, :, k] - a1[:, :, k-1]**2/f[:, :, k-1]
+    logdet = np.log(f).sum(axis=2)
+
+    quad = (a0*r**2).sum(axis=2) + 2*(a1*r*r_next).sum(axis=2)
+    trCA = (KLdata['Ck_diag']*a0).sum(axis=2) + (KLdata['Ck_off']*a1).sum(axis=2)
+    T = KLdata['T'][:, None]
+    Like = -.5*(logdet - T*np.log(D0)) + .5*(quad + trCA)/D0
+    if np.isnan(Like).any():
+        print sD**2, Like
+
+    if not gradient:
+        return Like.sum()
+
+    # derivatives of the matrix elements and of b_k with respect to s
+    with np.errstate(all='ignore'):
+        da0 = (np.where(exact, 2/(1-u) - 4*s*dtk*u/(1-u)**2, 0) +
+               np.where(valid_next, np.where(exact, 2*un/(1-un) - 4*s*dtn*un/(1-un)**2,
+                                             -2*(1.- s*dtn)), 0))
+        da0 = np.where(valid, da0, 0)
+        da1 = np.where(valid_next, np.where(exact, -2*vn/(1-un) + 2*s*dtn*vn/(1-un) +
+                                            4*s*dtn*vn*un/(1-un)**2, 1), 0)
+        db_k = np.where(exact, mu*(tk*w/s - (1-w)/s**2), 0)
+    dr = np.where(valid, -db_k, 0)
+    dr_next = np.zeros_like(dr); dr_next[:, :, :-1] = dr[:, :, 1:]
+
+    df = da0[:, :, 0]
+    dlogdet = df/f[:, :, 0]
+    for k in xrange(1, Tmax):
+        df = (da0[:, :, k] - 2*a1[:, :, k-1]*da1[:, :, k-1]/f[:, :, k-1] +
+              a1[:, :, k-1]**2*df/f[:, :, k-1]**2)
+        dlogdet += df/f[:, :, k]
+
+    dquad = ((da0*r**2).sum(axis=2) + 2*(da1*r*r_next).sum(axis=2) +
+             2*(a0*r*dr).sum(axis=2) + 2*(a1*(dr*r_next + r*dr_next)).sum(axis=2))
+    dtrCA = (KLdata['Ck_diag']*da0).sum(axis=2) + (KLdata['Ck_off']*da1).sum(axis=2)
+    dLike_ds = -.5*dlogdet + .5*(dquad + dtrCA)/D0
+    dLike_dD0 = .5*T/D0 - .5*(quad + trCA)/D0**2
+
+    grad = np.zeros_like(sD)
+    grad[:q] = 2*sD[:q]*dLike_ds.sum(axis=0)
+    grad[-1] = 2*sD[-1]*dLike_dD0.sum()
+    return Like.sum(), grad
+
+
+def KLfit_multipat_mu(Ckq_q_all, xk_q_all, tk_all, mu, sD0=None):
     '''
     Simultaneous KL divergence minimization for several quantiles
 
@@ -57,6 +195,7 @@ def KLfit_multipat_mu(Ckq_q_all, xk_q_all, tk_all, mu):
     xk_q_all - list of by-quantile mean frequencies for all patients
     tk_all - list of the time points for all patients
     mu - mutation rate
+    sD0 - initial square roots of the fitness and noise parameters (warm start)
 
     Returns:
     fitness parameters for each quantile, mutation rate and noise parameter
@@ -64,41 +203,25 @@ def KLfit_multipat_mu(Ckq_q_all, xk_q_all, tk_all, mu):
     from scipy.optimize import minimize
 
     q = xk_q_all[0].shape[0]
-    def akq_mat(s, dt_k):
-        if s > h/np.min(dt_k):
-            a0 =  2*s/(1-np.exp(-2*s*dt_k))
-            a0[:-1] += 2*s*np.exp(-2*s*dt_k[1:])/(1-np.exp(-2*s*dt_k[1:]))
-            a1 = - 2*s*np.exp(-s*dt_k[1:])/(1-np.exp(-2*s*dt_k[1:]))
-        else:
-            a0 =  1/dt_k
-            a0[:-1] += (1.- s*dt_k[1:])**2/dt_k[1:]
-            a1 = -(1.- s*dt_k[1:])/dt_k[1:]
-        return (np.diag(a0) + np.diag(a1,1) + np.diag(a1,-1))
-
-    def KL_multipat(sD):
-        D0 = sD[-1]**2
-        Like = np.zeros((len(tk_all),q))
-        for jpat, tk in enumerate(tk_all):
-            dtk = np.zeros(tk.shape[0]); dtk[0] = tk[0]; dtk[1:] = np.diff(tk)
-            for jq in xrange(q):
-                s = sD[jq]**2
-                Akq = akq_mat(s,dtk)/D0
-                if s > h/np.min(dtk):
-                    b_k = mu*(1-np.exp(-s*tk))/s
-                else:
-                    b_k = mu*tk
-                Like[jpat,jq] = -.5*np.log(LA.det(Akq)) + 0.5*(xk_q_all[jpat][jq,:]-b_k).dot(Akq).dot(xk_q_all[jpat][jq,:]-b_k)+\
-                                                        + .5*np.trace(Ckq_q_all[jpat][jq,:,:].dot(Akq))
-        if np.isnan(Like).any():
-            print sD**2, Like
-        return Like.sum()
+    KLdata = prepare_KL_data(Ckq_q_all, xk_q_all, tk_all)
+    KL_multipat = lambda sD: KL_multipat_tridiag(sD, KLdata, mu)
+    KL_multipat_grad = lambda sD: KL_multipat_tridiag(sD, KLdata, mu, gradient=True)
 
     # we operate on the square root of the coefficients -> when squared positive, not bounds required
-    sD0 = 1e-3*np.ones(q+1)
+    if sD0 is None:
+        sD0 = 1e-3*np.ones(q+1)
     step = 1e-4*np.ones(q+1)
     tol = h
     #sD = amoeba_vp(KL_multipat,sD0,args=(),a = step,tol_x = tol,tol_f = tol)
-    sol = minimize(KL_multipat, sD0, method='Powell')
+    sol = minimize(KL_multipat_grad, sD0, jac=True, method='BFGS')
+    if sol['success']:
+        sD = sol['x']
+        return sD**2
+    else:
+        # BFGS often stops on precision loss close to the minimum: polish with Powell
+        if np.isfinite(sol['fun']) and sol['fun'] <= KL_multipat(sD0):
+            sD0 = sol['x']
+        sol = minimize(KL_multipat, sD0, method='Powell')
     if sol['success']:
         sD = sol['x']
         return sD**2
@@ -112,6 +235,126 @@ def KLfit_multipat_mu(Ckq_q_all, xk_q_all, tk_all, mu):
             import ipdb; ipdb.set_trace();
 
 
+def KL_bootstrap_replicate(jboot):
+    '''Fit one bootstrap replicate, see bootstrap_KLfit_multipat_mu'''
+    shared = KL_bootstrap_shared
+    pp = shared['patients'][jboot]
+    print 'bootstrap #', jboot
+    smuD = KLfit_multipat_mu([shared['Ckq_q_all'][p] for p in pp],
+                             [shared['xk_q_all'][p] for p in pp],
+                             [shared['tk_all'][p] for p in pp],
+                             shared['mu'], sD0=shared['sD0'])
+    if shared['checkpoint_dir'] is not None:
+        fn = shared['checkpoint_dir']+'replicate_'+str(jboot)+'.txt'
+        np.savetxt(fn+'.tmp', smuD)
+        os.rename(fn+'.tmp', fn)
+    return jboot, smuD
+
+
+def get_bootstrap_fingerprint(Ckq_q_all, xk_q_all, tk_all, mu, Nboot, sD0=None):
+    '''md5 hash of the input data of a bootstrap, to validate its checkpoints'''
+    import hashlib
+    md5 = hashlib.md5(repr((mu, Nboot)))
+    for arr in list(Ckq_q_all) + list(xk_q_all) + list(tk_all) + [sD0]:
+        if arr is None:
+            md5.update('None')
+            continue
+        arr = np.ascontiguousarray(arr, dtype=float)
+        md5.update(repr(arr.shape))
+        md5.update(arr.tostring())
+    return md5.hexdigest()
+
+
+def bootstrap_KLfit_multipat_mu(Ckq_q_all, xk_q_all, tk_all, mu, Nboot=100,
+                                sD0=None, jobs=1, checkpoint_dir=None):
+    '''Bootstrap the simultaneous KL fit over patients
+
+    Input parameters:
+    Ckq_q_all, xk_q_all, tk_all, mu - see KLfit_multipat_mu
+    Nboot - number of bootstrap replicates
+    sD0 - warm start for each replicate, e.g. square roots of the point estimate
+    jobs - number of worker processes
+    checkpoint_dir - folder where the patient resamplings and each finished
+                     replicate are saved, so an interrupted run resumes. It
+                     is emptied if it holds a run on different input data
+
+    Returns:
+    array (Nboot, q+1) of fitness parameters and noise parameter per replicate
+    '''
+    from multiprocessing import Pool
+
+    npat = len(tk_all)
+    q = xk_q_all[0].shape[0]
+
+    # draw the patient resamplings up front, or reuse those of an interrupted run
+    patients = None
+    if checkpoint_dir is not None:
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+        # checkpoints of a run on other input data are stale
+        fingerprint = get_bootstrap_fingerprint(Ckq_q_all, xk_q_all, tk_all, mu,
+                                                Nboot, sD0=sD0)
+        fn_fingerprint = checkpoint_dir+'fingerprint.txt'
+        fingerprint_old = None
+        if os.path.isfile(fn_fingerprint):
+            with open(fn_fingerprint) as f:
+                fingerprint_old = f.read().strip()
+        if fingerprint_old != fingerprint:
+            for fn in os.listdir(checkpoint_dir):
+                os.remove(checkpoint_dir+fn)
+            with open(fn_fingerprint+'.tmp', 'w') as f:
+                f.write(fingerprint+'\n')
+            os.rename(fn_fingerprint+'.tmp', fn_fingerprint)
+
+        fn_patients = checkpoint_dir+'patients.txt'
+        if os.path.isfile(fn_patients):
+            patients = np.loadtxt(fn_patients, dtype=int, ndmin=2)
+            if patients.shape != (Nboot, npat):
+                patients = None
+    if patients is None:
+        patients = np.random.randint(0, npat, (Nboot, npat))
+        if checkpoint_dir is not None:
+            # results from other resamplings are stale
+            for fn in os.listdir(checkpoint_dir):
+                if fn.startswith('replicate_'):
+                    os.remove(checkpoint_dir+fn)
+            np.savetxt(fn_patients, patients, fmt='%d')
+
+    smuD_boot = np.zeros((Nboot, q+1))
+    todo = []
+    for jboot in xrange(Nboot):
+        fn = None if checkpoint_dir is None else checkpoint_dir+'replicate_'+str(jboot)+'.txt'
+        if (fn is not None) and os.path.isfile(fn):
+            smuD_boot[jboot] = np.loadtxt(fn)
+        else:
+            todo.append(jboot)
+    print 'bootstrap replicates to fit:', len(todo), 'of', Nboot
+
+    # the data are inherited by the forked workers
+    KL_bootstrap_shared.update({'Ckq_q_all': Ckq_q_all, 'xk_q_all': xk_q_all,
+                                'tk_all': tk_all, 'mu': mu, 'sD0': sD0,
+                                'patients': patients,
+                                'checkpoint_dir': checkpoint_dir})
+    try:
+        if jobs > 1:
+            pool = Pool(jobs)
+            try:
+                results = pool.imap_unordered(KL_bootstrap_replicate, todo)
+                for jboot, smuD in results:
+                    smuD_boot[jboot] = smuD
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for jboot, smuD in imap(KL_bootstrap_replicate, todo):
+                smuD_boot[jboot] = smuD
+    finally:
+        KL_bootstrap_shared.clear()
+
+    return smuD_boot
+
+
 def patient_preprocessing(pat_name,Squant, div = False, outliers = True, xcut = 0.0,
                           xcut_up = 0., cov_min=100):
     '''Load patient data, remove outliers and return average frequencies by
@@ -180,6 +423,10 @@ if __name__=="__main__":
                         help="Number of quantiles")
     parser.add_argument('--subtype', type=str, default='any',
                         help="subtype to compare against")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of processes for the bootstrap")
+    parser.add_argument('--no-checkpoint', action='store_true',
+                        help="Do not save and resume bootstrap replicates")
     args = parser.parse_args()
 
 
@@ -238,13 +485,18 @@ if __name__=="__main__":
 
     # Bootstrapping
     Nboot = 100
+    if args.no_checkpoint or (outdir_name is None):
+        checkpoint_dir = None
+    else:
+        checkpoint_dir = (outdir_name + gen_region+'_smuD_KLmu_multi_boot_replicates_'+
+                          args.subtype+'_q'+str(args.quantiles)+'/')
     smuD_multipat_boot_mu = np.zeros((Nboot,q+2))
-    for jboot in xrange(Nboot):
-        print 'bootstrap #', jboot
-        pp = np.random.randint(0,len(patient_names),len(patient_names))
-        smuD_multipat_boot_mu[jboot,q] = 1.2e-5 # fixed mutation rate
-        smuD_multipat_boot_mu[jboot,ii_sD] = KLfit_multipat_mu([Ckq_q_all[p] for p in pp],\
-        [xk_q_all[p] for p in pp],[tt_all[p] for p in pp],smuD_multipat_boot_mu[jboot,q])
+    smuD_multipat_boot_mu[:,q] = 1.2e-5 # fixed mutation rate
+    # warm start all replicates from the point estimate
+    smuD_multipat_boot_mu[:,ii_sD] = bootstrap_KLfit_multipat_mu(Ckq_q_all, xk_q_all, tt_all,
+                                        smuD_KL_q_multipat_mu[q], Nboot=Nboot,
+                                        sD0=np.sqrt(smuD_KL_q_multipat_mu[ii_sD]),
+                                        jobs=args.jobs, checkpoint_dir=checkpoint_dir)
 
     smuD_multipat_boot_mu_mean = smuD_multipat_boot_mu.mean(axis=0)
     smuD_multipat_boot_mu_sigma = np.sqrt((smuD_multipat_boot_mu**2).mean(axis=0) - smuD_multipat_boot_mu.mean(axis=0)**2)
@@ -252,3 +504,7 @@ if __name__=="__main__":
         np.savetxt(outdir_name + gen_region+'_smuD_KLmu_multi_boot.txt',
                    np.array([smuD_multipat_boot_mu_mean, smuD_multipat_boot_mu_sigma]),
                    header = '\t\t\t'.join(header))
+    # the checkpoints only serve to resume an interrupted bootstrap
+    if checkpoint_dir is not None:
+        import shutil
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
@@ -28,7 +28,9 @@ from hivevo.HIVreference import HIVreferenceAminoacid, HIVreference
 from hivevo.af_tools import divergence
 from util import add_panel_label
 from fitness_pooled import process_average_allele_frequencies, draw_genome, af_average, get_final_state, load_mutation_rates
-from fitness_pooled_aa import calc_amino_acid_mutation_rates
+from pooled_store import has_pooled_data, load_pooled_data
+from fitness_pooled_aa import get_initial_codon_matrix
+from aa_rate_table import load_aa_rate_tables
 
 
 
@@ -63,13 +65,14 @@ drug_muts = {'PI':{'offset': 56 - 1,
 
 
 # Functions
-def plot_drug_resistance_mutations(data, aa_mutation_rates, fname=None):
+def plot_drug_resistance_mutations(data, aa_rate_tables, fname=None):
     '''Plot the frequency of drug resistance mutations'''
     import matplotlib.patches as patches
 
     fs = 16
     region = 'pol'
     pcodes = data['init_codon'][region].keys()
+    codon_matrix = get_initial_codon_matrix(data, region, pcodes)
 
     fig, axs = plt.subplots(2, 1, gridspec_kw={'height_ratios': [1, 6]})
     ax = axs[1]
@@ -82,9 +85,10 @@ def plot_drug_resistance_mutations(data, aa_mutation_rates, fname=None):
         drug_mut_rates = {}
         offset = drug_muts[prot]['offset']
         for cons_aa, pos, target_aa in drug_muts[prot]['mutations']:
-            codons = {pat:data['init_codon'][region][pat][pos+offset] for pat in pcodes}
-            mut_rates = {pat:np.sum([aa_mutation_rates[(codons[pat], aa)] for aa in target_aa])
-                        for pat in pcodes}
+            # single hit rates into any of the target amino acids, 0 without codon
+            ci = codon_matrix[:,pos+offset]
+            rates = aa_rate_tables['single'][ci][:,[alphaal.index(aa) for aa in target_aa]].sum(axis=1)
+            mut_rates = dict(izip(pcodes, np.where(ci>=0, rates, 0)))
             freqs = {pat:np.sum([data['af_by_pat'][region][pat][alphaal.index(aa), pos+offset]\
                                 /data['af_by_pat'][region][pat][:20,pos+offset].sum()
                         for aa in target_aa]) for pat in pcodes}
@@ -239,13 +243,12 @@ if __name__=="__main__":
                         help='subtype to compare against')
     args = parser.parse_args()
 
-    fn = '../data/fitness_pooled_aa/avg_aa_allele_frequency_st_'+args.subtype+'.pickle.gz'
+    fn = '../data/fitness_pooled_aa/avg_aa_allele_frequency_st_'+args.subtype
 
-    if not os.path.isfile(fn):
+    if not has_pooled_data(fn):
         raise IOError('Data file not found. Please run combined_af_aa.py first')
     else:
-        with gzip.open(fn) as ifile:
-            data = cPickle.load(ifile)
+        data = load_pooled_data(fn)
 
-    aa_mutation_rates, total_nonsyn_mutation_rates = calc_amino_acid_mutation_rates()
-    plot_drug_resistance_mutations(data, aa_mutation_rates, '../figures/figure_6_subtype_'+args.subtype+'_withcost')
+    aa_rate_tables = load_aa_rate_tables()
+    plot_drug_resistance_mutations(data, aa_rate_tables, '../figures/figure_6_subtype_'+args.subtype+'_withcost')
@@ -22,6 +22,7 @@ from hivevo.sequence import alpha, alphal
 
 from util import add_binned_column, boot_strap_patients
 from secondary_structure_test import load_secondary_structure_patient
+from site_table import load_site_table, get_swept_sites
 
 
 
@@ -31,107 +32,37 @@ def load_mutation_rates():
     return pd.read_pickle(fn)
 
 
-def collect_data(patients, cov_min=100, no_sweeps=False, refname='HXB2'):
+def collect_data(patients, cov_min=100, no_sweeps=False, refname='HXB2',
+                 regenerate=False):
     '''Collect data for the fitness cost estimate'''
-    ref = HIVreference(refname=refname, subtype='any', load_alignment=True)
     mus = load_mutation_rates()
     mu = mus.mu
     muA = mus.muA
 
-    data = []
-    for pi, pcode in enumerate(patients):
-        print pcode
-
-        p = Patient.load(pcode)
-        p.sec_str = load_secondary_structure_patient(pcode)
-
-        comap = (pd.DataFrame(p.map_to_external_reference('genomewide', refname=refname)[:, :2],
-                              columns=[refname, 'patient'])
-                   .set_index('patient', drop=True)
-                   .loc[:, refname])
-
-        aft = p.get_allele_frequency_trajectories('genomewide', cov_min=cov_min)
-        for pos, aft_pos in enumerate(aft.swapaxes(0, 2)):
-            fead = p.pos_to_feature[pos]
-
-            # Look at the protein secondary structure
-            sec_str = p.sec_str[pos]
-
-            # Keep only sites within ONE protein
-            # Note: we could drop this, but then we cannot quite classify syn/nonsyn
-            if len(fead['protein_codon']) != 1:
-                continue
-
-            # Exclude codons with gaps
-            pc = fead['protein_codon'][0][-1]
-            cod_anc = ''.join(p.initial_sequence[pos - pc: pos - pc + 3])
-            if '-' in cod_anc:
-                continue
-
-            # Keep only nonmasked times
-            if aft_pos[:4].mask.any(axis=0).all():
-                continue
-            else:
-                ind = ~aft_pos[:4].mask.any(axis=0)
-                times = p.dsi[ind]
-                aft_pos = aft_pos[:, ind]
-                n_templates = p.n_templates_dilutions[ind]
-
-            # Get site entropy
-            if pos not in comap.index:
-                continue
-            pos_ref = comap.loc[pos]
-            S_pos = ref.entropy[pos_ref]
-
-            # Keep only sites where the ancestral allele and group M agree
-            if ref.consensus_indices[pos_ref] != aft_pos[:, 0].argmax():
-                continue
-
-            # Filter out sweeps if so specified
-            if no_sweeps:
-                found = False
-                nuc_anc = p.initial_sequence[pos]
-                for ia, aft_nuc in enumerate(aft_pos[:4]):
-                    if (alpha[ia] != nuc_anc) and (aft_nuc > 0.5).any():
-                        found = True
-                if found:
-                    continue
-
-            for ia, aft_nuc in enumerate(aft_pos[:4]):
-                # Keep only derived alleles
-                if alpha[ia] == p.initial_sequence[pos]:
-                    continue
-
-                # Annotate with syn/nonsyn alleles
-                cod_new = cod_anc[:pc] + alpha[ia] + cod_anc[pc+1:]
-                if translate(cod_anc) != translate(cod_new):
-                    syn = False
-                else:
-                    syn = True
-
-                mut = p.initial_sequence[pos]+'->'+alpha[ia]
-                mu_pos = mu[mut]
-                muA_pos = muA[mut]
-
-                for it, (t, af_nuc, n_temp) in enumerate(izip(times, aft_nuc, n_templates)):
-
-                    datum = {'time': t,
-                             'af': af_nuc,
-                             'pos': pos,
-                             'pos_ref': pos_ref,
-                             'protein': fead['protein_codon'][0][0],
-                             'pcode': pcode,
-                             'mut': mut,
-                             'mu': mu_pos,
-                             'muAbram': muA_pos,
-                             'S': S_pos,
-                             'syn': syn,
-                             'n_templates': n_temp,
-                             'protein_secondary_structure': sec_str,
-                            }
-                    data.append(datum)
-
-    data = pd.DataFrame(data)
+    data = load_site_table(patients, cov_min=cov_min, refname=refname,
+                           subtype='any', regenerate=regenerate)
+
+    # Keep only nonmasked times at sites where the ancestral allele and
+    # group M agree, and derived alleles
+    ind = data['covered'] & data['anc_cross'] & data['derived']
+
+    # Filter out sweeps if so specified
+    if no_sweeps:
+        ind &= ~get_swept_sites(data, threshold=0.5)
+
+    data = data.loc[ind, ['time', 'af', 'pos', 'pos_ref', 'protein', 'pcode',
+                          'mut', 'S', 'syn', 'n_templates']]
+    data.reset_index(drop=True, inplace=True)
+    data['mu'] = data['mut'].map(mu)
+    data['muAbram'] = data['mut'].map(muA)
+
+    # Look at the protein secondary structure
+    sec_str = np.empty(len(data), object)
+    for pcode in patients:
+        ind = (data['pcode'] == pcode).values
+        sec_str_pat = np.asarray(load_secondary_structure_patient(pcode))
+        sec_str[ind] = sec_str_pat[data.loc[ind, 'pos'].values]
+    data['protein_secondary_structure'] = sec_str
 
     return data
 
@@ -153,7 +84,8 @@ if __name__ == '__main__':
     if not os.path.isfile(fn) or args.regenerate:
         patients = ['p1', 'p2', 'p3','p5', 'p6', 'p8', 'p9', 'p11']
         cov_min = 100
-        data = collect_data(patients, cov_min=cov_min, no_sweeps=args.no_sweeps)
+        data = collect_data(patients, cov_min=cov_min, no_sweeps=args.no_sweeps,
+                            regenerate=args.regenerate)
         data.to_pickle(fn)
     else:
         data = pd.read_pickle(fn)
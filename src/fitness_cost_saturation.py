@@ -9,19 +9,18 @@ from __future__ import print_function
 import os
 import sys
 import argparse
-from itertools import izip
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-from Bio.Seq import translate
-
 from hivevo.patients import Patient
 from hivevo.HIVreference import HIVreference
 from hivevo.sequence import alpha, alphal
 
-from util import add_binned_column, boot_strap_patients, load_mutation_rates
+from util import add_binned_column, load_mutation_rates, patient_bootstrap_counts
+from site_table import load_site_table, load_sweep_events, get_swept_sites
+from saturation_fit import aggregate_by_patient, average_over_patients, fit_slope, fit_saturation
 
 
 def prepare_data_for_fit(data, plot=False):
@@ -181,64 +180,33 @@ def plot_fit(data_to_fit, mu, s):
     plt.show()
 
 
-def fit_fitness_cost(data, plot=True, save=True, bootstrap=True, mu=None):
-    '''Fit one slope and 6 saturations to ALL data at once'''
-    def average_data(data):
-        data = data.copy()
-        data['counter'] = 1.0
-        d = (data
-             .loc[:, ['S_binc', 'time_binc', 'af', 'counter']]
-             .groupby(['S_binc', 'time_binc'], as_index=True)
-             .sum())
-        d['af'] /= d['counter']
-        data_to_fit = d['af'].unstack()
-        data_to_fit.name = 'af'
-        return data_to_fit
-
-    def fit_data(data_to_fit, mu=None):
-        from scipy.optimize import curve_fit
-
-        # First fit slope from high-entropy class
-        if mu is None:
-            datum = data_to_fit.iloc[-1]
-            nInd = 3
-            x = np.array(datum.index)[:3]
-            y = np.array(datum)[:3]
-            mu = np.dot(x, y) / np.dot(x, x)
-
-        # Then, fit the saturations
-        s = []
-        fun = lambda x, s: mu / s * (1.0 - np.exp(-s * x))
-        for iS, (S, datum) in enumerate(data_to_fit.iterrows()):
-            x = np.array(datum.index)
-            y = np.array(datum)
-            s0 = 1e-2 / 10**(iS / 2.0)
-            fit = curve_fit(fun, x, y, p0=[s0])
-            sTmp = fit[0][0]
-            dsTmp = fit[1][0][0]
-            s.append({'S': S,
-                      's': sTmp,
-                      'ds': dsTmp,
-                     })
-        s = pd.DataFrame(s).set_index('S', drop=True, inplace=False)
-        return mu, s
-
-    data_to_fit = average_data(data)
-    mu, s = fit_data(data_to_fit, mu=mu)
+def fit_fitness_cost(data, plot=True, save=True, bootstrap=True, mu=None, n_bootstrap=100):
+    '''Fit one slope and 6 saturations to ALL data at once
 
-    if bootstrap:
-        def bootstrap_fun():
-            def prepare_and_fit(data):
-                data_to_fit = average_data(data)
-                return fit_data(data_to_fit, mu=mu)[1]['s']
+    The frequencies are summed per patient, entropy bin, and time bin once, the
+    bootstrap replicates over patients are weighted averages of these sums and
+    all their saturations are fitted together.
+    '''
+    (S_binc, time_binc), sums, counts = aggregate_by_patient(data, ['S_binc', 'time_binc'])
+    af = average_over_patients(sums, counts)
+    data_to_fit = pd.DataFrame(af,
+                               index=pd.Index(S_binc, name='S_binc'),
+                               columns=pd.Index(time_binc, name='time_binc'))
+    data_to_fit.name = 'af'
 
-            ds = s['s'].copy()
-            sBS = boot_strap_patients(data, prepare_and_fit, n_bootstrap=100)
-            for key, _ in ds.iteritems():
-                ds[key] = np.std([tmp[key] for tmp in sBS])
-            s['ds'] = ds
+    # First fit slope from high-entropy class
+    if mu is None:
+        mu = fit_slope(time_binc[:3], af[-1, :3])
 
-        bootstrap_fun()
+    # Then, fit the saturations
+    s0 = 1e-2 / 10**(np.arange(len(S_binc)) / 2.0)
+    sFit, dsFit = fit_saturation(time_binc, af, mu, s0)
+    s = pd.DataFrame({'s': sFit, 'ds': dsFit}, index=pd.Index(S_binc, name='S'))
+
+    if bootstrap:
+        weights = patient_bootstrap_counts(sums.shape[0], n_bootstrap)
+        sBS = fit_saturation(time_binc, average_over_patients(sums, counts, weights), mu, s0)[0]
+        s['ds'] = sBS.std(axis=0)
 
     output = {'data_to_fit': data_to_fit, 'mu': mu, 's': s}
 
@@ -254,88 +222,30 @@ def fit_fitness_cost(data, plot=True, save=True, bootstrap=True, mu=None):
     return output
 
 
-def collect_data(patients, cov_min=100, no_sweeps=False, refname='HXB2'):
+def collect_data(patients, cov_min=100, no_sweeps=False, refname='HXB2',
+                 regenerate=False):
     '''Collect data for the fitness cost estimate'''
     print('Collect data from patients')
 
-    ref = HIVreference(refname=refname, subtype='any', load_alignment=True)
-    mus = load_mutation_rates()
-    mu = mus.mu
-    muA = mus.muA
-
-    data = []
-    for pi, pcode in enumerate(patients):
-        print(pcode)
-
-        p = Patient.load(pcode)
-        comap = (pd.DataFrame(p.map_to_external_reference('genomewide', refname=refname)[:, :2],
-                              columns=[refname, 'patient'])
-                   .set_index('patient', drop=True)
-                   .loc[:, refname])
-
-        aft = p.get_allele_frequency_trajectories('genomewide', cov_min=cov_min)
-        for pos, aft_pos in enumerate(aft.swapaxes(0, 2)):
-            fead = p.pos_to_feature[pos]
-
-            # Keep only sites within ONE protein
-            # Note: we could drop this, but then we cannot quite classify syn/nonsyn
-            if len(fead['protein_codon']) != 1:
-                continue
-
-            # Exclude codons with gaps
-            pc = fead['protein_codon'][0][-1]
-            cod_anc = ''.join(p.initial_sequence[pos - pc: pos - pc + 3])
-            if '-' in cod_anc:
-                continue
-
-            # Keep only nonmasked times
-            if aft_pos[:4].mask.any(axis=0).all():
-                continue
-            else:
-                ind = ~aft_pos[:4].mask.any(axis=0)
-                times = p.dsi[ind]
-                aft_pos = aft_pos[:, ind]
-                n_templates = p.n_templates_dilutions[ind]
-
-            # Get site entropy
-            if pos not in comap.index:
-                continue
-            pos_ref = comap.loc[pos]
-            S_pos = ref.entropy[pos_ref]
-
-            # Keep only sites where the ancestral allele and group M agree
-            if ref.consensus_indices[pos_ref] != aft_pos[:, 0].argmax():
-                continue
-
-            # Filter out sweeps if so specified, only for nonsyn
-            if no_sweeps:
-                found = False
-                nuc_anc = p.initial_sequence[pos]
-                for ia, aft_nuc in enumerate(aft_pos[:4]):
-                    if (alpha[ia] != nuc_anc) and (aft_nuc > 0.5).any():
-                        cod_new = cod_anc[:pc] + alpha[ia] + cod_anc[pc+1:]
-                        if translate(cod_anc) != translate(cod_new):
-                            found = True
-                if found:
-                    continue
-
-            # Keep only 1 - ancestral allele
-            ia = p.initial_indices[pos]
-            aft_nuc = 1 - aft_pos[ia]
-            for it, (t, af_nuc, n_temp) in enumerate(izip(times, aft_nuc, n_templates)):
-                datum = {'time': t,
-                         'af': af_nuc,
-                         'pos': pos,
-                         'pos_ref': pos_ref,
-                         'protein': fead['protein_codon'][0][0],
-                         'pcode': pcode,
-                         'ancestral': alpha[ia],
-                         'S': S_pos,
-                         'n_templates': n_temp,
-                        }
-                data.append(datum)
-
-    data = pd.DataFrame(data)
+    data = load_site_table(patients, cov_min=cov_min, refname=refname,
+                           subtype='any', regenerate=regenerate)
+
+    # Keep only nonmasked times, sites where the ancestral allele and group M
+    # agree (hence also sites in the reference), and the ancestral allele
+    ind = data['covered'] & data['anc_cross'] & (~data['derived'])
+
+    # Filter out sweeps if so specified, only for nonsyn
+    if no_sweeps:
+        events = load_sweep_events(patients, threshold=0.5, cov_min=cov_min,
+                                   refname=refname, subtype='any', table=data)
+        ind &= ~get_swept_sites(data, only_nonsyn=True, events=events)
+
+    data = data.loc[ind, ['time', 'af', 'pos', 'pos_ref', 'protein', 'pcode',
+                          'ancestral', 'S', 'n_templates']]
+    data.reset_index(drop=True, inplace=True)
+
+    # Keep only 1 - ancestral allele
+    data['af'] = 1 - data['af']
 
     return data
 
@@ -359,7 +269,8 @@ if __name__ == '__main__':
     if not os.path.isfile(fn) or args.regenerate:
         patients = ['p1', 'p2', 'p5', 'p6', 'p8', 'p9', 'p11']
         cov_min = 100
-        data = collect_data(patients, cov_min=cov_min, no_sweeps=args.no_sweeps)
+        data = collect_data(patients, cov_min=cov_min, no_sweeps=args.no_sweeps,
+                            regenerate=args.regenerate)
         try:
             data.to_pickle(fn)
             print('Data saved to file:', os.path.abspath(fn))
@@ -28,7 +28,12 @@ import seaborn as sns
 from hivevo.patients import Patient
 from hivevo.HIVreference import HIVreference
 from hivevo.af_tools import divergence
-from util import load_mutation_rates, draw_genome
+from util import load_mutation_rates, draw_genome, map_jobs, spearman_rows
+from util import save_fitness_cost_table, patient_bootstrap_counts
+from trajectory_cache import get_allele_frequency_trajectories
+from syn_sites import get_syn_sites
+from pooled_store import has_pooled_data, load_pooled_data, save_pooled_data
+from reference_tracks import get_reference_tracks
 
 
 # Globals
@@ -91,6 +96,54 @@ def af_average(afs):
     tmp_afs = tmp_afs/(np.sum(tmp_afs, axis=0)+1e-6)
     return tmp_afs
 
+def patient_partition_weights(afs, npartitions):
+    '''
+    0/1 weights of patients for many random partitions in two halves,
+    each pair of rows is equivalent to one call of patient_partition
+    '''
+    patients = afs.keys()
+    weights = []
+    for ii in xrange(npartitions):
+        tmp_sample = set(sample(patients, len(patients)//2))
+        part = np.array([pat in tmp_sample for pat in patients], dtype=float)
+        weights.extend([part, 1 - part])
+    return np.array(weights).reshape(-1, len(patients))
+
+
+def patient_subset_weights(npat, nsubsets=20, min_size=2):
+    '''
+    0/1 indicator matrix of patient subsets of each size from min_size to npat.
+    Sizes with at most nsubsets distinct subsets get all of them, larger ones
+    nsubsets random subsets. Returns the (n_subsets, npat) matrix and the sizes
+    '''
+    from itertools import combinations
+    from scipy.special import binom
+    subsets, sizes = [], []
+    for n in xrange(min_size, npat+1):
+        if binom(npat, n) <= nsubsets:
+            size_subsets = list(combinations(range(npat), n))
+        else:
+            size_subsets = [sample(range(npat), n) for ii in xrange(nsubsets)]
+        subsets.extend(size_subsets)
+        sizes.extend([n]*len(size_subsets))
+    weights = np.zeros((len(subsets), npat))
+    for si, subset in enumerate(subsets):
+        weights[si, list(subset)] = 1
+    return weights, np.array(sizes)
+
+
+def af_average_weighted(afs, weights):
+    '''
+    af_average for many sets of patient weights at once
+    afs     --  stacked allele frequencies of patients (n_patients, n_states, L)
+    weights --  weights of patients for each replicate (n_replicates, n_patients)
+    '''
+    tmp_afs = np.tensordot(weights, afs, axes=(1, 0))
+    tmp_norm = tmp_afs.sum(axis=1)
+    tmp_norm[tmp_norm==0] = np.nan
+    return tmp_afs/(tmp_norm[:,None,:]+1e-6)
+
+
 def get_final_state(aft):
     not_covered = np.ones(aft.shape[-1], dtype='bool')
     final_state = np.zeros(aft.shape[-1], dtype='int')
@@ -104,78 +157,99 @@ def get_final_state(aft):
     return np.ma.array(final_state, mask=not_covered)
 
 
-def collect_weighted_afs(region, patients, reference, cov_min=1000, max_div=0.5, synnonsyn=True):
+def collect_weighted_afs_patient(region, p, reference, cov_min=1000, max_div=0.5, synnonsyn=True,
+                                 regenerate=False):
     '''
-    produce weighted averages of allele frequencies for all late samples in each patients
-    restrict to sites that don't sweep and have limited diversity as specified by max_div
+    produce the weighted average of allele frequencies for all late samples of one patient,
+    see collect_weighted_afs. Returns the summed allele frequencies and, if synnonsyn,
+    the syn site indicators with and without masking of constrained sites (recomputed
+    instead of read from the cache if regenerate)
     '''
-    good_pos_in_reference = reference.get_ungapped(threshold = 0.05)
-    combined_af_by_pat = {}
-    syn_nonsyn_by_pat={}
-    syn_nonsyn_by_pat_unconstrained={}
+    good_pos_in_reference = get_reference_tracks(reference).get_track('ungapped')
     if region=="genomewide":
         region_start = 0
         L = len(reference.seq)
     else:
         region_start = int(reference.annotation[region].location.start)
         L = len(reference.annotation[region])
-    for pi, p in enumerate(patients):
-        pcode= p.name
-        print("averaging ",pcode," region ",region)
-        try:
-            pcode= p.name
-            combined_af_by_pat[pcode] = np.zeros((6, L))
-            print(pcode, p.Subtype)
-            aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min, error_rate = ERR_RATE, type='nuc')
-
-            # get patient to subtype map
-            patient_to_subtype = p.map_to_external_reference(region, refname=reference.refname)
-            consensus = reference.get_consensus_indices_in_patient_region(patient_to_subtype)
-            ref_ungapped = good_pos_in_reference[patient_to_subtype[:,0]]
-
-            ancestral = p.get_initial_indices(region)[patient_to_subtype[:,2]]
-            rare = ((aft[:,:4,:]**2).sum(axis=1).min(axis=0)>max_div)[patient_to_subtype[:,2]]
-            #final = aft[-1].argmax(axis=0)[patient_to_subtype[:,2]]
-            final=get_final_state(aft[:,:,patient_to_subtype[:,2]])
-
-            if synnonsyn:
-                from hivevo.sequence import alphal
-                Ai = alphal.index('A')
-                Gi = alphal.index('G')
-                # note: this doesn not work for split reading frames.
-                syn_nonsyn_by_pat[pcode] = np.zeros(L, dtype=int)
-                syn_nonsyn_by_pat_unconstrained[pcode] = np.zeros(L, dtype=int)
-                for mask_constrained, dest in [(True, syn_nonsyn_by_pat),
-                                               (False, syn_nonsyn_by_pat_unconstrained)]:
-                    syn_matrix = p.get_syn_mutations(region, mask_constrained=mask_constrained)
-                    syn_pos = ((syn_matrix.sum(axis=0)>3)|   # 4-fold synonymous OR
-                              ((syn_matrix.sum(axis=0)==2)&   # 2-fold syonymous AND
-                               (syn_matrix[Ai,:]==syn_matrix[Gi,:])))  # A and G both syn or both non-syn
-                                                                    # (C T is then opposite)
-                    dest[pcode][patient_to_subtype[:,0]-patient_to_subtype[0][0]]+=\
-                                            syn_pos[patient_to_subtype[:,2]]
-
-            for af, ysi, depth in izip(aft, p.ysi, p.n_templates_dilutions):
-                if ysi<SAMPLE_AGE_CUTOFF:
-                    continue
-                pat_af = af[:,patient_to_subtype[:,2]]
-                patient_consensus = pat_af.argmax(axis=0)
-                ind = ref_ungapped&rare&(patient_consensus==consensus)&(ancestral==consensus)&(final==ancestral)
-                if pat_af.mask.any():
-                    ind = ind&(~pat_af.mask.any(axis=0))
-                if ind.sum()==0:
-                    continue
-                weight = depth/(1.0+depth/WEIGHT_CUTOFF)
-                print(weight, np.max(pat_af[:,ind]))
-                combined_af_by_pat[pcode][:,patient_to_subtype[ind,0]-region_start] \
-                            += weight*pat_af[:,ind]
-                if np.max(combined_af_by_pat[pcode])>10000:
-                    import ipdb; ipdb.set_trace()
-        except:
-            import ipdb; ipdb.set_trace()
+
+    pcode= p.name
+    print("averaging ",pcode," region ",region)
+    combined_af = np.zeros((6, L))
+    print(pcode, p.Subtype)
+    aft = get_allele_frequency_trajectories(p, region, cov_min=cov_min, error_rate=ERR_RATE, type='nuc')
+
+    # get patient to subtype map
+    patient_to_subtype = p.map_to_external_reference(region, refname=reference.refname)
+    consensus = reference.get_consensus_indices_in_patient_region(patient_to_subtype)
+    ref_ungapped = good_pos_in_reference[patient_to_subtype[:,0]]
+
+    ancestral = p.get_initial_indices(region)[patient_to_subtype[:,2]]
+    rare = ((aft[:,:4,:]**2).sum(axis=1).min(axis=0)>max_div)[patient_to_subtype[:,2]]
+    #final = aft[-1].argmax(axis=0)[patient_to_subtype[:,2]]
+    final=get_final_state(aft[:,:,patient_to_subtype[:,2]])
+
+    syn_nonsyn = {}
+    if synnonsyn:
+        # note: this doesn not work for split reading frames.
+        for mask_constrained in [True, False]:
+            syn_nonsyn[mask_constrained] = np.zeros(L, dtype=int)
+            syn_pos = get_syn_sites(p, region, mask_constrained=mask_constrained,
+                                    regenerate=regenerate)
+            syn_nonsyn[mask_constrained][patient_to_subtype[:,0]-patient_to_subtype[0][0]]+=\
+                                    syn_pos[patient_to_subtype[:,2]]
+
+    for af, ysi, depth in izip(aft, p.ysi, p.n_templates_dilutions):
+        if ysi<SAMPLE_AGE_CUTOFF:
+            continue
+        pat_af = af[:,patient_to_subtype[:,2]]
+        patient_consensus = pat_af.argmax(axis=0)
+        ind = ref_ungapped&rare&(patient_consensus==consensus)&(ancestral==consensus)&(final==ancestral)
+        if pat_af.mask.any():
+            ind = ind&(~pat_af.mask.any(axis=0))
+        if ind.sum()==0:
+            continue
+        weight = depth/(1.0+depth/WEIGHT_CUTOFF)
+        print(weight, np.max(pat_af[:,ind]))
+        combined_af[:,patient_to_subtype[ind,0]-region_start] \
+                    += weight*pat_af[:,ind]
+        if np.max(combined_af)>10000:
+            raise ValueError('implausible weighted allele frequencies in '+pcode+' '+region)
+    return combined_af, syn_nonsyn.get(True), syn_nonsyn.get(False)
+
+
+def collect_weighted_afs(region, patients, reference, cov_min=1000, max_div=0.5, synnonsyn=True):
+    '''
+    produce weighted averages of allele frequencies for all late samples in each patients
+    restrict to sites that don't sweep and have limited diversity as specified by max_div
+    '''
+    combined_af_by_pat = {}
+    syn_nonsyn_by_pat={}
+    syn_nonsyn_by_pat_unconstrained={}
+    for p in patients:
+        af, syn, syn_uc = collect_weighted_afs_patient(region, p, reference, cov_min=cov_min,
+                                                       max_div=max_div, synnonsyn=synnonsyn)
+        combined_af_by_pat[p.name] = af
+        if synnonsyn:
+            syn_nonsyn_by_pat[p.name] = syn
+            syn_nonsyn_by_pat_unconstrained[p.name] = syn_uc
     return combined_af_by_pat, syn_nonsyn_by_pat, syn_nonsyn_by_pat_unconstrained
 
 
+# patients and reference shared with the worker processes of collect_data
+# (inherited via fork, so they are not pickled for every task)
+collect_shared = {}
+
+
+def collect_weighted_afs_task(task):
+    '''Run collect_weighted_afs_patient for one (region, patient index) task'''
+    region, pi = task
+    return collect_weighted_afs_patient(region, collect_shared['patients'][pi],
+                                        collect_shared['reference'],
+                                        synnonsyn=collect_shared['synnonsyn'],
+                                        regenerate=collect_shared['regenerate'])
+
+
 def process_average_allele_frequencies(data, regions,
                                        nbootstraps=0,
                                        bootstrap_type='bootstrap',
@@ -201,22 +275,16 @@ def process_average_allele_frequencies(data, regions,
         #minor_af[region][ind]=np.nan
         #combined_entropy[region][ind]=np.nan
         if nbootstraps:
-            minor_af_bs[region]=[]
-            combined_entropy_bs[region]=[]
+            # all replicates are weighted sums of the same per-patient arrays
+            afs = data['af_by_pat'][region]
+            afs_stack = np.array([afs[pat] for pat in afs.keys()])
             if bootstrap_type=='bootstrap':
-                for ii in xrange(nbootstraps):
-                    tmp_af = af_average(patient_bootstrap(data['af_by_pat'][region]))
-                    combined_entropy_bs[region].append((-np.log2(tmp_af+1e-10)*tmp_af).sum(axis=0))
-                    minor_af_bs[region].append((tmp_af[:nstates,:].sum(axis=0) - tmp_af.max(axis=0))/(tmp_af[:nstates,:].sum(axis=0)+1e-6))
-                    #ind = tmp_af[:nstates,:].sum(axis=0)<0.5
-                    #minor_af_bs[region][-1][ind]=np.nan
-                    #combined_entropy_bs[region][-1][ind]=np.nan
+                weights = patient_bootstrap_counts(len(afs), nbootstraps)
             elif bootstrap_type=='partition':
-                for ii in xrange(nbootstraps//2):
-                    for a in patient_partition(data['af_by_pat'][region]):
-                        tmp_af = af_average(a)
-                        combined_entropy_part[region].append((-np.log2(tmp_af+1e-10)*tmp_af).sum(axis=0))
-                        minor_af_part[region].append((tmp_af[:nstates,:].sum(axis=0) - tmp_af.max(axis=0))/(tmp_af[:nstates,:].sum(axis=0)+1e-6))
+                weights = patient_partition_weights(afs, nbootstraps//2)
+            tmp_af = af_average_weighted(afs_stack, weights)
+            combined_entropy_bs[region] = (-np.log2(tmp_af+1e-10)*tmp_af).sum(axis=1)
+            minor_af_bs[region] = (tmp_af[:,:nstates,:].sum(axis=1) - tmp_af.max(axis=1))/(tmp_af[:,:nstates,:].sum(axis=1)+1e-6)
 
     output = {'combined_af': combined_af,
               'combined_entropy': combined_entropy,
@@ -261,7 +329,7 @@ def scatter_vs_entropy(region, data_to_scatter, synnonsyn, reference,
     vs cross-sectional entropy. In addition, the function return the
     enrichment of nonsyn mutations in the high entropy, low input data corner
     '''
-    xsS = np.array([reference.entropy[ii] for ii in reference.annotation[region]])
+    xsS = get_reference_tracks(reference).get_track('entropy', region)
     ind = (xsS>=0.000)&(~np.isnan(data_to_scatter[region]))
     print(region)
     print("Pearson:", pearsonr(data_to_scatter[region][ind], xsS[ind]))
@@ -324,36 +392,34 @@ def fraction_diverse(region, minor_af, synnonsyn, fname=None):
         plt.savefig(fname)
 
 
-def fitness_correlation_vs_npat(region, data, reference):
+def fitness_correlation_vs_npat(region, data, reference, nsubsets=20):
     '''
     evaluate entropy within/cross-sectional correlation for subsets of patients
     of different size. returns a dictionary with rank correlation coefficients
-    where the keys are number of patients. Each entry is  alist of different
-    patient boot straps
+    where the keys are number of patients. Each entry is a list over patient
+    subsets, all subsets are averaged with one weight matrix, see
+    patient_subset_weights
     '''
-    from scipy.special import binom
-    from random import sample
     from collections import defaultdict
     pats = data['af_by_pat'][region].keys()
-    N = len(pats)
-    within_cross_correlation = defaultdict(list)
-    xsS = np.array([reference.entropy[ii] for ii in reference.annotation[region]])
-    for n in range(2,1+N):
-        for ii in range(int(min(2*binom(N,n),20))):
-            subset = [data['af_by_pat'][region][x] for x in sample(pats, n)]
-            tmp_af = af_average(subset)
-            minor_af_subset = 1.0 - tmp_af.max(axis=0)
-            fit_cost = data['mut_rate'][region]/(minor_af_subset+af_cutoff)
-            #withS = -(np.log2(tmp_af+1e-10)*tmp_af).sum(axis=0)
-            #ind = (xsS>=0.000)&(~np.isnan(withS))
-            #within_cross_correlation[n].append(spearmanr(xsS[ind], withS[ind])[0])
-            ind = (xsS>=0.000)&(~np.isnan(fit_cost))
-            within_cross_correlation[n].append(spearmanr(xsS[ind], fit_cost[ind])[0])
+    afs = np.array([data['af_by_pat'][region][pat] for pat in pats])
+    weights, sizes = patient_subset_weights(len(pats), nsubsets=nsubsets)
+    xsS = get_reference_tracks(reference).get_track('entropy', region)
+    # blocks of subsets bound the size of the (subsets, states, L) averages
+    rho = []
+    for block in xrange(0, len(weights), 200):
+        tmp_af = af_average_weighted(afs, weights[block:block+200])
+        minor_af_subset = 1.0 - tmp_af.max(axis=1)
+        fit_cost = data['mut_rate'][region]/(minor_af_subset+af_cutoff)
+        rho.extend(spearman_rows(xsS, fit_cost, mask=xsS>=0.000))
 
+    within_cross_correlation = defaultdict(list)
+    for n, r in izip(sizes, rho):
+        within_cross_correlation[n].append(r)
     return within_cross_correlation
 
 
-def FitCorr_vs_Npat(data, reference, minor_af, figname=None, label_str=''):
+def FitCorr_vs_Npat(data, reference, minor_af, figname=None, label_str='', nsubsets=20):
     '''
     calculate cross-sectional and fitness cost correlations
     for many subsets of patients and plot the average rank correlation
@@ -364,7 +430,7 @@ def FitCorr_vs_Npat(data, reference, minor_af, figname=None, label_str=''):
     plt.suptitle('Nucleotide fitness costs -- '
                  + ('subtype B' if args.subtype=='B' else 'group M'), fontsize=fs*1.2)
     for region in ['gag', 'pol', 'vif', 'nef']:
-        xsS_within_corr = fitness_correlation_vs_npat(region, data, reference)
+        xsS_within_corr = fitness_correlation_vs_npat(region, data, reference, nsubsets=nsubsets)
         npats = sorted(xsS_within_corr.keys())
         avg_corr = [np.mean(xsS_within_corr[i]) for i in npats]
         std_corr = [np.std(xsS_within_corr[i]) for i in npats]
@@ -382,7 +448,7 @@ def FitCorr_vs_Npat(data, reference, minor_af, figname=None, label_str=''):
     region='pol'
     s = data['mut_rate'][region]/(minor_af[region]+af_cutoff)
     s[s>1] = 1
-    xsS = np.array([reference.entropy[ii] for ii in reference.annotation[region]])
+    xsS = get_reference_tracks(reference).get_track('entropy', region)
     ind = (xsS>=0.000)&(~np.isnan(s))
     axs[1].scatter(s[ind]+.00003, xsS[ind]+.01, s=20)
     corr = spearmanr(s[ind], xsS[ind])
@@ -543,7 +609,7 @@ def fitnesscost_vs_entropy(regions,  minor_af, synnonsyn, mut_rate, reference,
         s=[]
         entropy = []
         for region in regions:
-            xsS = np.array([reference.entropy[ii] for ii in reference.annotation[region]])
+            xsS = get_reference_tracks(reference).get_track('entropy', region)
             ind = synnonsyn[region] if label_str=='synonymous' else ~synnonsyn[region]
             if label_str == 'all': ind = xsS>=0
             s.append(mut_rate[region][ind]/(minor_af[region][ind]+af_cutoff))
@@ -697,53 +763,31 @@ def export_fitness_cost(data, synnonsyn, subtype, reference):
     '''Calculate and export per-site fitness costs (no average)'''
     from scipy.stats import scoreatpercentile
 
-    def sel_out(s):
-        '''Output formatter for selection coefficients'''
-        def round_sig(x, sig=2):
-            '''Round selection coefficient to 2 significant digits'''
-            return round(x, sig - int(np.floor(np.log10(x))) - 1)
-
-        if s<0.001:
-            return '<0.001'
-        elif s>0.1:
-            return '>0.1'
-        elif np.isnan(s):
-            return s
-        else:
-            return round_sig(s)
-
+    tracks = get_reference_tracks(reference)
+    seq = np.array(list(reference.seq))
+    consensus = np.array(list(reference.consensus))
     for region in data['af_by_pat']:
         av = process_average_allele_frequencies(data, [region],
                         nbootstraps=100, bootstrap_type='bootstrap')
-        combined_af = av['combined_af']
-        combined_entropy = av['combined_entropy']
-        minor_af = av['minor_af']
-        combined_entropy_bs = av['combined_entropy_bs']
         minor_af_bs = av['minor_af_bs']
 
         minor_af_array=np.array(minor_af_bs[region])
         qtiles = np.vstack([scoreatpercentile(minor_af_array, x, axis=0) for x in [75, 50, 25]])
         scb = (data['mut_rate'][region]/(af_cutoff+qtiles))
 
-        ref_seq = [reference.seq[pos] for pos in reference.annotation[region]]
-        cons_seq = [reference.consensus[pos] for pos in reference.annotation[region]]
-
+        positions = tracks.get_positions(region)
+        save_fitness_cost_table('../data/fitness_pooled/nuc_'+region+'_selection_coeffcients_'+ subtype +'.tsv',
+                                'selection coefficients in '+region, reference.refname,
+                                consensus[positions], seq[positions], scb,
+                                syn=synnonsyn[region])
 
-        with open('../data/fitness_pooled/nuc_'+region+'_selection_coeffcients_'+ subtype +'.tsv','w') as selfile:
-            selfile.write('### selection coefficients in '+region+'\n')
-            selfile.write('\t'.join(['# position','consensus', reference.refname,
-                                    'lower quartile','median','upper quartile','syn'])+'\n')
 
-            for pos in xrange(scb.shape[1]):
-                selfile.write('\t'.join(map(str,[pos+1, cons_seq[pos], ref_seq[pos]]
-                            +[sel_out(scb[qi][pos]) for qi in range(scb.shape[0])]
-                            +[int(synnonsyn[region][pos])]))+'\n')
-
-
-def collect_data(patient_codes, regions, reference, synnonsyn=True):
+def collect_data(patient_codes, regions, reference, synnonsyn=True, jobs=1, regenerate=False):
     '''
     loop over regions and produce a dictionary that contains the frequencies,
-    syn/nonsyn designations and mutation rates
+    syn/nonsyn designations and mutation rates. With jobs > 1, the regions and
+    patients are processed in parallel worker processes. With regenerate, the
+    cached per-patient data are computed again
     '''
     cov_min=500
     combined_af_by_pat={}
@@ -758,13 +802,35 @@ def collect_data(patient_codes, regions, reference, synnonsyn=True):
         print(pcode)
         p = Patient.load(pcode)
         patients.append(p)
+
+    # every region and patient is independent, trajectories are read memory
+    # mapped from the cache by each worker
+    tasks = [(region, pi) for region in regions for pi in xrange(len(patients))]
+    # build and open the reference tracks once, before the workers fork
+    get_reference_tracks(reference, regenerate=regenerate)
+    collect_shared.update({'patients': patients, 'reference': reference,
+                           'synnonsyn': synnonsyn, 'regenerate': regenerate})
+    try:
+        results = map_jobs(collect_weighted_afs_task, tasks, jobs=jobs)
+    finally:
+        collect_shared.clear()
+
+    for region in regions:
+        combined_af_by_pat[region] = {}
+        syn_nonsyn_by_pat[region] = {}
+        syn_nonsyn_by_pat_unconstrained[region] = {}
+    for (region, pi), (af, syn, syn_uc) in izip(tasks, results):
+        pcode = patients[pi].name
+        combined_af_by_pat[region][pcode] = af
+        if synnonsyn:
+            syn_nonsyn_by_pat[region][pcode] = syn
+            syn_nonsyn_by_pat_unconstrained[region][pcode] = syn_uc
+
     for region in regions:
         if region=="genomewide":
             region_seq = "".join(reference.consensus)
         else:
             region_seq = reference.annotation[region].extract("".join(reference.consensus))
-        combined_af_by_pat[region], syn_nonsyn_by_pat[region], syn_nonsyn_by_pat_unconstrained[region] \
-            = collect_weighted_afs(region, patients, reference, synnonsyn=synnonsyn)
         consensus_mutation_rate[region] = np.array([total_muts[nuc] if nuc not in ['-', 'N'] else np.nan
                                                     for nuc in region_seq])
 
@@ -781,14 +847,16 @@ if __name__=="__main__":
                         help="regenerate data")
     parser.add_argument('--subtype', choices=['B', 'any'], default='B',
                         help='subtype to compare against')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes for collecting the data')
     args = parser.parse_args()
 
     # NOTE: HXB2 alignment has way more sequences resulting in better correlations
     reference = HIVreference(refname='HXB2', subtype=args.subtype)
 
     # Intermediate data are saved to file for faster access later on
-    fn = '../data/fitness_pooled/avg_nucleotide_allele_frequency_st_'+args.subtype+'.pickle.gz'
-    if not os.path.isfile(fn) or args.regenerate:
+    fn = '../data/fitness_pooled/avg_nucleotide_allele_frequency_st_'+args.subtype
+    if not has_pooled_data(fn) or args.regenerate:
         if args.subtype=='B':
             #patient_codes = ['p2','p3', 'p5', 'p8', 'p9','p10', 'p11'] # subtype B only, no p4/p7
             patient_codes = ['p2','p3', 'p5', 'p7', 'p8', 'p9','p10', 'p11'] # subtype B only, no p4
@@ -796,17 +864,16 @@ if __name__=="__main__":
             #patient_codes = ['p1', 'p2','p3','p5','p6', 'p8', 'p9','p10', 'p11'] # all subtypes, no p4/7
             patient_codes = ['p1', 'p2','p3', 'p5','p6','p7', 'p8', 'p9','p10', 'p11'] # patients, no p4
 
-        data = collect_data(patient_codes, regions, reference)
+        data = collect_data(patient_codes, regions, reference, jobs=args.jobs,
+                            regenerate=args.regenerate)
         try:
-            with gzip.open(fn, 'w') as ofile:
-                cPickle.dump(data, ofile)
+            save_pooled_data(data, fn)
             print('Data saved to file:', os.path.abspath(fn))
-        except IOError:
+        except (IOError, OSError):
             print('Could not save data to file:', os.path.abspath(fn))
 
     else:
-        with gzip.open(fn) as ifile:
-            data = cPickle.load(ifile)
+        data = load_pooled_data(fn, regions=regions)
 
     # Check whether all regions are present
     if not all([region in data['mut_rate'] for region in regions]):
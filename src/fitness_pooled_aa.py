@@ -25,8 +25,14 @@ from hivevo.patients import Patient
 from hivevo.sequence import alphaal
 from hivevo.HIVreference import HIVreferenceAminoacid, HIVreference
 from hivevo.af_tools import divergence
-from util import add_panel_label
+from util import add_panel_label, map_jobs, spearman_rows, save_fitness_cost_table
+from util import patient_bootstrap_counts
+from trajectory_cache import get_allele_frequency_trajectories
+from pooled_store import has_pooled_data, load_pooled_data, save_pooled_data
+from codons import codon_indices, codons as all_codons
+from aa_rate_table import load_aa_rate_tables
 from fitness_pooled import process_average_allele_frequencies, draw_genome, af_average, get_final_state, load_mutation_rates
+from fitness_pooled import patient_subset_weights
 
 
 
@@ -62,43 +68,96 @@ offsets = {
 }
 
 
-def aminoacid_mutation_rate(initial_codon, der, nuc_muts, doublehit=False):
-    from Bio.Seq import CodonTable
-    CT = CodonTable.standard_dna_table.forward_table
-    targets = [x for x,a in CT.iteritems() if a==der]
-    #print(CT[initial_codon], initial_codon, targets)
-    mut_rate=0
-    for codon in targets:
-        nmuts = sum([a!=d for a,d in zip(initial_codon, codon)])
-        mut_rate+=np.prod([nuc_muts[a+'->'+d] for a,d in
-                    zip(initial_codon, codon) if a!=d])*((nmuts==1) or doublehit)
-        #print(mut_rate, [nuc_muts[a+'->'+d] for a,d in zip(initial_codon, codon) if a!=d])
-
-    return mut_rate
-
-
-def calc_amino_acid_mutation_rates():
-    from Bio.Seq import CodonTable
-
-    nuc_mutation_rates = load_mutation_rates()['mu']
-
-    CT = CodonTable.standard_dna_table.forward_table
-    aa_mutation_rates = defaultdict(float)
-    total_mutation_rates = defaultdict(float)
-    for codon in CT:
-        aa1 = CT[codon]
-        for aa2 in alphaal:
-            if aa1!=aa2:
-                aa_mutation_rates[(codon,aa2)] += aminoacid_mutation_rate(codon, aa2, nuc_mutation_rates)
+def collect_weighted_aa_afs_patient(region, p, reference, cov_min=1000, max_div=0.05):
+    '''
+    produce the weighted average of amino acid frequencies for all late samples of one
+    patient, see collect_weighted_aa_afs. Returns the summed frequencies, the initial
+    codons and the phenotypes at reference positions
+    '''
+    phenos = {'disorder':np.zeros(len(reference.entropy)),
+              'accessibility':np.zeros(len(reference.entropy)),
+              'structural':np.zeros(len(reference.entropy))}
 
-    for codon,aa1 in CT.iteritems():
-        for pos in range(3):
-            for nuc in 'ACTG':
-                new_codon= codon[:pos]+nuc+codon[(pos+1):]
-                if new_codon in CT:
-                    if aa1!=CT[new_codon]:
-                        total_mutation_rates[codon]+=nuc_mutation_rates[codon[pos]+'->'+nuc]
-    return aa_mutation_rates, total_mutation_rates
+    good_pos_in_reference = reference.get_ungapped(threshold = 0.05)
+    combined_af = np.zeros(reference.af.shape)
+    aft = get_allele_frequency_trajectories(p, region, cov_min=cov_min, type='aa', error_rate=ERR_RATE)
+
+    # get patient to subtype map and initial aa and nuc sequence
+    patient_to_subtype = p.map_to_external_reference_aminoacids(region, refname = reference.refname)
+    init_nuc_sec = "".join(p.get_initial_sequence(region))
+    consensus = reference.get_consensus_indices_in_patient_region(patient_to_subtype)
+    ref_ungapped = good_pos_in_reference[patient_to_subtype[:,0]]
+
+    # remember the codon at each reference position to be able to calculate mutation rates later
+    # as indices into the codon table of codons.py, -1 if missing
+    init_nuc_sec += 'N'*(-len(init_nuc_sec)%3)
+    init_codons = np.array(list(init_nuc_sec)).reshape(-1,3)
+    initial_codons = -np.ones(reference.af.shape[1], dtype=np.int8)
+    initial_codons[patient_to_subtype[:,0]] = codon_indices(init_codons[patient_to_subtype[:,1]])
+
+    ancestral = p.get_initial_indices(region, type='aa')[patient_to_subtype[:,1]]
+    rare = ((aft[:,:21,:]**2).sum(axis=1).min(axis=0)>max_div)[patient_to_subtype[:,1]]
+    #final = aft[-1].argmax(axis=0)[patient_to_subtype[:,1]]
+    final = get_final_state(aft[:,:,patient_to_subtype[:,1]])
+
+    do=[]
+    acc=[]
+    struct=[]
+    for pos in p.annotation[region]:
+        if pos%3==1: # extract phenotypes for each
+            try:
+                do.append(np.mean(p.pos_to_feature[pos]['disorder'].values()))
+            except:
+                do.append(None)
+            try:
+                struct.append(np.mean(p.pos_to_feature[pos]['structural'].values()))
+            except:
+                struct.append(None)
+            try:
+                acc.append(np.mean(p.pos_to_feature[pos]['accessibility'].values()))
+            except:
+                acc.append(None)
+    do = np.array(map(lambda x:0.0 if x is None else x, do))
+    phenos['disorder'][patient_to_subtype[:,0]]+= do[patient_to_subtype[:,1]]
+
+    acc = np.array(map(lambda x:0.0 if x is None else x, acc))
+    phenos['accessibility'][patient_to_subtype[:,0]]+= acc[patient_to_subtype[:,1]]
+
+    struct = np.array(map(lambda x:0.0 if x is None else x, struct))
+    phenos['structural'][patient_to_subtype[:,0]]+= struct[patient_to_subtype[:,1]]
+
+    for af, ysi, depth in izip(aft, p.ysi, p.n_templates_dilutions):
+        if ysi<SAMPLE_AGE_CUTOFF:
+            continue
+        pat_af = af[:,patient_to_subtype[:,1]]
+        patient_consensus = pat_af.argmax(axis=0)
+        ind = ref_ungapped&rare&(patient_consensus==consensus)&(ancestral==consensus)&(final==consensus)
+        if pat_af.mask.any():
+            ind = ind&(~pat_af.mask.any(axis=0))
+        if ind.sum()==0:
+            continue
+        w = depth/(1.0+depth/WEIGHT_CUTOFF)
+        combined_af[:,patient_to_subtype[ind,0]] \
+                    += w*pat_af[:-1,ind]
+    return combined_af, initial_codons, phenos
+
+
+def merge_weighted_aa_afs(pcodes, results):
+    '''Combine the per patient results of collect_weighted_aa_afs_patient of one region'''
+    combined_af_by_pat = {}
+    initial_codons_by_pat = {}
+    combined_phenos = {}
+    for pcode, (af, initial_codons, phenos) in izip(pcodes, results):
+        combined_af_by_pat[pcode] = af
+        initial_codons_by_pat[pcode] = initial_codons
+        for pheno, x in phenos.iteritems():
+            if pheno in combined_phenos:
+                combined_phenos[pheno] += x
+            else:
+                combined_phenos[pheno] = np.copy(x)
+    for pheno in combined_phenos:
+        combined_phenos[pheno]/=len(pcodes)
+    return combined_af_by_pat, initial_codons_by_pat, combined_phenos
 
 
 def collect_weighted_aa_afs(region, patients, reference, cov_min=1000, max_div=0.05):
@@ -106,77 +165,25 @@ def collect_weighted_aa_afs(region, patients, reference, cov_min=1000, max_div=0
     produce weighted averages of allele frequencies for all late samples in each patients
     restrict to sites that don't sweep and have limited diversity as specified by max_div
     '''
-    combined_af_by_pat = {}
-    initial_codons_by_pat={}
-    combined_phenos = {'disorder':np.zeros(len(reference.entropy)),
-                        'accessibility':np.zeros(len(reference.entropy)),
-                        'structural':np.zeros(len(reference.entropy))}
+    results = [collect_weighted_aa_afs_patient(region, p, reference, cov_min=cov_min, max_div=max_div)
+               for p in patients]
+    return merge_weighted_aa_afs([p.name for p in patients], results)
 
-    good_pos_in_reference = reference.get_ungapped(threshold = 0.05)
-    for pi, p in enumerate(patients):
-        pcode = p.name
-        combined_af_by_pat[pcode] = np.zeros(reference.af.shape)
-        aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min, type='aa', error_rate=ERR_RATE)
-
-        # get patient to subtype map and initial aa and nuc sequence
-        patient_to_subtype = p.map_to_external_reference_aminoacids(region, refname = reference.refname)
-        init_nuc_sec = "".join(p.get_initial_sequence(region))
-        consensus = reference.get_consensus_indices_in_patient_region(patient_to_subtype)
-        ref_ungapped = good_pos_in_reference[patient_to_subtype[:,0]]
-
-        # remember the codon at each reference position to be able to calculate mutation rates later
-        initial_codons_by_pat[pcode] = {ci:init_nuc_sec[ii*3:(ii+1)*3] for ci, ii in patient_to_subtype}
-
-        ancestral = p.get_initial_indices(region, type='aa')[patient_to_subtype[:,1]]
-        rare = ((aft[:,:21,:]**2).sum(axis=1).min(axis=0)>max_div)[patient_to_subtype[:,1]]
-        #final = aft[-1].argmax(axis=0)[patient_to_subtype[:,1]]
-        final = get_final_state(aft[:,:,patient_to_subtype[:,1]])
-
-        do=[]
-        acc=[]
-        struct=[]
-        for pos in p.annotation[region]:
-            if pos%3==1: # extract phenotypes for each
-                try:
-                    do.append(np.mean(p.pos_to_feature[pos]['disorder'].values()))
-                except:
-                    do.append(None)
-                try:
-                    struct.append(np.mean(p.pos_to_feature[pos]['structural'].values()))
-                except:
-                    struct.append(None)
-                try:
-                    acc.append(np.mean(p.pos_to_feature[pos]['accessibility'].values()))
-                except:
-                    acc.append(None)
-        do = np.array(map(lambda x:0.0 if x is None else x, do))
-        combined_phenos['disorder'][patient_to_subtype[:,0]]+= do[patient_to_subtype[:,1]]
-
-        acc = np.array(map(lambda x:0.0 if x is None else x, acc))
-        combined_phenos['accessibility'][patient_to_subtype[:,0]]+= acc[patient_to_subtype[:,1]]
-
-        struct = np.array(map(lambda x:0.0 if x is None else x, struct))
-        combined_phenos['structural'][patient_to_subtype[:,0]]+= struct[patient_to_subtype[:,1]]
-
-        for af, ysi, depth in izip(aft, p.ysi, p.n_templates_dilutions):
-            if ysi<SAMPLE_AGE_CUTOFF:
-                continue
-            pat_af = af[:,patient_to_subtype[:,1]]
-            patient_consensus = pat_af.argmax(axis=0)
-            ind = ref_ungapped&rare&(patient_consensus==consensus)&(ancestral==consensus)&(final==consensus)
-            if pat_af.mask.any():
-                ind = ind&(~pat_af.mask.any(axis=0))
-            if ind.sum()==0:
-                continue
-            w = depth/(1.0+depth/WEIGHT_CUTOFF)
-            combined_af_by_pat[pcode][:,patient_to_subtype[ind,0]] \
-                        += w*pat_af[:-1,ind]
-    for pheno in combined_phenos:
-        combined_phenos[pheno]/=len(patients)
-    return combined_af_by_pat, initial_codons_by_pat, combined_phenos
+
+# patients and references shared with the worker processes of collect_data
+# (inherited via fork, so they are not pickled for every task)
+collect_shared = {}
+
+
+def collect_weighted_aa_afs_task(task):
+    '''Run collect_weighted_aa_afs_patient for one (region, patient index) task'''
+    region, pi = task
+    return collect_weighted_aa_afs_patient(region, collect_shared['patients'][pi],
+                                           collect_shared['references'][region],
+                                           cov_min=collect_shared['cov_min'])
 
 
-def collect_data(patient_codes, regions, subtype):
+def collect_data(patient_codes, regions, subtype, jobs=1):
     cov_min=500
     combined_af_by_pat={}
     initial_codons_by_pat={}
@@ -191,10 +198,22 @@ def collect_data(patient_codes, regions, subtype):
         except:
             print("Can't load patient", pcode)
 
-    for region in regions:
-        reference = HIVreferenceAminoacid(region, refname=aa_ref, subtype = subtype)
+    references = {region: HIVreferenceAminoacid(region, refname=aa_ref, subtype = subtype)
+                  for region in regions}
+
+    # every region and patient is independent, see fitness_pooled.collect_data
+    tasks = [(region, pi) for region in regions for pi in xrange(len(patients))]
+    collect_shared.update({'patients': patients, 'references': references,
+                           'cov_min': cov_min})
+    try:
+        results = map_jobs(collect_weighted_aa_afs_task, tasks, jobs=jobs)
+    finally:
+        collect_shared.clear()
+
+    pcodes = [p.name for p in patients]
+    for ri, region in enumerate(regions):
         combined_af_by_pat[region], initial_codons_by_pat[region], combined_phenos[region] =\
-            collect_weighted_aa_afs(region, patients, reference, cov_min=cov_min)
+            merge_weighted_aa_afs(pcodes, results[ri*len(patients):(ri+1)*len(patients)])
 
     return {'af_by_pat':combined_af_by_pat, 'init_codon': initial_codons_by_pat, 'pheno':combined_phenos}
 
@@ -429,36 +448,30 @@ def phenotype_scatter(region, data_to_scatter, phenotype, phenotype_name, fname
 
 
 def correlation_vs_npat(pheno, region, data, reference, total_nonsyn_mutation_rates,
-                        with_entropy=False):
+                        with_entropy=False, nsubsets=20):
     '''
     evaluate entropy within/cross-sectional correlation for subsets of patients
     of different size. returns a dictionary with rank correlation coefficients
     '''
-    from scipy.special import binom
-    from random import sample
-    from collections import defaultdict
     pats = data['af_by_pat'][region].keys()
-    N = len(pats)
     within_cross_correlation = defaultdict(list)
     if pheno=='entropy':
         xsS = reference.entropy+1e-10
     else:
         xsS = np.array(data['pheno'][region][pheno])
 
-    for n in range(2,1+N):
-        for ii in range(int(min(2*binom(N,n),20))):
-            subset = [x for x in sample(pats, n)]
-            #subset = [data['af_by_pat'][region][x] for x in sample(pats, n)]
-            #tmp_af = af_average(subset)
-            #withS = -(np.log2(tmp_af+1e-10)*tmp_af).sum(axis=0)
-            withS = fitness_costs_per_site(region, data, total_nonsyn_mutation_rates, patient_subset=subset)
-            ind = (xsS>0.000)&(~np.isnan(withS))
-            within_cross_correlation[n].append(spearmanr(xsS[ind], withS[ind])[0])
+    weights, sizes = patient_subset_weights(len(pats), nsubsets=nsubsets)
+    withS = fitness_costs_per_site(region, data, total_nonsyn_mutation_rates,
+                                   patient_subset=pats, weights=weights)
+    rho = spearman_rows(xsS, withS, mask=xsS>0.000)
+    for n, r in izip(sizes, rho):
+        within_cross_correlation[n].append(r)
 
     return within_cross_correlation
 
 
-def PhenoCorr_vs_Npat(pheno, data, total_nonsyn_mutation_rates, associations, figname=None, label_str=''):
+def PhenoCorr_vs_Npat(pheno, data, total_nonsyn_mutation_rates, associations, figname=None, label_str='',
+                      nsubsets=20):
     '''
     calculate cross-sectional and within patient entropy correlations
     for many subsets of patients and plot the average rank correlation
@@ -469,7 +482,8 @@ def PhenoCorr_vs_Npat(pheno, data, total_nonsyn_mutation_rates, associations, fi
                  + ('subtype B' if args.subtype=='B' else 'group M'), fontsize=fs*1.2)
     for region in ['gag', 'pol', 'vif', 'nef']:
         reference = HIVreferenceAminoacid(region, refname=aa_ref, subtype = args.subtype)
-        cost_pheno_corr = correlation_vs_npat(pheno, region, data, reference, total_nonsyn_mutation_rates)
+        cost_pheno_corr = correlation_vs_npat(pheno, region, data, reference, total_nonsyn_mutation_rates,
+                                              nsubsets=nsubsets)
         npats = sorted(cost_pheno_corr.keys())
         avg_corr = [np.mean(cost_pheno_corr[i]) for i in npats]
         std_corr = [np.std(cost_pheno_corr[i]) for i in npats]
@@ -516,85 +530,153 @@ def PhenoCorr_vs_Npat(pheno, data, total_nonsyn_mutation_rates, associations, fi
             plt.savefig(figname+'.'+ext)
 
 
-def fitness_cost_mutation(region, data, aa_mutation_rates, pos, target_aa, nbootstraps=0):
+def get_initial_codon_matrix(data, region, pats):
+    '''
+    return the (P, L_aa) int8 matrix of initial codons of patients at reference positions,
+    as indices into the codon table of codons.py, -1 if missing or ambiguous. Data
+    collected with dicts of reference position -> codon string are converted
+    '''
+    L = data['af_by_pat'][region][pats[0]].shape[1]
+    codon_matrix = -np.ones((len(pats), L), dtype=np.int8)
+    for pi, pat in enumerate(pats):
+        init_codons = data['init_codon'][region][pat]
+        if isinstance(init_codons, dict):
+            if len(init_codons):
+                pos = np.array(init_codons.keys(), dtype=int)
+                cods = np.array([list(cod.ljust(3, '-')) for cod in init_codons.values()])
+                codon_matrix[pi, pos] = codon_indices(cods)
+        else:
+            codon_matrix[pi] = init_codons
+    return codon_matrix
+
+
+def get_codon_rate_vector(codon_rates):
+    '''
+    convert a dict of codon -> rate to an array in the order of the codon table of codons.py,
+    arrays (e.g. from aa_rate_table.load_aa_rate_tables) are returned as is
+    '''
+    if not isinstance(codon_rates, dict):
+        return np.asarray(codon_rates)
+    return np.array([codon_rates.get(cod, 0.0) for cod in all_codons])
+
+
+def get_site_rates(codon_matrix, rate_vector):
+    '''per site rates from the initial codon indices, NaN where the codon is missing'''
+    rates = rate_vector[codon_matrix]
+    rates[codon_matrix<0] = np.nan
+    return rates
+
+
+def fitness_costs_mutations(queries, data, aa_rate_table, nbootstraps=0,
+                            percentiles=[5, 25, 50, 75, 95]):
     '''
-    determine the fitness cost associated with a particular amino acid mutations such as K103N
+    determine the fitness costs associated with particular amino acid mutations such as K103N
     this requires specification of the target amino acid and a specific calculation of
     the mutation rate into the amino acid, which requires the ancestral codon present in
-    each individual patient
-    '''
-    def s(pats):
-        # calcute nu/mu for each patient with patient specific mutation rates excluding double hit mutations
-        nu_over_mu = [minor_af_by_pat[pat]/aa_mutation_rates[(codons[pat][pos],target_aa)] for pat in pats
-                     if aa_mutation_rates[(codons[pat][pos],target_aa)]>0]
-        # return the inverse, i.e. essentially the harmonic mean
-        if len(nu_over_mu):
-            savg = 1.0/max(0.01, np.mean(nu_over_mu))
-        else:
-            savg=np.nan
-        return savg
+    each individual patient. All mutations are computed at once and share the same
+    bootstrap replicates of patients.
 
-    target_ii = alphaal.index(target_aa)
-    codons = data['init_codon'][region]
-    minor_af_by_pat = {pat: x[target_ii,pos].sum(axis=0)/x[:20,pos].sum(axis=0)
-                        for pat, x in data['af_by_pat'][region].iteritems() if pos in codons[pat]}
-    all_patients = minor_af_by_pat.keys()
+    queries         --  list of (region, position, target amino acids), several target
+                        amino acids (e.g. 'HRK') are pooled
+    aa_rate_table   --  (64, len(alphaal)) rates from codons to amino acids, e.g.
+                        aa_rate_table.load_aa_rate_tables()['single'] to exclude double hits
+    nbootstraps     --  number of bootstrap replicates over patients
+
+    returns the fitness costs (n_queries,), or their percentiles across bootstrap
+    replicates (n_queries, n_percentiles)
+    '''
+    regions = sorted(set(region for region, pos, target_aa in queries))
+    pats = sorted(set(pat for region in regions for pat in data['af_by_pat'][region]))
+    nu = np.repeat(np.nan, len(queries)*len(pats)).reshape(len(queries), len(pats))
+    mu = np.zeros_like(nu)
+    for region in regions:
+        qis = np.array([qi for qi, q in enumerate(queries) if q[0]==region])
+        poss = np.array([queries[qi][1] for qi in qis])
+        targets = np.zeros((len(qis), len(alphaal)))
+        for ti, qi in enumerate(qis):
+            targets[ti, [alphaal.index(aa) for aa in queries[qi][2]]] = 1
+
+        region_pats = [pat for pat in pats if pat in data['af_by_pat'][region]]
+        pis = np.array([pats.index(pat) for pat in region_pats])
+        x = np.array([data['af_by_pat'][region][pat][:,poss] for pat in region_pats])
+        codon_matrix = get_initial_codon_matrix(data, region, region_pats)[:,poss]
+
+        # minor frequency and patient specific mutation rate into the target amino acids
+        minor_af = (x*targets[:,:x.shape[1]].T).sum(axis=1)/x[:,:20].sum(axis=1)
+        rates = aa_rate_table.dot(targets.T)[codon_matrix, np.arange(len(qis))]
+        has_codon = codon_matrix>=0
+        nu[np.ix_(qis, pis)] = np.where(has_codon, minor_af, np.nan).T
+        mu[np.ix_(qis, pis)] = np.where(has_codon, rates, 0).T
 
     if nbootstraps:
-        s_bs = []
-        for bi in xrange(nbootstraps):
-            tmp_s = s([all_patients[pi] for pi in np.random.randint(len(all_patients), size=len(all_patients))])
-            if not np.isnan(tmp_s):
-                s_bs.append(tmp_s)
-        if len(s_bs):
-            s_out = [np.percentile(s_bs, perc) for perc in [5, 25, 50, 75,95]]
-        else:
-            s_out = [np.nan for perc in [5, 25, 50, 75,95]]
+        weights = patient_bootstrap_counts(len(pats), nbootstraps).astype(float)
     else:
-        s_out = s(all_patients)
-    return s_out
+        weights = np.ones((1, len(pats)))
+
+    # average nu/mu over the patients with a codon that can mutate into the target, the
+    # inverse is essentially the harmonic mean. Patients without frequency data make the
+    # average NaN, which gives the maximal cost as before
+    valid = mu>0
+    nu_over_mu = nu/np.where(valid, mu, 1)
+    no_data = valid&np.isnan(nu_over_mu)
+    n_pats = weights.dot(valid.T)
+    avg = weights.dot(np.where(valid&(~no_data), nu_over_mu, 0).T)/np.maximum(n_pats, 1)
+    avg[weights.dot(no_data.T)>0] = np.nan
+    s_bs = 1.0/np.fmax(0.01, avg)
+    s_bs[n_pats==0] = np.nan
+
+    if nbootstraps:
+        return np.array([[np.percentile(s_q[~np.isnan(s_q)], perc) if (~np.isnan(s_q)).any() else np.nan
+                          for perc in percentiles] for s_q in s_bs.T])
+    else:
+        return s_bs[0]
 
 
 def fitness_costs_per_site(region,data, total_nonsyn_mutation_rates,
-                           nbootstraps=None, patient_subset = None):
+                           nbootstraps=None, patient_subset = None, weights=None):
     '''
-    function that returns amino acid fitness costs in a specific region
+    function that returns amino acid fitness costs in a specific region.
+    weights (n_sets, n_patients) of the patients in patient_subset give
+    the costs of many patient sets at once, instead of bootstraps
     '''
     if patient_subset is None:
         patient_subset=data['af_by_pat'][region].keys()
-    codons = data['init_codon'][region]
-    minor_af_by_pat = {}
+    minor_af = []
     for pat in patient_subset:
         x = data['af_by_pat'][region][pat]
-        minor_af_by_pat[pat]= (x[:20,:].sum(axis=0) - x[:20,:].max(axis=0))/(x[:20,:].sum(axis=0))
-
-    if nbootstraps is None:
-        pat_sets = [patient_subset]
+        minor_af.append((x[:20,:].sum(axis=0) - x[:20,:].max(axis=0))/(x[:20,:].sum(axis=0)))
+
+    # nu/mu of all patients at once, NaN where the initial codon is missing
+    codon_matrix = get_initial_codon_matrix(data, region, patient_subset)
+    nu_over_mu = np.array(minor_af)/get_site_rates(codon_matrix,
+                                    get_codon_rate_vector(total_nonsyn_mutation_rates))
+
+    # all patient sets as a (B, P) matrix of patient counts
+    single_set = (weights is None) and (nbootstraps is None)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+    elif nbootstraps is None:
+        weights = np.ones((1, len(patient_subset)))
     else:
-        pats = patient_subset
-        pat_sets = [[pats[ii] for ii in np.random.randint(len(pats), size=len(pats))] for jj in range(nbootstraps)]
-    s_bs = []
-    for pat_set in pat_sets:
-        nu_over_mu = []
-        for pat in pat_set:
-            tmp=[]
-            for pos, nu in enumerate(minor_af_by_pat[pat]):
-                if pos in codons[pat]:
-                    tmp.append(nu/total_nonsyn_mutation_rates[codons[pat][pos]])
-                else:
-                    tmp.append(np.nan)
-
-            nu_over_mu.append(tmp)
-
-        tmp_nu_over_mu = np.ma.array(nu_over_mu)
-        tmp_nu_over_mu.mask = np.isnan(nu_over_mu)
-        tmp_s = 1.0/(tmp_nu_over_mu.mean(axis=0)+0.1)
-        tmp_s[tmp_s.mask] = np.nan
-        s_bs.append(tmp_s)
-    if nbootstraps is None:
-        return s_bs[-1]
+        weights = patient_bootstrap_counts(len(patient_subset), nbootstraps).astype(float)
+
+    # mean over the patients of each set, ignoring NaNs. Sets with infinite
+    # nu/mu (zero rates) have no estimate, as for the masked mean before
+    valid = ~np.isnan(nu_over_mu)
+    infinite = np.isinf(nu_over_mu)
+    finite = valid&(~infinite)
+    tmp_sum = weights.dot(np.where(finite, nu_over_mu, 0))
+    tmp_n = weights.dot(valid)
+    tmp_n[tmp_n==0] = np.nan
+    tmp_mean = tmp_sum/tmp_n
+    tmp_mean[weights.dot(infinite)>0] = np.nan
+    s_bs = 1.0/(tmp_mean+0.1)
+
+    if single_set:
+        # NaN where there is no estimate, but not masked
+        return np.ma.array(s_bs[0], mask=False)
     else:
-        return np.array(s_bs)
+        return s_bs
 
 
 def fitness_costs_distribution(region, data, total_nonsyn_mutation_rates):
@@ -764,31 +846,17 @@ def export_fitness_costs(data, total_nonsyn_mutation_rates, subtype):
     files contain position and 25%, 50% and 75% of 100 bootstrap replicates
     '''
     from scipy.stats import scoreatpercentile
-    def sel_out(s):
-        if s<0.001:
-            return '<0.001'
-        elif s>0.1:
-            return '>0.1'
-        else:
-            return s
 
     for region in data['af_by_pat']:
         reference = HIVreferenceAminoacid(region, refname=aa_ref, subtype = args.subtype)
-        ref_seq = reference.seq.seq.translate()
+        ref_seq = str(reference.seq.seq.translate())
         sel_array = fitness_costs_per_site(region, data,
                             total_nonsyn_mutation_rates, nbootstraps=100)
-        selcoeff={}
-        for q in [25, 50, 75]:
-            selcoeff[q] = scoreatpercentile(sel_array, q, axis=0)
-
-        with open('../data/fitness_pooled_aa/aa_'+region+'_fitness_costs_st_'+subtype+'.tsv','w') as selfile:
-            selfile.write('### fitness costs in '+region+'\n')
-            selfile.write('\t'.join(['# position','consensus', reference.refname,
-                                    'lower quartile','median','upper quartile'])+'\n')
+        selcoeff = np.vstack([scoreatpercentile(sel_array, q, axis=0) for q in [25, 50, 75]])
 
-            for pos in xrange(selcoeff[25].shape[0]):
-                selfile.write('\t'.join(map(str,[pos+1, reference.consensus[pos], ref_seq[pos]]+
-                        [sel_out(selcoeff[q][pos]) for q in [25, 50, 75]]))+'\n')
+        save_fitness_cost_table('../data/fitness_pooled_aa/aa_'+region+'_fitness_costs_st_'+subtype+'.tsv',
+                                'fitness costs in '+region, reference.refname,
+                                reference.consensus, ref_seq, selcoeff, sig=None)
 
 
 
@@ -801,24 +869,24 @@ if __name__=="__main__":
                         help="regenerate data")
     parser.add_argument('--subtype', choices=['B', 'any'], default='B',
                         help='subtype to compare against')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes for collecting the data')
     args = parser.parse_args()
 
-    fn = '../data/fitness_pooled_aa/avg_aa_allele_frequency_st_'+args.subtype+'.pickle.gz'
+    fn = '../data/fitness_pooled_aa/avg_aa_allele_frequency_st_'+args.subtype
 
     regions = ['gag', 'pol', 'nef', 'env', 'vif']
-    if not os.path.isfile(fn) or args.regenerate:
+    if not has_pooled_data(fn) or args.regenerate:
         if args.subtype=='B':
             #patient_codes = ['p2','p3','p5','p8','p9','p10','p11'] # subtype B only
             patient_codes = ['p2','p3', 'p5','p7', 'p8','p9','p10', 'p11'] # patients
         else:
             patient_codes = ['p1','p2','p3', 'p5','p6','p7', 'p8','p9','p10', 'p11'] # patients
             #patient_codes = ['p1','p2','p3','p5','p6','p8','p9','p10', 'p11'] # patients
-        data = collect_data(patient_codes, regions, args.subtype)
-        with gzip.open(fn, 'w') as ofile:
-            cPickle.dump(data, ofile)
+        data = collect_data(patient_codes, regions, args.subtype, jobs=args.jobs)
+        save_pooled_data(data, fn)
     else:
-        with gzip.open(fn) as ifile:
-            data = cPickle.load(ifile)
+        data = load_pooled_data(fn, regions=regions)
 
     # calculate minor variant frequencies and entropy measures
     av = process_average_allele_frequencies(data, regions, nbootstraps=0,nstates=20)
@@ -828,7 +896,7 @@ if __name__=="__main__":
 
     # get association, calculate fitness costs
     associations = get_associations(regions)
-    aa_mutation_rates, total_nonsyn_mutation_rates = calc_amino_acid_mutation_rates()
+    total_nonsyn_mutation_rates = load_aa_rate_tables()['total_nonsyn']
     selcoeff = {}
     for region in regions:
         s = fitness_costs_per_site(region, data, total_nonsyn_mutation_rates)
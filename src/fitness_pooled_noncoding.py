@@ -29,6 +29,9 @@ from hivevo.af_tools import divergence
 
 from fitness_pooled import process_average_allele_frequencies, draw_genome
 from fitness_pooled import af_average, load_mutation_rates, collect_data, running_average
+from pooled_store import has_pooled_data, load_pooled_data, save_pooled_data
+from util import rolling_spearman
+from reference_tracks import get_coordinate_map, lift_over, get_reference_tracks
 
 
 
@@ -251,7 +254,6 @@ def add_RNA_properties_to_reference(reference):
     Sukosd et al
     '''
     from hivevo.external import load_pairing_probability_NL43
-    from hivevo.HIVreference import ReferenceTranslator
     from parse_pairing_probabilities import load_shape
     siegfried = load_pairing_probability_NL43()
     pp = np.zeros(10000)
@@ -261,20 +263,14 @@ def add_RNA_properties_to_reference(reference):
 
     # siegfried et al pairing probabilities are measured for and NL4-3 sequence
     # translate them to the reference in question (HXB2)
-    hxb2_pp = np.zeros(len(reference.seq))
-    rt = ReferenceTranslator(ref1 = reference.refname, ref2='NL4-3')
-    for i, p in enumerate(pp):
-        hxb2_pp[rt.translate(i, 'NL4-3')[1]]=p
-    reference.pp = hxb2_pp
+    L = len(reference.seq)
+    coordinate_map = get_coordinate_map(reference.refname, ref_from='NL4-3')
+    reference.pp = lift_over(pp, coordinate_map, L)
 
     shape = load_shape()
-    shape_array = -999.0*np.ones_like(hxb2_pp)
     field = ['1M7 SHAPE MaP', '1M6 SHAPE MaP', 'NMIA SHAPE MaP'][1]
-    for pos, val in shape.iterrows():
-        r, hxb2pos = rt.translate(pos, 'NL4-3')
-        if np.isnan(hxb2pos) or hxb2pos<0:
-            continue
-        shape_array[hxb2pos] = val[field]
+    shape_array = lift_over(shape.loc[:,field].values, coordinate_map, L,
+                            positions=shape.index.values, fill_value=-999.0)
     reference.shape_values = np.ma.array(shape_array, mask=shape_array<-100)
 
     # load data from Suskod et al NAR.
@@ -283,10 +279,8 @@ def add_RNA_properties_to_reference(reference):
     suskod_data = {}
     offset = 454
     for field in fields:
-        tmp = np.zeros(len(reference.seq))
-        for i, p in enumerate(suskod.loc[:,field]):
-            tmp[rt.translate(i+offset, 'NL4-3')[1]] = p>0
-        suskod_data[field]=tmp
+        suskod_data[field] = lift_over(suskod.loc[:,field].values>0, coordinate_map, L,
+                                       positions=np.arange(len(suskod))+offset)
     reference.suskod = suskod_data
 
 
@@ -313,14 +307,10 @@ def shape_vs_fitness(data, minor_af, shape_data,synnonsyn, ws=100, fname=None, n
     spear = spearmanr(sc[ind], shape_data[ind])
     print("synonymous only correlation:", spear)
 
-    pp_fitness_correlation = []
-    for ii in range(len(sc)-ws):
-        ind = (~np.isnan(sc[ii:ii+ws]))&synnonsyn[ii:ii+ws]
-        cc=0
-        if ind.sum()>ws*0.2:
-            tmp = spearmanr(shape_data[ii:ii+ws][ind], sc[ii:ii+ws][ind])
-            cc = tmp.correlation
-        pp_fitness_correlation.append(cc)
+    # windows with at most 20% of the sites usable get 0
+    pp_fitness_correlation = rolling_spearman(shape_data, sc, ws,
+                                mask=(~np.isnan(sc))&synnonsyn,
+                                min_count=int(ws*0.2)+1, fill_value=0)
     axs[0].plot(np.arange(len(sc)-ws)+ws*0.5, pp_fitness_correlation,
                 label=label + r', $\rho='+str(np.round(spear.correlation, 3))+'$')
     axs[0].set_ylabel('rank correlation with fitness costs in '+str(ws)+' base windows')
@@ -399,9 +389,10 @@ def RNA_correlation_in_genes(data, minor_af, reference, pairings, synnonsyn, fna
     sc[sc>0.1] = 0.1
     sc[sc<0.001] = 0.001
 
+    tracks = get_reference_tracks(reference)
     with open(fname, 'w') as ofile:
         for region in ['gag', 'pol','nef',  'env', 'vif']:
-            gene_ii = np.in1d(np.arange(len(reference.entropy)), [ii for ii in reference.annotation[region]])
+            gene_ii = tracks.get_region_mask(region)
             stmp = sc[gene_ii]
             corr = []
             for pp in pairings:
@@ -421,14 +412,16 @@ if __name__=="__main__":
                         help="regenerate data")
     parser.add_argument('--subtype', choices=['B', 'any'], default='B',
                         help='subtype to compare against')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes for collecting the data')
     args = parser.parse_args()
 
     # NOTE: HXB2 alignment has way more sequences resulting in better correlations
     reference = HIVreference(refname='HXB2', subtype=args.subtype)
     genes = ['gag', 'nef', 'env', 'vif','pol', 'vpr', 'vpu']
     # Intermediate data are saved to file for faster access later on
-    fn = '../data/fitness_pooled_noncoding/avg_noncoding_allele_frequency_st_'+args.subtype+'.pickle.gz'
-    if not os.path.isfile(fn) or args.regenerate:
+    fn = '../data/fitness_pooled_noncoding/avg_noncoding_allele_frequency_st_'+args.subtype
+    if not has_pooled_data(fn) or args.regenerate:
         if args.subtype=='B':
             patient_codes = ['p2','p3', 'p5','p7', 'p8', 'p9','p10', 'p11'] # subtype B only
         else:
@@ -436,20 +429,19 @@ if __name__=="__main__":
 
         # gag and nef are loaded since they overlap with relevnat non-coding structures
         # and we need to know which positions have synonymous mutations
-        data = collect_data(patient_codes,genes, reference, synnonsyn=True)
-        tmp_data = collect_data(patient_codes, ['genomewide'], reference, synnonsyn=False)
+        data = collect_data(patient_codes,genes, reference, synnonsyn=True, jobs=args.jobs,
+                            regenerate=args.regenerate)
+        tmp_data = collect_data(patient_codes, ['genomewide'], reference, synnonsyn=False, jobs=args.jobs)
         for k in data:
             data[k].update(tmp_data[k])
 
         try:
-            with gzip.open(fn, 'w') as ofile:
-                cPickle.dump(data, ofile)
+            save_pooled_data(data, fn)
             print('Data saved to file:', os.path.abspath(fn))
-        except IOError:
+        except (IOError, OSError):
             print('Could not save data to file:', os.path.abspath(fn))
     else:
-        with gzip.open(fn) as ifile:
-            data = cPickle.load(ifile)
+        data = load_pooled_data(fn, regions=genes+['genomewide'])
 
     # Check whether all regions are present
     if not all([region in data['mut_rate'] for region in regions]):
@@ -472,7 +464,7 @@ if __name__=="__main__":
     synnonsyn['genomewide'] = np.ones_like(minor_af['genomewide'], dtype=bool)
     synnonsyn_unconstrained['genomewide'] = np.ones_like(minor_af['genomewide'], dtype=bool)
     for gene in genes:
-        pos = [x for x in reference.annotation[gene]]
+        pos = get_reference_tracks(reference).get_positions(gene)
         synnonsyn_unconstrained['genomewide'][pos] = synnonsyn_unconstrained[gene]
         synnonsyn['genomewide'][pos] = synnonsyn[gene]
 
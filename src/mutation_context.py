@@ -3,6 +3,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from scipy.stats import ks_2samp
+from util import load_fitness_cost_table
 sns.set_style('darkgrid')
 
 if __name__=="__main__":
@@ -10,18 +11,9 @@ if __name__=="__main__":
     genes = ['gag', 'pol', 'env', 'nef']
     subtype = 'B'
     for gene in genes:
-        fc = pd.read_csv('../data/fitness_pooled/nuc_'+gene+'_selection_coeffcients_'+subtype+'.tsv', sep='\t', header=1)
+        fc = load_fitness_cost_table('../data/fitness_pooled/nuc_'+gene+'_selection_coeffcients_'+subtype+'.tsv')
         cons = np.array(fc.loc[:,'consensus'])
-        fitness = fc.loc[:,'median']
-        fitness_array = []
-        for f in fitness:
-            if f=='>0.1':
-                fitness_array.append(0.1)
-            elif f=='<0.001':
-                fitness_array.append(0.001)
-            else:
-                fitness_array.append(float(f))
-        fitness_array = np.array(fitness_array)
+        fitness_array = np.array(fc.loc[:,'median'])
         plt.figure()
         plt.title(gene)
         for nuc in 'ACGT':
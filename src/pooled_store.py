@@ -0,0 +1,213 @@
+# vim: fdm=indent
+'''
+content:    Storage of the pooled allele frequency data (af_by_pat, mut_rate,
+            syn_by_pat, ...) as a directory of per-region, per-patient .npy
+            files with a JSON manifest. Regions are loaded lazily and in
+            parallel, so scripts only read what they use.
+'''
+# Modules
+from __future__ import division, print_function
+
+import os
+import sys
+import json
+import gzip
+import cPickle
+import argparse
+from itertools import izip
+from collections import Mapping
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+
+# Globals
+manifest_name = 'manifest.json'
+store_version = 1
+legacy_suffix = '.pickle.gz'
+
+
+
+# Functions
+def save_leaf(fn, leaf):
+    '''Save an array, or a dictionary (e.g. position -> codon) as key/value arrays'''
+    if isinstance(leaf, dict):
+        keys = sorted(leaf.keys())
+        np.savez(fn+'.npz', keys=np.array(keys), values=np.array([leaf[k] for k in keys]))
+        return 'dict'
+    else:
+        np.save(fn+'.npy', np.asarray(leaf))
+        return 'array'
+
+
+def load_leaf(fn, leaf_type):
+    '''Inverse of save_leaf'''
+    if leaf_type == 'dict':
+        with np.load(fn+'.npz') as f:
+            return dict(zip(f['keys'].tolist(), f['values'].tolist()))
+    else:
+        return np.load(fn+'.npy')
+
+
+def save_pooled_data(data, path):
+    '''Save pooled data to a store directory
+
+    Parameters:
+       data (dict): field -> region -> either an array or a dict of patient
+          (or phenotype) -> array/dict, e.g. the output of collect_data in
+          fitness_pooled.py and fitness_pooled_aa.py
+       path (str): directory of the store
+    '''
+    # remove the manifest of an existing store first, so an interrupted save
+    # is never a valid store with a mix of old and new leaves
+    fn_manifest = os.path.join(path, manifest_name)
+    if os.path.isfile(fn_manifest):
+        os.remove(fn_manifest)
+
+    fields = {}
+    for field, by_region in data.iteritems():
+        fields[field] = {}
+        for region, value in by_region.iteritems():
+            folder = os.path.join(path, field, region)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            if isinstance(value, dict) and all(isinstance(v, (dict, np.ndarray))
+                                               for v in value.itervalues()):
+                entry = {'type': 'mapping', 'leaves': {}}
+                for key, leaf in value.iteritems():
+                    entry['leaves'][key] = save_leaf(os.path.join(folder, key), leaf)
+            else:
+                entry = {'type': save_leaf(os.path.join(folder, region), value)}
+            fields[field][region] = entry
+
+    # the manifest is written last, so an interrupted save is not a valid store
+    fn_tmp = fn_manifest+'.'+str(os.getpid())+'.tmp'
+    with open(fn_tmp, 'w') as f:
+        json.dump({'version': store_version, 'fields': fields}, f, indent=1)
+    os.rename(fn_tmp, fn_manifest)
+
+
+def get_region_leaves(path, field, region, entry):
+    '''List the (key, filename, leaf type) of the files of one field and region'''
+    folder = os.path.join(path, field, region)
+    if entry['type'] != 'mapping':
+        return [(None, os.path.join(folder, region), entry['type'])]
+    return [(key, os.path.join(folder, key), leaf_type)
+            for key, leaf_type in sorted(entry['leaves'].iteritems())]
+
+
+def load_leaves(leaves, jobs=1):
+    '''Load a list of (key, filename, leaf type), in parallel threads if jobs > 1'''
+    load_func = lambda leaf: load_leaf(leaf[1], leaf[2])
+    if (jobs <= 1) or (len(leaves) <= 1):
+        return map(load_func, leaves)
+
+    pool = ThreadPool(min(jobs, len(leaves)))
+    try:
+        return pool.map(load_func, leaves)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def assemble_region(leaves, values):
+    '''Build the data of one region from its loaded leaves'''
+    if len(leaves) == 1 and leaves[0][0] is None:
+        return values[0]
+    return {key: value for (key, fn, leaf_type), value in zip(leaves, values)}
+
+
+class LazyRegionMapping(Mapping):
+    '''Region -> data mapping of one field that reads regions on first access'''
+    def __init__(self, path, field, entries, jobs=1):
+        self.path = path
+        self.field = field
+        self.entries = entries
+        self.jobs = jobs
+        self.loaded = {}
+
+    def __getitem__(self, region):
+        if region not in self.loaded:
+            leaves = self.get_leaves(region)
+            self.loaded[region] = assemble_region(leaves, load_leaves(leaves, jobs=self.jobs))
+        return self.loaded[region]
+
+    def get_leaves(self, region):
+        return get_region_leaves(self.path, self.field, region, self.entries[region])
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def has_pooled_data(path):
+    '''Check whether a store, or a legacy gzipped pickle to convert, exists'''
+    return (os.path.isfile(os.path.join(path, manifest_name)) or
+            os.path.isfile(path+legacy_suffix))
+
+
+def load_pooled_data(path, regions=None, jobs=4):
+    '''Load pooled data from a store directory
+
+    Regions are read on first access. If a legacy gzipped pickle (path +
+    '.pickle.gz') exists but the store does not, it is converted first.
+
+    Parameters:
+       path (str): directory of the store
+       regions (list): regions to read right away, in parallel
+       jobs (int): number of threads for reading files
+    '''
+    fn_manifest = os.path.join(path, manifest_name)
+    if (not os.path.isfile(fn_manifest)) and os.path.isfile(path+legacy_suffix):
+        convert_pickle_to_store(path+legacy_suffix, path)
+
+    with open(fn_manifest) as f:
+        manifest = json.load(f)
+
+    # JSON gives unicode strings, the analysis scripts use str keys
+    fields = {str(field): {str(region): entry for region, entry in by_region.iteritems()}
+              for field, by_region in manifest['fields'].iteritems()}
+    for by_region in fields.itervalues():
+        for entry in by_region.itervalues():
+            if 'leaves' in entry:
+                entry['leaves'] = {str(k): v for k, v in entry['leaves'].iteritems()}
+
+    data = {field: LazyRegionMapping(path, field, entries, jobs=jobs)
+            for field, entries in fields.iteritems()}
+
+    if regions is not None:
+        # read all files of the requested regions in one batch
+        tasks = [(field, region) for field in data for region in regions
+                 if (region in data[field]) and (region not in data[field].loaded)]
+        leaves = [data[field].get_leaves(region) for field, region in tasks]
+        values = load_leaves(sum(leaves, []), jobs=jobs)
+        for (field, region), region_leaves in izip(tasks, leaves):
+            data[field].loaded[region] = assemble_region(region_leaves, values[:len(region_leaves)])
+            values = values[len(region_leaves):]
+
+    return data
+
+
+def convert_pickle_to_store(fn, path):
+    '''Convert a legacy gzipped pickle of pooled data into a store directory'''
+    print('Converting', fn, 'to', path)
+    with gzip.open(fn) as ifile:
+        data = cPickle.load(ifile)
+    save_pooled_data(data, path)
+
+
+
+# Script
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description='convert pooled allele frequency pickles to stores')
+    parser.add_argument('filenames', nargs='+',
+                        help='gzipped pickle files, e.g. ../data/fitness_pooled/avg_nucleotide_allele_frequency_st_B.pickle.gz')
+    args = parser.parse_args()
+
+    for fn in args.filenames:
+        if not fn.endswith(legacy_suffix):
+            print('Not a gzipped pickle, skipping:', fn)
+            continue
+        convert_pickle_to_store(fn, fn[:-len(legacy_suffix)])
@@ -0,0 +1,193 @@
+# vim: fdm=indent
+'''
+content:    Per-site tracks on reference genomes: a cached coordinate map from
+            NL4-3 to another reference, lift-over of whole tracks (pairing
+            probabilities, SHAPE reactivities, ...) along it, and a memory
+            mapped store of entropy, consensus, ungapped masks and region
+            positions of HIVreference objects.
+'''
+# Modules
+from __future__ import division, print_function
+
+import os
+import json
+import numpy as np
+
+
+# Globals
+reference_tracks_folder = '../data/reference_tracks/'
+reference_track_names = ['entropy', 'consensus_indices', 'ungapped']
+regions_manifest_name = 'regions.json'
+# stores opened in this process, by (refname, subtype)
+loaded_reference_tracks = {}
+
+
+
+# Functions
+def get_coordinate_map_filename(refname, ref_from='NL4-3'):
+    '''Get the filename of the cached coordinate map from ref_from to refname'''
+    return reference_tracks_folder+'coordinate_map_'+ref_from+'_to_'+refname+'.npy'
+
+
+def build_coordinate_map(refname, ref_from='NL4-3', length=10000):
+    '''Position in refname of each position in ref_from, -1 if not mapped'''
+    from hivevo.HIVreference import ReferenceTranslator
+    rt = ReferenceTranslator(ref1=refname, ref2=ref_from)
+    coordinate_map = -np.ones(length, dtype=int)
+    for pos in xrange(length):
+        try:
+            pos_to = rt.translate(pos, ref_from)[1]
+        except IndexError:
+            break
+        if not (np.isnan(pos_to) or pos_to < 0):
+            coordinate_map[pos] = pos_to
+    return coordinate_map
+
+
+def get_coordinate_map(refname, ref_from='NL4-3', length=10000, regenerate=False):
+    '''Get the coordinate map from ref_from to refname, from the cache if possible
+
+    Parameters:
+       refname (str): reference to map to, e.g. HXB2
+       ref_from (str): reference to map from
+       length (int): minimal number of positions of ref_from to map
+       regenerate (bool): recompute and overwrite the cache
+
+    Returns:
+       int array with the position in refname of each position in ref_from,
+       -1 if not mapped
+    '''
+    fn = get_coordinate_map_filename(refname, ref_from=ref_from)
+    if (not regenerate) and os.path.isfile(fn):
+        coordinate_map = np.load(fn)
+        if len(coordinate_map) >= length:
+            return coordinate_map
+
+    coordinate_map = build_coordinate_map(refname, ref_from=ref_from, length=length)
+    try:
+        if not os.path.isdir(reference_tracks_folder):
+            os.makedirs(reference_tracks_folder)
+        fn_tmp = fn+'.'+str(os.getpid())+'.tmp'
+        with open(fn_tmp, 'wb') as f:
+            np.save(f, coordinate_map)
+        os.rename(fn_tmp, fn)
+    except (IOError, OSError):
+        print('Could not save coordinate map to file:', os.path.abspath(fn))
+    return coordinate_map
+
+
+def lift_over(values, coordinate_map, length, positions=None, fill_value=0):
+    '''Map a per-site track to another reference
+
+    Parameters:
+       values (array): track values
+       coordinate_map (array): see get_coordinate_map
+       length (int): length of the target reference
+       positions (array): positions of the values in the source reference
+          (default: 0, 1, ...)
+       fill_value (float): value at unmapped target positions
+
+    Returns:
+       array of the given length. Where several positions map to the same
+       target, the last one is kept.
+    '''
+    values = np.asarray(values)
+    if positions is None:
+        positions = np.arange(len(values))
+    positions = np.asarray(positions, dtype=int)
+    lifted = np.repeat(np.array(fill_value, dtype=float), length)
+    pos_to = coordinate_map[positions]
+    mapped = pos_to >= 0
+    lifted[pos_to[mapped]] = values[mapped]
+    return lifted
+
+
+def get_reference_tracks_path(refname, subtype):
+    '''Get the directory of the track store of a reference and subtype'''
+    return reference_tracks_folder+'tracks_'+refname+'_'+subtype+'/'
+
+
+def store_reference_tracks(reference, path, ungapped_threshold=0.05):
+    '''Save the tracks and region positions of an HIVreference to a store directory'''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    L = len(reference.seq)
+    tracks = {'entropy': np.asarray(reference.entropy, dtype=float),
+              'consensus_indices': np.asarray(reference.consensus_indices, dtype=int),
+              'ungapped': np.asarray(reference.get_ungapped(threshold=ungapped_threshold), dtype=bool)}
+    for track in reference_track_names:
+        np.save(os.path.join(path, track+'.npy'), tracks[track])
+
+    # positions of all regions concatenated, in the order of the features
+    regions = {'genomewide': [0, L]}
+    positions = [np.arange(L)]
+    offset = L
+    for region, feature in sorted(reference.annotation.iteritems()):
+        pos = np.array([x for x in feature], dtype=int)
+        regions[region] = [offset, offset + len(pos)]
+        positions.append(pos)
+        offset += len(pos)
+    np.save(os.path.join(path, 'region_positions.npy'), np.concatenate(positions))
+
+    # the manifest is written last, so an interrupted save is not a valid store
+    with open(os.path.join(path, regions_manifest_name), 'w') as f:
+        json.dump({'length': L, 'ungapped_threshold': ungapped_threshold,
+                   'regions': regions}, f, indent=1)
+
+
+class ReferenceTracks(object):
+    '''Per-site tracks of a reference, memory mapped from a store directory'''
+    def __init__(self, path):
+        with open(os.path.join(path, regions_manifest_name)) as f:
+            manifest = json.load(f)
+        self.length = manifest['length']
+        self.regions = {str(region): tuple(bounds)
+                        for region, bounds in manifest['regions'].iteritems()}
+        self.positions = np.load(os.path.join(path, 'region_positions.npy'), mmap_mode='r')
+        self.tracks = {track: np.load(os.path.join(path, track+'.npy'), mmap_mode='r')
+                       for track in reference_track_names}
+
+    def get_positions(self, region):
+        '''Reference positions of a region, in the order of the feature'''
+        start, stop = self.regions[region]
+        return self.positions[start:stop]
+
+    def get_region_mask(self, region):
+        '''Boolean mask of the positions of a region along the reference'''
+        mask = np.zeros(self.length, dtype=bool)
+        mask[self.get_positions(region)] = True
+        return mask
+
+    def get_track(self, track, region=None):
+        '''Values of a track (entropy, consensus_indices, ungapped) in a region'''
+        values = self.tracks[track]
+        if region is None:
+            return values
+        return values[self.get_positions(region)]
+
+
+def get_reference_tracks(reference, subtype=None, regenerate=False):
+    '''Get the track store of an HIVreference, building it if needed
+
+    Parameters:
+       reference (HIVreference): the reference, with its alignment loaded
+       subtype (str): subtype of the alignment (default: reference.subtype)
+       regenerate (bool): rebuild and overwrite the store
+    '''
+    if subtype is None:
+        subtype = reference.subtype
+    key = (reference.refname, subtype)
+    if (not regenerate) and (key in loaded_reference_tracks):
+        return loaded_reference_tracks[key]
+
+    path = get_reference_tracks_path(reference.refname, subtype)
+    if regenerate or (not os.path.isfile(os.path.join(path, regions_manifest_name))):
+        try:
+            store_reference_tracks(reference, path)
+        except (IOError, OSError):
+            print('Could not save reference tracks to:', os.path.abspath(path))
+            raise
+
+    loaded_reference_tracks[key] = ReferenceTracks(path)
+    return loaded_reference_tracks[key]
@@ -0,0 +1,144 @@
+# vim: fdm=indent
+'''
+content:    Batched fits of the saturation curves mu / s * (1 - exp(-s t)) of
+            the average derived allele frequency, on data pre-aggregated per
+            patient so that bootstrap replicates over patients are weighted
+            sums instead of new groupbys.
+'''
+# Modules
+from __future__ import division, print_function
+
+import numpy as np
+
+
+
+# Functions
+def aggregate_by_patient(data, columns, value='af'):
+    '''Sums and counts of a value per patient and combination of column values
+
+    Parameters:
+       data (pd.DataFrame): data with a 'pcode' column and the given columns
+       columns (list): columns to group by, e.g. ['S_binc', 'time_binc']
+       value (str): column to sum
+
+    Returns:
+       levels: list with the sorted unique values of each column
+       sums, counts: arrays of shape (patients, len(levels[0]), ...)
+    '''
+    codes = []
+    levels = []
+    for col in ['pcode'] + list(columns):
+        lev, code = np.unique(np.asarray(data[col]), return_inverse=True)
+        levels.append(lev)
+        codes.append(code)
+    shape = tuple(len(lev) for lev in levels)
+    key = np.ravel_multi_index(codes, shape)
+    size = int(np.prod(shape))
+    sums = np.bincount(key, weights=np.asarray(data[value], float), minlength=size).reshape(shape)
+    counts = np.bincount(key, minlength=size).reshape(shape)
+    return levels[1:], sums, counts
+
+
+def average_over_patients(sums, counts, weights=None):
+    '''Average values from aggregate_by_patient, NaN where there are no data
+
+    Parameters:
+       weights (array): patient counts of bootstrap replicates, (n_bootstrap,
+          patients), see util.patient_bootstrap_counts. If None, all patients
+          are averaged once.
+
+    Returns:
+       array of the shape of sums without the patient axis, with a leading
+       replicate axis if weights are given
+    '''
+    if weights is None:
+        sums, counts = sums.sum(axis=0), counts.sum(axis=0)
+    else:
+        sums = np.tensordot(weights, sums, axes=(1, 0))
+        counts = np.tensordot(weights, counts, axes=(1, 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def fit_slope(times, y):
+    '''Slope through the origin, along the last axis'''
+    times = np.asarray(times, float)
+    return np.dot(y, times) / np.dot(times, times)
+
+
+def saturation_curve(times, s, mu):
+    '''Average frequency mu / s * (1 - exp(-s t)) and its derivative by s
+
+    s has the shape of the curves, times and mu broadcast to (..., times)
+    '''
+    s = s[..., np.newaxis]
+    st = s * times
+    e = np.exp(-st)
+    return mu / s * (1.0 - e), mu / s**2 * (e * (1.0 + st) - 1.0)
+
+
+def fit_saturation(times, y, mu, s0, sigma=None, n_iter=200, tol=1e-10):
+    '''Least squares fits of s in y = mu / s * (1 - exp(-s t)), all at once
+
+    Levenberg-Marquardt for one parameter: every curve has its own damping,
+    and steps stop for the curves that have converged, until all have.
+
+    Parameters:
+       times (array): times of the points, broadcastable to y, e.g. the
+          time bins of the last axis
+       y (array): curves along the last axis, NaN values are left out
+       mu (float or array): slopes at t = 0, broadcastable to y. Add a last
+          axis to give one slope per curve, or give one per point
+       s0 (float or array): initial values of s, broadcastable to y.shape[:-1]
+       sigma (array): errors of y, broadcastable to y, as in curve_fit with
+          absolute_sigma=False
+       n_iter (int): maximal number of steps
+       tol (float): relative change in s for convergence
+
+    Returns:
+       s, var: fitted s and its variance, as returned by scipy.optimize.curve_fit
+    '''
+    y = np.asarray(y, float)
+    times = np.broadcast_to(np.asarray(times, float), y.shape)
+    mu = np.broadcast_to(np.asarray(mu, float), y.shape)
+    if sigma is None:
+        sigma = np.ones(y.shape)
+    sigma = np.broadcast_to(np.asarray(sigma, float), y.shape)
+    valid = ~(np.isnan(y) | np.isnan(sigma))
+    y = np.where(valid, y, 0)
+    shape = y.shape[:-1]
+    s = np.array(np.broadcast_to(s0, shape), float)
+
+    def residuals(s):
+        f, J = saturation_curve(times, s, mu)
+        return np.where(valid, (y - f) / sigma, 0), np.where(valid, J / sigma, 0)
+
+    r, J = residuals(s)
+    ssr = (r**2).sum(axis=-1)
+    damping = np.ones(shape) * 1e-3
+    active = np.ones(shape, bool)
+    for it in xrange(n_iter):
+        JJ = (J**2).sum(axis=-1)
+        step = (J * r).sum(axis=-1) / (JJ * (1.0 + damping))
+        s_new = np.where(active, s + step, s)
+        r_new, J_new = residuals(s_new)
+        ssr_new = (r_new**2).sum(axis=-1)
+
+        # accept steps that do not increase the residuals, damp the others
+        with np.errstate(invalid='ignore'):
+            accept = active & (ssr_new <= ssr)
+        s = np.where(accept, s_new, s)
+        r = np.where(accept[..., np.newaxis], r_new, r)
+        J = np.where(accept[..., np.newaxis], J_new, J)
+        ssr = np.where(accept, ssr_new, ssr)
+        damping = np.where(accept, damping / 10, damping * 10)
+
+        converged = (accept & (np.abs(step) <= tol * np.abs(s))) | (damping > 1e10)
+        active &= ~converged
+        if not active.any():
+            break
+
+    dof = valid.sum(axis=-1) - 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = ssr / dof / (J**2).sum(axis=-1)
+    return s, var
@@ -0,0 +1,256 @@
+# vim: fdm=indent
+'''
+content:    Columnar table of allele frequencies by patient, site, allele and
+            time, shared by the data collection of the saturation, mutation
+            rate and sweep scripts, and the index of sweeping alleles in it.
+'''
+# Modules
+from __future__ import print_function
+import os
+import numpy as np
+import pandas as pd
+
+from hivevo.patients import Patient
+from hivevo.HIVreference import HIVreference
+from hivevo.sequence import alpha
+
+from trajectory_cache import get_allele_frequency_trajectories
+from codons import get_codons_at_sites, get_synonymous_table
+
+
+# Globals
+site_table_folder = '../data/site_table/'
+site_table_columns = ['pcode', 'pos', 'pos_ref', 'S', 'protein', 'RNA',
+                      'ancestral', 'allele', 'derived', 'mut', 'syn',
+                      'anc_cross', 'time', 'af', 'af_max', 'covered',
+                      'n_templates']
+sweep_event_keys = ['pcode', 'pos', 'allele']
+sweep_event_columns = ['pos_ref', 'S', 'protein', 'ancestral', 'mut', 'syn',
+                       'anc_cross', 'af_max']
+
+
+
+# Functions
+def get_site_table_filename(pcode, cov_min=100, refname='HXB2', subtype='any'):
+    '''Get the filename of the cached site table of a patient'''
+    return (site_table_folder+'site_table_'+pcode+'_'+refname+'_'+subtype+
+            '_covmin_'+str(cov_min)+'.pickle')
+
+
+def get_sweep_events_filename(pcode, threshold=0.5, cov_min=100, refname='HXB2',
+                              subtype='any'):
+    '''Get the filename of the cached sweep events of a patient'''
+    return (get_site_table_filename(pcode, cov_min=cov_min, refname=refname,
+                                    subtype=subtype)[:-7]+
+            '_sweeps_'+str(threshold)+'.pickle')
+
+
+def build_site_table_patient(p, aft, ref, refname='HXB2'):
+    '''Build the site table of one patient
+
+    Only sites within ONE protein and with ungapped ancestral codons are kept,
+    with one row per nucleotide (ACGT) and time at which that allele is not
+    masked. Columns:
+       pos_ref: position in the reference, -1 if not mapped
+       S: reference entropy, NaN if not mapped
+       derived, syn: the allele differs from the ancestral one, synonymously
+       anc_cross: the ancestral allele (majority at the first time with all
+          four nucleotides covered) agrees with the reference consensus
+       af_max: max frequency of the allele across covered times
+       covered: all four nucleotides are unmasked at this time
+    '''
+    L = aft.shape[2]
+    mask = np.ma.getmaskarray(aft)[:, :4]
+    afs = aft.data[:, :4]
+    init_seq = np.asarray(p.initial_sequence)[:L]
+    times = np.asarray(p.dsi)
+    n_templates = np.asarray(p.n_templates_dilutions)
+
+    covered = ~mask.any(axis=1)
+    has_covered = covered.any(axis=0)
+
+    # Keep only sites within ONE protein
+    # Note: we could drop this, but then we cannot quite classify syn/nonsyn
+    feas = [p.pos_to_feature[pos] for pos in xrange(L)]
+    good = np.array([len(fea['protein_codon']) == 1 for fea in feas], bool)
+    protein = np.array([fea['protein_codon'][0][0] if g else ''
+                        for fea, g in zip(feas, good)])
+    codon_pos = np.array([fea['protein_codon'][0][-1] if g else 0
+                          for fea, g in zip(feas, good)], int)
+    rna = np.array([bool(fea['RNA']) for fea in feas], bool)
+
+    # Exclude codons with gaps
+    cods = get_codons_at_sites(init_seq, codon_pos)
+    good &= ~(cods == '-').any(axis=1)
+    syn = get_synonymous_table(cods, codon_pos)
+
+    # Map to the reference
+    mapco = p.map_to_external_reference('genomewide', refname=refname)
+    pos_ref = -np.ones(L, int)
+    pos_ref[mapco[:, 1]] = mapco[:, 0]
+    in_ref = pos_ref >= 0
+    S = np.repeat(np.nan, L)
+    S[in_ref] = ref.entropy[pos_ref[in_ref]]
+    cons = -np.ones(L, int)
+    cons[in_ref] = ref.consensus_indices[pos_ref[in_ref]]
+
+    # Ancestral allele and group M agree
+    it_first = covered.argmax(axis=0)
+    anc_first = aft[it_first, :, np.arange(L)].argmax(axis=1)
+    anc_cross = has_covered & (cons == anc_first)
+
+    af_max = np.where(covered[:, np.newaxis], afs, -np.inf).max(axis=0)
+    af_max[:, ~has_covered] = np.nan
+
+    # One row per site, allele, and time
+    pos, ia, it = np.nonzero(~mask.transpose(2, 1, 0) &
+                             good[:, np.newaxis, np.newaxis])
+    anc = init_seq[pos]
+    allele = alpha[ia]
+    table = pd.DataFrame({'pcode': np.repeat(p.name, len(pos)),
+                          'pos': pos,
+                          'pos_ref': pos_ref[pos],
+                          'S': S[pos],
+                          'protein': protein[pos],
+                          'RNA': rna[pos],
+                          'ancestral': anc,
+                          'allele': allele,
+                          'derived': anc != allele,
+                          'mut': np.char.add(np.char.add(anc, '->'), allele),
+                          'syn': syn[ia, pos],
+                          'anc_cross': anc_cross[pos],
+                          'time': times[it],
+                          'af': afs[it, ia, pos],
+                          'af_max': af_max[ia, pos],
+                          'covered': covered[it, pos],
+                          'n_templates': n_templates[it],
+                         },
+                         columns=site_table_columns)
+    return table
+
+
+def load_site_table(patients, cov_min=100, refname='HXB2', subtype='any',
+                    regenerate=False):
+    '''Load the site table for a few patients, building it if needed
+
+    Each patient table is cached to file, so every script collecting data
+    from the same patients shares one pass over the allele frequencies. With
+    regenerate, the tables are built again and the caches overwritten.
+    '''
+    ref = None
+    tables = []
+    for pcode in patients:
+        fn = get_site_table_filename(pcode, cov_min=cov_min, refname=refname,
+                                     subtype=subtype)
+        if os.path.isfile(fn) and (not regenerate):
+            tables.append(pd.read_pickle(fn))
+            continue
+
+        print(pcode)
+        if ref is None:
+            ref = HIVreference(refname=refname, subtype=subtype, load_alignment=True)
+
+        p = Patient.load(pcode)
+        aft = get_allele_frequency_trajectories(p, 'genomewide', cov_min=cov_min)
+        table = build_site_table_patient(p, aft, ref, refname=refname)
+        try:
+            if not os.path.isdir(site_table_folder):
+                os.makedirs(site_table_folder)
+            fn_tmp = fn+'.'+str(os.getpid())+'.tmp'
+            table.to_pickle(fn_tmp)
+            os.rename(fn_tmp, fn)
+        except (IOError, OSError):
+            print('Could not save site table to file:', os.path.abspath(fn))
+        tables.append(table)
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def find_sweep_events(table, threshold=0.5):
+    '''Find the derived alleles that go above a frequency threshold
+
+    af_max is constant across the rows of an allele, so every sweeping allele
+    is found by one comparison over the table, without visiting trajectories.
+
+    Returns:
+       pd.DataFrame with one row per sweeping allele, indexed by pcode, pos
+       and allele, with the site and allele columns of the site table
+    '''
+    swept = (table['derived'] & (table['af_max'] > threshold)).values
+    events = (table.loc[swept, sweep_event_keys + sweep_event_columns]
+              .drop_duplicates(sweep_event_keys)
+              .set_index(sweep_event_keys)
+              .sort_index())
+    return events
+
+
+def load_sweep_events(patients, threshold=0.5, cov_min=100, refname='HXB2',
+                      subtype='any', table=None, regenerate=False):
+    '''Load the sweep events of a few patients, finding them if needed
+
+    Parameters:
+       patients (list): patient codes
+       threshold (float): frequency threshold for a sweep
+       table (pd.DataFrame): site table of these patients, if already loaded.
+          Otherwise it is loaded for the patients whose events are not cached.
+       regenerate (bool): find the events again and overwrite the cache
+
+    The events of a patient are found again whenever its site table file is
+    newer than the cached events.
+    '''
+    events = []
+    for pcode in patients:
+        fn = get_sweep_events_filename(pcode, threshold=threshold, cov_min=cov_min,
+                                       refname=refname, subtype=subtype)
+        fn_table = get_site_table_filename(pcode, cov_min=cov_min, refname=refname,
+                                           subtype=subtype)
+        if ((not regenerate) and os.path.isfile(fn) and
+            ((not os.path.isfile(fn_table)) or
+             (os.path.getmtime(fn) >= os.path.getmtime(fn_table)))):
+            events.append(pd.read_pickle(fn))
+            continue
+
+        if table is None:
+            table_pat = load_site_table([pcode], cov_min=cov_min, refname=refname,
+                                        subtype=subtype)
+        else:
+            table_pat = table.loc[(table['pcode'] == pcode).values]
+        events_pat = find_sweep_events(table_pat, threshold=threshold)
+        try:
+            if not os.path.isdir(site_table_folder):
+                os.makedirs(site_table_folder)
+            fn_tmp = fn+'.'+str(os.getpid())+'.tmp'
+            events_pat.to_pickle(fn_tmp)
+            os.rename(fn_tmp, fn)
+        except (IOError, OSError):
+            print('Could not save sweep events to file:', os.path.abspath(fn))
+        events.append(events_pat)
+
+    return pd.concat(events).sort_index()
+
+
+def get_swept_sites(table, threshold=0.5, only_nonsyn=False, events=None,
+                    alleles=False):
+    '''Mark rows of sites where any derived allele goes above a threshold
+
+    Parameters:
+       table (pd.DataFrame): site table
+       threshold (float): frequency threshold for a sweep
+       only_nonsyn (bool): consider only nonsynonymous derived alleles
+       events (pd.DataFrame): sweep events at this threshold, see
+          load_sweep_events. If None, they are found in the table.
+       alleles (bool): mark only the rows of the sweeping alleles instead of
+          all rows of their sites
+    '''
+    if events is None:
+        events = find_sweep_events(table, threshold=threshold)
+    if only_nonsyn:
+        events = events.loc[~events['syn'].values.astype(bool)]
+
+    if alleles:
+        keys = pd.MultiIndex.from_arrays([table[key] for key in sweep_event_keys])
+        swept = events.index
+    else:
+        keys = pd.MultiIndex.from_arrays([table['pcode'], table['pos']])
+        swept = events.index.droplevel('allele')
+    return pd.Series(keys.isin(swept), index=table.index)
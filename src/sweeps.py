@@ -14,98 +14,32 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-from Bio.Seq import translate
-
 from hivevo.patients import Patient
 from hivevo.HIVreference import HIVreference
 from hivevo.sequence import alpha, alphal
 
 from util import add_binned_column, boot_strap_patients
+from site_table import load_site_table, load_sweep_events, get_swept_sites
 
 
 
 # Functions
-def collect_data(patients, cov_min=100, refname='HXB2'):
+def collect_data(patients, cov_min=100, refname='HXB2', regenerate=False):
     '''Collect data for the fitness cost estimate'''
-    ref = HIVreference(refname=refname, subtype='any', load_alignment=True)
-
-    data = []
-    for pi, pcode in enumerate(patients):
-        print pcode
-
-        p = Patient.load(pcode)
-        comap = (pd.DataFrame(p.map_to_external_reference('genomewide', refname=refname)[:, :2],
-                              columns=[refname, 'patient'])
-                   .set_index('patient', drop=True)
-                   .loc[:, refname])
-
-        aft = p.get_allele_frequency_trajectories('genomewide', cov_min=cov_min)
-        for pos, aft_pos in enumerate(aft.swapaxes(0, 2)):
-            fead = p.pos_to_feature[pos]
-
-            # Keep only sites within ONE protein
-            # Note: we could drop this, but then we cannot quite classify syn/nonsyn
-            if len(fead['protein_codon']) != 1:
-                continue
+    data = load_site_table(patients, cov_min=cov_min, refname=refname,
+                           subtype='any', regenerate=regenerate)
 
-            # Exclude codons with gaps
-            pc = fead['protein_codon'][0][-1]
-            cod_anc = ''.join(p.initial_sequence[pos - pc: pos - pc + 3])
-            if '-' in cod_anc:
-                continue
+    # Keep only nonmasked times at sites in the reference, and sweeping
+    # derived alleles
+    events = load_sweep_events(patients, threshold=0.9, cov_min=cov_min,
+                               refname=refname, subtype='any', table=data)
+    ind = (data['covered'] &
+           (data['pos_ref'] >= 0) &
+           get_swept_sites(data, events=events, alleles=True))
 
-            # Keep only nonmasked times
-            if aft_pos[:4].mask.any(axis=0).all():
-                continue
-            else:
-                ind = ~aft_pos[:4].mask.any(axis=0)
-                times = p.dsi[ind]
-                aft_pos = aft_pos[:, ind]
-
-            # Get site entropy
-            if pos not in comap.index:
-                continue
-            pos_ref = comap.loc[pos]
-            S_pos = ref.entropy[pos_ref]
-
-            # Keep only sites where the ancestral allele and group M agree
-            if ref.consensus_indices[pos_ref] != aft_pos[:, 0].argmax():
-                anc_cross = False
-            else:
-                anc_cross = True
-
-            for ia, aft_nuc in enumerate(aft_pos[:4]):
-                # Keep only derived alleles
-                if alpha[ia] == p.initial_sequence[pos]:
-                    continue
-
-                # Keep only sweeps
-                if not (aft_nuc > 0.9).any():
-                    continue
-
-                # Annotate with syn/nonsyn alleles
-                cod_new = cod_anc[:pc] + alpha[ia] + cod_anc[pc+1:]
-                if translate(cod_anc) != translate(cod_new):
-                    syn = False
-                else:
-                    syn = True
-
-                mut = p.initial_sequence[pos]+'->'+alpha[ia]
-                for it, (t, af_nuc) in enumerate(izip(times, aft_nuc)):
-                    datum = {'time': t,
-                             'af': af_nuc,
-                             'pos': pos,
-                             'pos_ref': pos_ref,
-                             'protein': fead['protein_codon'][0][0],
-                             'pcode': pcode,
-                             'mut': mut,
-                             'S': S_pos,
-                             'syn': syn,
-                             'anc_cross': anc_cross,
-                            }
-                    data.append(datum)
-
-    data = pd.DataFrame(data)
+    data = data.loc[ind, ['time', 'af', 'pos', 'pos_ref', 'protein', 'pcode',
+                          'mut', 'S', 'syn', 'anc_cross']]
+    data.reset_index(drop=True, inplace=True)
 
     return data
 
@@ -281,7 +215,7 @@ if __name__ == '__main__':
     if not os.path.isfile(fn) or args.regenerate:
         patients = ['p1', 'p2', 'p3','p5', 'p6', 'p8', 'p9', 'p11']
         cov_min = 100
-        data = collect_data(patients, cov_min=cov_min)
+        data = collect_data(patients, cov_min=cov_min, regenerate=args.regenerate)
         data.to_pickle(fn)
     else:
         data = pd.read_pickle(fn)
@@ -0,0 +1,88 @@
+# vim: fdm=indent
+'''
+content:    Synonymous site classification of patients' initial sequences,
+            computed with the codon tables in codons.py and cached to file
+            per patient, region, and masking of constrained sites.
+'''
+# Modules
+from __future__ import division, print_function
+
+import os
+import numpy as np
+
+from hivevo.sequence import alpha, alphal
+from codons import get_codons_at_sites, get_synonymous_table
+
+
+# Globals
+syn_sites_folder = '../data/syn_sites/'
+
+
+
+# Functions
+def get_syn_sites_filename(pcode, region, mask_constrained=True):
+    '''Get the filename of the cached syn sites of a patient region'''
+    return (syn_sites_folder+'syn_sites_'+pcode+'_'+region+
+            ('_constrained_masked' if mask_constrained else '')+'.npy')
+
+
+def get_constrained_sites(p, region):
+    '''Sites of a region in RNA structures or in more than one protein'''
+    feas = [p.pos_to_feature[pos] for pos in p.annotation[region]]
+    return np.array([(len(fea['protein_codon']) > 1) or bool(fea['RNA'])
+                     for fea in feas], bool)
+
+
+def get_syn_matrix(p, region, mask_constrained=True):
+    '''Whether each of ACGT is synonymous at each site of a coding region
+
+    Same as Patient.get_syn_mutations, but with codon lookup tables: the region
+    is read in frame from its start, codons with gaps are never synonymous.
+
+    Returns:
+       (4, L) bool array
+    '''
+    seq = alpha[p.get_initial_indices(region)]
+    codon_pos = np.arange(len(seq)) % 3
+    syn = get_synonymous_table(get_codons_at_sites(seq, codon_pos), codon_pos)
+    if mask_constrained:
+        syn[:, get_constrained_sites(p, region)] = False
+    return syn
+
+
+def classify_syn_sites(syn_matrix):
+    '''Call sites synonymous if 4-fold, or 2-fold with A and G either both syn or both not'''
+    Ai = alphal.index('A')
+    Gi = alphal.index('G')
+    nsyn = syn_matrix.sum(axis=0)
+    return (nsyn > 3) | ((nsyn == 2) & (syn_matrix[Ai] == syn_matrix[Gi]))
+
+
+def get_syn_sites(p, region, mask_constrained=True, regenerate=False):
+    '''Get the synonymous sites of a patient region, from the cache if possible
+
+    Parameters:
+       p (Patient): the patient
+       region (str): coding region
+       mask_constrained (bool): sites in RNA structures or reading frame
+          overlaps are not synonymous
+       regenerate (bool): recompute and overwrite the cache
+
+    Returns:
+       bool array with the length of the region in the patient
+    '''
+    fn = get_syn_sites_filename(p.name, region, mask_constrained=mask_constrained)
+    if (not regenerate) and os.path.isfile(fn):
+        return np.load(fn)
+
+    syn_pos = classify_syn_sites(get_syn_matrix(p, region, mask_constrained=mask_constrained))
+    try:
+        if not os.path.isdir(syn_sites_folder):
+            os.makedirs(syn_sites_folder)
+        fn_tmp = fn+'.'+str(os.getpid())+'.tmp'
+        with open(fn_tmp, 'wb') as f:
+            np.save(f, syn_pos)
+        os.rename(fn_tmp, fn)
+    except (IOError, OSError):
+        print('Could not save syn sites to file:', os.path.abspath(fn))
+    return syn_pos
@@ -0,0 +1,75 @@
+# vim: fdm=indent
+'''
+content:    On-disk cache of allele frequency trajectories of patients. Each
+            masked array is stored as a pair of .npy files (data and mask)
+            that are read back memory-mapped.
+'''
+# Modules
+from __future__ import division, print_function
+
+import os
+import numpy as np
+
+
+# Globals
+trajectory_cache_folder = '../data/trajectories/'
+
+
+
+# Functions
+def get_trajectory_cache_basename(pcode, region, cov_min=100, error_rate=2e-3, type='nuc'):
+    '''Get the path of the cached trajectories without the _data/_mask.npy suffix'''
+    return (trajectory_cache_folder+pcode+'_'+region+'_'+type+
+            '_covmin_'+str(cov_min)+'_err_'+str(error_rate))
+
+
+def store_allele_frequency_trajectories(aft, basename):
+    '''Save a masked array of trajectories as a data and a mask .npy file'''
+    if not os.path.isdir(os.path.dirname(basename)):
+        os.makedirs(os.path.dirname(basename))
+
+    # write to temporary files first, so a concurrent reader never sees a
+    # half written cache
+    for suffix, arr in [('_mask.npy', np.ma.getmaskarray(aft)),
+                        ('_data.npy', np.ma.getdata(aft))]:
+        fn_tmp = basename+suffix+'.'+str(os.getpid())+'.tmp'
+        with open(fn_tmp, 'wb') as f:
+            np.save(f, arr)
+        os.rename(fn_tmp, basename+suffix)
+
+
+def load_allele_frequency_trajectories(basename, mmap=True):
+    '''Load cached trajectories as a masked array, memory mapped by default'''
+    mmap_mode = 'r' if mmap else None
+    data = np.load(basename+'_data.npy', mmap_mode=mmap_mode)
+    mask = np.load(basename+'_mask.npy', mmap_mode=mmap_mode)
+    return np.ma.array(data, mask=mask, copy=False)
+
+
+def get_allele_frequency_trajectories(p, region, cov_min=100, error_rate=2e-3,
+                                      type='nuc', regenerate=False, mmap=True):
+    '''Get the allele frequency trajectories of a patient, from the cache if possible
+
+    Parameters:
+       p (Patient): the patient
+       region, cov_min, error_rate, type: see Patient.get_allele_frequency_trajectories
+       regenerate (bool): recompute and overwrite the cache
+       mmap (bool): memory map the cached arrays instead of reading them
+
+    Returns:
+       masked array of shape (n_times, n_alleles, L), read-only when memory mapped
+    '''
+    basename = get_trajectory_cache_basename(p.name, region, cov_min=cov_min,
+                                             error_rate=error_rate, type=type)
+    if (not regenerate) and os.path.isfile(basename+'_data.npy'):
+        return load_allele_frequency_trajectories(basename, mmap=mmap)
+
+    aft = p.get_allele_frequency_trajectories(region, cov_min=cov_min,
+                                              error_rate=error_rate, type=type)
+    try:
+        store_allele_frequency_trajectories(aft, basename)
+    except (IOError, OSError):
+        print('Could not save trajectories to file:', os.path.abspath(basename))
+        return aft
+
+    return load_allele_frequency_trajectories(basename, mmap=mmap)
@@ -12,18 +12,123 @@ import numpy as np
 # Globals
 fig_width = 5
 fig_fontsize = 12
+# fitness costs outside these bounds are censored in the exported tables
+fitness_cost_bounds = (0.001, 0.1)
+quartile_columns = ['lower quartile', 'median', 'upper quartile']
 
 
 # Functions
+def get_mutation_rates_filename(threshold=0.3, gp120=True):
+    return '../data/mutation_rates/mutation_rate_'+str(threshold) + ('_gp120' if gp120 else '') + '.pickle'
+
+
 def load_mutation_rates(threshold=0.3, gp120=True):
     import pandas as pd
-    fn = '../data/mutation_rates/mutation_rate_'+str(threshold) + ('_gp120' if gp120 else '') + '.pickle'
+    fn = get_mutation_rates_filename(threshold=threshold, gp120=gp120)
     print('loading', fn)
     mu =  pd.read_pickle(fn)
     return mu
 
 
 # Functions
+def format_fitness_costs(costs, sig=2):
+    '''Format a column of fitness costs for the exported tables
+
+    Costs below or above fitness_cost_bounds are written as '<0.001' and '>0.1',
+    the others rounded to sig significant digits (full precision if sig is None).
+    '''
+    costs = np.asarray(costs, dtype=float)
+    fmt = '%.12g' if sig is None else '%.'+str(sig)+'g'
+    with np.errstate(invalid='ignore'):
+        return np.where(costs < fitness_cost_bounds[0], '<'+str(fitness_cost_bounds[0]),
+               np.where(costs > fitness_cost_bounds[1], '>'+str(fitness_cost_bounds[1]),
+                        np.char.mod(fmt, costs)))
+
+
+def get_fitness_cost_npz_filename(fn):
+    '''Binary companion of an exported fitness cost table'''
+    return fn[:-len('.tsv')]+'.npz' if fn.endswith('.tsv') else fn+'.npz'
+
+
+def save_fitness_cost_table(fn, title, refname, consensus, ref_seq, quartiles,
+                            syn=None, sig=2):
+    '''Export per-site fitness costs as a TSV file and an npz companion
+
+    Parameters:
+       fn (str): name of the TSV file, the companion replaces .tsv by .npz
+       title (str): first line of the TSV file, after '### '
+       refname (str): name of the reference column
+       consensus, ref_seq (sequences): consensus and reference at each site
+       quartiles (3 x L array): lower quartile, median, upper quartile
+       syn (bool array): optional column of synonymous sites
+       sig (int): significant digits in the TSV file, see format_fitness_costs
+
+    The TSV file has censored and rounded costs, the companion the exact ones.
+    '''
+    quartiles = np.asarray(quartiles, dtype=float)
+    L = quartiles.shape[1]
+    consensus = np.array(list(consensus[:L]))
+    ref_seq = np.array(list(ref_seq[:L]))
+    columns = [np.arange(1, L+1).astype(str), consensus, ref_seq]
+    columns.extend([format_fitness_costs(q, sig=sig) for q in quartiles])
+    header = ['# position', 'consensus', refname] + quartile_columns
+    if syn is not None:
+        columns.append(np.asarray(syn, dtype=int).astype(str))
+        header.append('syn')
+
+    with open(fn, 'w') as ofile:
+        ofile.write('### '+title+'\n')
+        ofile.write('\t'.join(header)+'\n')
+        np.savetxt(ofile, np.column_stack(columns), fmt='%s', delimiter='\t')
+
+    arrays = {'position': np.arange(1, L+1), 'consensus': consensus,
+              'reference': ref_seq, 'refname': np.array(refname),
+              'quartiles': quartiles}
+    if syn is not None:
+        arrays['syn'] = np.asarray(syn, dtype=bool)
+    np.savez(get_fitness_cost_npz_filename(fn), **arrays)
+
+
+def load_fitness_cost_table(fn, censored=fitness_cost_bounds):
+    '''Load an exported fitness cost table, see save_fitness_cost_table
+
+    The npz companion is read if it exists and is not older than the TSV file,
+    the TSV file is parsed otherwise.
+
+    Parameters:
+       fn (str): name of the TSV file
+       censored (pair): values for costs below and above fitness_cost_bounds
+
+    Returns:
+       DataFrame with columns position, consensus, the reference name, the
+       quartile columns as floats, and syn if exported
+    '''
+    import os
+    import pandas as pd
+    fn_npz = get_fitness_cost_npz_filename(fn)
+    if os.path.isfile(fn_npz) and ((not os.path.isfile(fn)) or
+                                   os.path.getmtime(fn_npz) >= os.path.getmtime(fn)):
+        with np.load(fn_npz) as f:
+            refname = str(f['refname'])
+            df = pd.DataFrame({'position': f['position'], 'consensus': f['consensus'],
+                               refname: f['reference']},
+                              columns=['position', 'consensus', refname])
+            for col, q in zip(quartile_columns, f['quartiles']):
+                with np.errstate(invalid='ignore'):
+                    df[col] = np.where(q < fitness_cost_bounds[0], censored[0],
+                              np.where(q > fitness_cost_bounds[1], censored[1], q))
+            if 'syn' in f.files:
+                df['syn'] = f['syn']
+        return df
+
+    df = (pd.read_csv(fn, sep='\t', header=1)
+          .rename(columns={'# position': 'position'}))
+    for col in quartile_columns:
+        df[col] = pd.to_numeric(df[col].replace({'<'+str(fitness_cost_bounds[0]): censored[0],
+                                                 '>'+str(fitness_cost_bounds[1]): censored[1]}))
+    return df
+
+
 def add_binned_column(df, bins, to_bin):
     '''Add a column to data frame with binned values (in-place)
 
@@ -40,30 +145,230 @@ def add_binned_column(df, bins, to_bin):
                                           np.maximum(0,np.searchsorted(bins, df.loc[:,to_bin])-1))
 
 
-def boot_strap_patients(df, eval_func, columns=None,  n_bootstrap=100):
-    import pandas as pd
+def patient_bootstrap_counts(npat, n_bootstrap):
+    '''Multinomial counts of patients in each bootstrap replicate, (n_bootstrap, npat)
+
+    Each row is equivalent to one resampling of the patients with replacement.
+    '''
+    tmp_sample = np.random.randint(npat, size=(n_bootstrap, npat))
+    tmp_sample += npat * np.arange(n_bootstrap)[:, None]
+    return np.bincount(tmp_sample.ravel(), minlength=n_bootstrap*npat).reshape(n_bootstrap, npat)
+
+
+# data shared with the bootstrap worker processes (inherited via fork, so
+# eval_func does not need to be picklable)
+bootstrap_shared = {}
+
+
+def get_bootstrap_replicate(i):
+    '''Build and evaluate one bootstrap replicate, see boot_strap_patients'''
+    df = bootstrap_shared['df']
+    rows_by_patient = bootstrap_shared['rows_by_patient']
+    npats = len(rows_by_patient)
+    seed = bootstrap_shared['seed'] + i
+    if (i%20==0): print("Bootstrap",i)
+
+    pats = np.random.RandomState(seed).randint(0, npats, size=npats)
+    rows = np.concatenate([rows_by_patient[pat] for pat in pats])
+    bs = df.take(rows)
+    bs['pcode'] = np.repeat(['BS'+str(pi+1) for pi in xrange(npats)],
+                            [len(rows_by_patient[pat]) for pat in pats])
+
+    # any randomness in eval_func is seeded per replicate as well
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        return bootstrap_shared['eval_func'](bs)
+    finally:
+        np.random.set_state(state)
+
+
+def boot_strap_patients(df, eval_func, columns=None,  n_bootstrap=100,
+                        n_jobs=1, seed=None):
+    '''Evaluate a function on bootstrap replicates over patients
+
+    Parameters
+       df (pandas.DataFrame): data with a 'pcode' column
+       eval_func (function): called on each replicate, in which resampled
+           patients are relabelled BS1, BS2, ...
+       columns (list): columns to keep in the replicates (default: all)
+       n_bootstrap (int): number of replicates
+       n_jobs (int): number of worker processes
+       seed (int): replicate i is drawn with seed + i, hence the results do
+           not depend on n_jobs. If None, it is drawn from numpy's global
+           random state.
 
+    Returns
+       list of the eval_func results, in replicate order
+    '''
     if columns is None:
         columns = df.columns
     if 'pcode' not in columns:
         columns = list(columns)+['pcode']
+    if seed is None:
+        seed = np.random.randint(2**31 - n_bootstrap)
 
+    # positions of the rows of each patient, so a replicate is one take
     patients = df.loc[:,'pcode'].unique()
-    tmp_df_grouped = df.loc[:,columns].groupby('pcode')
-    npats = len(patients)
-    replicates = []
-    for i in xrange(n_bootstrap):
-        if (i%20==0): print("Bootstrap",i)
-        pats = patients[np.random.randint(0,npats, size=npats)]
-        bs = []
-        for pi,pat in enumerate(pats):
-            bs.append(tmp_df_grouped.get_group(pat))
-            bs[-1]['pcode']='BS'+str(pi+1)
-        bs = pd.concat(bs)
-        replicates.append(eval_func(bs))
+    pat_index = {pat: pi for pi, pat in enumerate(patients)}
+    pat_of_row = np.array([pat_index[pat] for pat in df.loc[:,'pcode']], int)
+    order = np.argsort(pat_of_row, kind='mergesort')
+    bounds = np.cumsum(np.bincount(pat_of_row, minlength=len(patients)))[:-1]
+
+    bootstrap_shared.update({'df': df.loc[:,columns],
+                             'rows_by_patient': np.split(order, bounds),
+                             'eval_func': eval_func,
+                             'seed': seed})
+    try:
+        if n_jobs > 1:
+            from multiprocessing import Pool
+            pool = Pool(n_jobs)
+            try:
+                replicates = pool.map(get_bootstrap_replicate, xrange(n_bootstrap))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            replicates = map(get_bootstrap_replicate, xrange(n_bootstrap))
+    finally:
+        bootstrap_shared.clear()
+
     return replicates
 
 
+def map_jobs(func, tasks, jobs=1):
+    '''Map a function over tasks, in forked worker processes if jobs > 1
+
+    func must be defined at module level; data it needs that should not be
+    pickled for each task (e.g. loaded patients) can be stored in a module
+    global before the call, since the workers inherit it via fork.
+    '''
+    if jobs > 1 and len(tasks) > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(jobs, len(tasks)))
+        try:
+            return pool.map(func, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return map(func, tasks)
+
+
+def centered_ranks(vals, valid):
+    '''Ranks within each row of vals among the valid entries, minus their mean
+
+    Ties get average ranks as in scipy.stats.spearmanr, entries that are not
+    valid are zero. NaN at valid entries are ranked as 0, callers flag them.
+    '''
+    n_rows, n = vals.shape
+    count = valid.sum(axis=1)
+    # entries not in the mask are sorted to the end and do not affect the
+    # ranks of the others
+    vals = np.where(valid, vals, np.inf)
+    vals[np.isnan(vals)] = 0
+    order = np.argsort(vals, axis=1, kind='mergesort')
+    rows = np.arange(n_rows)[:, np.newaxis]
+    svals = vals[rows, order]
+    # first and last position of each group of ties
+    pos = np.tile(np.arange(n), (n_rows, 1))
+    new_group = np.ones((n_rows, n), dtype=bool)
+    new_group[:, 1:] = svals[:, 1:] != svals[:, :-1]
+    first = np.maximum.accumulate(np.where(new_group, pos, 0), axis=1)
+    end_group = np.ones((n_rows, n), dtype=bool)
+    end_group[:, :-1] = new_group[:, 1:]
+    last = np.minimum.accumulate(np.where(end_group, pos, n)[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.empty((n_rows, n))
+    ranks[rows, order] = 0.5*(first + last) + 1
+    return np.where(valid, ranks - 0.5*(count[:, np.newaxis] + 1), 0)
+
+
+def track_ranks(x, valid):
+    '''centered_ranks of one track x restricted to each row of valid
+
+    x is sorted only once, the ranks of each row follow from cumulative
+    counts of the valid sites along that order.
+    '''
+    order = np.argsort(x, kind='mergesort')
+    sx = x[order]
+    new_group = np.concatenate([[True], sx[1:] != sx[:-1]])
+    group = np.cumsum(new_group) - 1
+    starts = np.flatnonzero(new_group)
+    ends = np.concatenate([starts[1:], [len(x)]]) - 1
+    svalid = valid[:, order]
+    cum = np.cumsum(svalid, axis=1)
+    # valid sites before each group of ties, and within it
+    before = cum[:, starts] - svalid[:, starts]
+    within = cum[:, ends] - before
+    count = cum[:, -1]
+    ranks = np.empty(valid.shape)
+    ranks[:, order] = (before + 0.5*(within + 1))[:, group]
+    return np.where(valid, ranks - 0.5*(count[:, np.newaxis] + 1), 0)
+
+
+def spearman_rows(x, Y, mask=None):
+    '''Spearman rank correlation of a track with each row of a matrix
+
+    Each row is correlated with x at the sites in mask where the row is not
+    NaN, as spearmanr(x[ind], Y[i, ind]) with ind = mask & ~isnan(Y[i]).
+
+    Parameters
+       x (array): per-site track of length L, not NaN in the mask
+       Y (array): (n_rows, L) matrix, e.g. fitness costs of patient subsets
+       mask (bool array): sites to use (default: all)
+
+    Returns
+       array of n_rows correlation coefficients, NaN for constant rows
+    '''
+    x = np.asarray(x, dtype=float)
+    Y = np.atleast_2d(np.asarray(Y, dtype=float))
+    if mask is None:
+        mask = np.ones(len(x), dtype=bool)
+    valid = mask & (~np.isnan(Y))
+    rx = track_ranks(x, valid)
+    ry = centered_ranks(Y, valid)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (rx*ry).sum(axis=1)/np.sqrt((rx**2).sum(axis=1)*(ry**2).sum(axis=1))
+
+
+def rolling_spearman(x, y, ws, mask=None, min_count=3, fill_value=np.nan):
+    '''Spearman rank correlation of two per-site tracks in sliding windows
+
+    All windows are ranked at once: each window is sorted as a row of a
+    (n_windows, ws) matrix, ties get average ranks as in scipy.stats.spearmanr.
+
+    Parameters
+       x, y (arrays): per-site tracks of the same length L
+       ws (int): window size, the windows start at 0, ..., L - ws - 1
+       mask (bool array): sites to use in each window (default: all)
+       min_count (int): windows with fewer sites in the mask get fill_value
+       fill_value (float): value for windows with too few sites
+
+    Returns
+       array of L - ws correlation coefficients. As for spearmanr, windows with
+       NaN at a masked site, or a constant track, give NaN.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if mask is None:
+        mask = np.ones(len(x), dtype=bool)
+    n_windows = len(x) - ws
+    if n_windows <= 0:
+        return np.zeros(0)
+    windows = np.arange(n_windows)[:, np.newaxis] + np.arange(ws)
+    valid = mask[windows]
+    count = valid.sum(axis=1)
+    has_nan = (valid & (np.isnan(x[windows]) | np.isnan(y[windows]))).any(axis=1)
+
+    rx = centered_ranks(x[windows], valid)
+    ry = centered_ranks(y[windows], valid)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cc = (rx*ry).sum(axis=1)/np.sqrt((rx**2).sum(axis=1)*(ry**2).sum(axis=1))
+    cc[has_nan] = np.nan
+    cc[count < min_count] = fill_value
+    return cc
+
+
 def add_panel_label(ax, label, x_offset=-0.1):
     '''Add a label letter to a panel'''
     ax.text(x_offset, 0.95, label,